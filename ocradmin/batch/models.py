@@ -4,7 +4,9 @@ one or more OcrTasks.
 """
 
 import datetime
-from django.db import models
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, connection
 from django.contrib.auth.models import User
 from tagging.fields import TagField
 
@@ -15,6 +17,8 @@ class Batch(models.Model):
     """
     OCR Batch object.
     """
+    DONE_STATUSES = ("SUCCESS", "FAILURE", "ABORTED")
+
     user = models.ForeignKey(User, related_name="batches")
     name = models.CharField(max_length=255)
     project = models.ForeignKey(Project, related_name="batches")
@@ -50,19 +54,89 @@ class Batch(models.Model):
         """
         return self.tasks.all()
 
+    def summary(self):
+        """
+        Task counts by status, overall progress and whether
+        the batch is complete.  Cached for a few seconds so
+        that polling clients don't each hit the database, and
+        cleared whenever a task's status changes, so only the
+        progress of running tasks can lag.
+        """
+        key = self.summary_key(self.pk)
+        summary = cache.get(key)
+        if summary is None:
+            summary = self._get_summary()
+            timeout = getattr(settings, "BATCH_SUMMARY_CACHE", 2)
+            if timeout:
+                cache.set(key, summary, timeout)
+        return summary
+
+    @classmethod
+    def summary_key(cls, batch_pk):
+        return "batch_summary_%d" % batch_pk
+
+    @classmethod
+    def clear_summary(cls, batch_pk):
+        """
+        Forget the cached summary of a batch.
+        """
+        cache.delete(cls.summary_key(batch_pk))
+
+    def _get_summary(self):
+        """
+        Work out the batch summary with a single aggregate
+        query.  Progress is an estimate, with each task
+        weighted by its number of lines (or 50, if unknown.)
+        """
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute(
+            "SELECT %(status)s, COUNT(*), SUM(COALESCE(%(lines)s, 50)),"
+            " SUM(COALESCE(%(lines)s, 50) * COALESCE(%(progress)s, 0))"
+            " FROM %(table)s WHERE %(batch)s = %%s GROUP BY %(status)s" % dict(
+                table=qn(self.tasks.model._meta.db_table),
+                status=qn("status"),
+                lines=qn("lines"),
+                progress=qn("progress"),
+                batch=qn("batch_id")), [self.pk])
+        counts = {}
+        totallines = running = 0
+        percentdone = 0.0
+        for status, count, lines, progress in cursor.fetchall():
+            counts[status] = count
+            # SUMs can come back as Decimals
+            lines, progress = int(lines), float(progress)
+            totallines += lines
+            if status in self.DONE_STATUSES:
+                percentdone += lines * 100.0
+            else:
+                running += count
+                percentdone += progress
+        done = 0
+        if totallines > 0:
+            done = min(100.0, percentdone / totallines)
+            # if there are running tasks, never go above
+            # 99%
+            if running > 0:
+                done = max(0, done - 1.0)
+        return dict(
+            counts=counts,
+            task_count=sum(counts.values()),
+            progress=done,
+            complete=running == 0,
+        )
+
     def is_complete(self):
         """
         Check whether all tasks are done.
         """
-        numrunning = self.tasks.exclude(
-                status__in=("SUCCESS", "FAILURE", "ABORTED")).count()
-        return numrunning == 0
+        return self.summary()["complete"]
 
     def task_count(self):
         """
         Return the number of contained tasks.
         """
-        return self.tasks.count()
+        return self.summary()["task_count"]
 
     def estimate_progress(self):
         """
@@ -72,28 +146,7 @@ class Batch(models.Model):
         of stages where progress is difficult to
         measure, i.e. segmentation.
         """
-        totallines = 0
-        percentdone = 0
-        runningtasks = 0
-        tasks = self.tasks.all()
-        for t in tasks:
-            totallines += t.lines or 50
-        if totallines == 0:
-            return 0
-        for t in tasks:
-            lines = t.lines or 50
-            weight = float(lines) / float(totallines)
-            if t.status in ("FAILURE", "ABORTED", "SUCCESS"):
-                percentdone += (weight * 100)
-            else:
-                runningtasks += 1
-                percentdone += (weight * t.progress)
-        done = min(100.0, percentdone)
-        # if there are running tasks, never go above
-        # 99%
-        if runningtasks > 0:
-            done -= 1.0
-        return max(0, done)
+        return self.summary()["progress"]
 
     def errored_tasks(self):
         """
@@ -4,74 +4,307 @@ Celery tasks for Batch operations.
 
 import os
 import shutil
+import celery
 from celery.contrib.abortable import AbortableTask
-from celery.task.sets import subtask
 from ocradmin.ocrtasks.decorators import register_handlers
+from ocradmin.ocrtasks.models import OcrTask
 from ocradmin.ocrtasks.utils import get_progress_callback, get_abort_callback
+from django.db import transaction
 from django.utils import simplejson as json
 
 from nodetree import cache, node, script, exceptions
 from django.conf import settings
 from ocradmin.nodelib import stages, nodes
+from ocradmin.nodelib import utils as pluginutils
+from ocradmin.batch.models import Batch
+from ocradmin.batch import utils as batchutils
 from ocradmin.projects.models import Project
 from ocradmin.documents import status
 
 
+# compiled batch scripts, by batch pk, kept
+# for the lifetime of the worker process
+MAX_TEMPLATES = 20
+_templates = {}
+
+
+def get_batch_template(batch_pk):
+    """
+    Get the project pk and deserialized script
+    template for a batch.
+    """
+    try:
+        return _templates[batch_pk]
+    except KeyError:
+        batch = Batch.objects.get(pk=batch_pk)
+        if len(_templates) >= MAX_TEMPLATES:
+            _templates.clear()
+        _templates[batch_pk] = (batch.project_id, json.loads(batch.script))
+        return _templates[batch_pk]
+
+
+def run_batch_item(task_id, args, logger):
+    """
+    Run a batch task's args.  Tasks carry the batch pk, the
+    pid and the overrides to apply to the batch template,
+    or (if created before there were templates) the project
+    pk, pid and a full script.
+    """
+    first, pid, rest = args
+    if isinstance(rest, basestring):
+        return run_document_script(task_id, first, pid,
+                json.loads(rest), logger)
+    project_pk, template = get_batch_template(first)
+    run_document_script(task_id, project_pk, pid,
+            batchutils.apply_overrides(template, rest), logger)
+
+
+def get_shared_cacher(logger):
+    """
+    Read-only view of the shared node cache, so batch runs
+    can reuse what's been computed interactively, or None
+    if that's switched off.
+    """
+    if not getattr(settings, "NODETREE_BATCH_SHARED_CACHE", False) \
+            or not getattr(settings, "NODETREE_SHARED_CACHE", False):
+        return
+    cacheclass = pluginutils.get_cacher(settings)
+    if not getattr(cacheclass, "shareable", False):
+        return
+    return cacheclass(
+            path=os.path.join(settings.MEDIA_ROOT, settings.TEMP_PATH),
+            logger=logger, shared=True, readonly=True,
+            arrayformat=getattr(settings, "NODETREE_CACHE_ARRAY_FORMAT", "png"),
+            locktimeout=getattr(settings,
+                "NODETREE_BATCH_CACHE_LOCK_TIMEOUT", 0))
+
+
+def run_document_script(task_id, project_pk, pid, nodelist, logger):
+    """
+    Run a batch script for one document, under the
+    given (OcrTask) task id.
+    """
+    project = Project.objects.get(pk=project_pk)
+    storage = project.get_storage()
+    doc = storage.get(pid)
+    logger.debug("Running Document Batch Item: %s", pid)
+
+    # try and delete the existing binary dzi file
+    dzipath = storage.document_attr_dzi_path(doc, "binary")
+    dzifiles = os.path.splitext(dzipath)[0] + "_files"
+    try:
+        os.unlink(dzipath)
+        shutil.rmtree(dzifiles)
+    except OSError:
+        pass
+
+    progress_handler = get_progress_callback(task_id)
+    abort_handler = get_abort_callback(task_id)
+    progress_handler(0)
+
+    nodekwargs = dict(
+            logger=logger,
+            abort_func=abort_handler,
+            progress_func=progress_handler)
+    cacher = get_shared_cacher(logger)
+    if cacher is not None:
+        nodekwargs.update(cacher=cacher)
+    tree = script.Script(nodelist, nodekwargs=nodekwargs)
+    logger.debug("Running tree: %s", json.dumps(tree.serialize(), indent=2))
+    try:
+        # write out the binary... this should cache it's input
+        os.environ["NODETREE_WRITE_FILEOUT"] = "1"
+        doc.script_content = json.dumps(tree.serialize(), indent=2)
+        doc.script_label = "%s.json" % os.path.splitext(doc.label)[0]
+        doc.script_mimetype = "application/json"
+        # set document metadata to indicate it's an OCR "draft"
+        doc.ocr_status = status.RUNNING
+        doc.save()
+
+        # process the nodes
+        [t.eval() for t in tree.get_terminals()]
+
+    except Exception, err:
+        logger.exception("Unhandled exception: %s", err)
+        # set document metadata to indicate it's an OCR "draft"
+        doc.ocr_status = status.ERROR
+    else:
+        # set document metadata to indicate it's an OCR "draft"
+        doc.ocr_status = status.UNCORRECTED
+    finally:
+        doc.save()
+        progress_handler.flush()
+
+
 @register_handlers
 class DocBatchScriptTask(AbortableTask):
     name = "run.batchitem"
     ignore_result = True
 
-    def run(self, project_pk, pid, scriptjson):
+    def run(self, batch_pk, pid, overrides):
         """
         Runs the convert action.
         """
-        project = Project.objects.get(pk=project_pk)
-        storage = project.get_storage()
-        doc = storage.get(pid)
+        run_batch_item(self.request.id, (batch_pk, pid, overrides),
+                self.get_logger())
+
+
+class DocBatchGroupTask(AbortableTask):
+    """
+    Run several batch documents, one after the other, from
+    a single message.  Each document still has its own
+    OcrTask, so the status of those is kept up to date here
+    rather than by the usual signal handlers.
+    """
+    name = "run.batchgroup"
+    ignore_result = True
+
+    def run(self, task_ids):
+        """
+        Run each task in turn.
+        """
         logger = self.get_logger()
-        logger.debug("Running Document Batch Item: %s")
+        for task_id in task_ids:
+            # anything aborted while waiting has moved on from
+            # INIT or PENDING, so gets skipped
+            if not OcrTask.objects.filter(task_id=task_id,
+                    status__in=("INIT", "PENDING")).update(status="STARTED"):
+                continue
+            task = OcrTask.objects.get(task_id=task_id)
+            Batch.clear_summary(task.batch_id)
+            try:
+                run_batch_item(task_id, task.args, logger)
+            except Exception, err:
+                logger.exception("Batch item failed: %s", err)
+                OcrTask.objects.filter(task_id=task_id,
+                        status="STARTED").update(error=err, status="FAILURE")
+            else:
+                # leave it be if it's been aborted meanwhile
+                OcrTask.objects.filter(task_id=task_id,
+                        status="STARTED").update(status="SUCCESS")
+            Batch.clear_summary(task.batch_id)
 
-        # try and delete the existing binary dzi file
-        dzipath = storage.document_attr_dzi_path(doc, "binary")
-        dzifiles = os.path.splitext(dzipath)[0] + "_files"
-        try:
-            os.unlink(dzipath)
-            shutil.rmtree(dzifiles)
-        except OSError:
-            pass
-
-        progress_handler = get_progress_callback(self.request.id)
-        abort_handler = get_abort_callback(self.request.id)
-        progress_handler(0)
-
-        tree = script.Script(json.loads(scriptjson),
-                nodekwargs=dict(
-                    logger=logger,
-                    abort_func=abort_handler,
-                    progress_func=progress_handler))
-        logger.debug("Running tree: %s", json.dumps(tree.serialize(), indent=2))
+
+class BatchSchedulerTask(AbortableTask):
+    """
+    Create and send the tasks for a batch a chunk at a time,
+    holding back while too many tasks are waiting on the
+    queue.  All the scheduler's state is in the OcrTask table,
+    so running it again for a batch picks up where it left off.
+    """
+    name = "batch.schedule"
+    ignore_result = True
+
+    def run(self, batch_pk, pids=None):
+        """
+        Create any missing tasks for the given pids, then
+        dispatch the next chunk and reschedule if there
+        are more to come.
+        """
+        logger = self.get_logger()
         try:
-            # write out the binary... this should cache it's input
-            os.environ["NODETREE_WRITE_FILEOUT"] = "1"
-            doc.script_content = json.dumps(tree.serialize(), indent=2)
-            doc.script_label = "%s.json" % os.path.splitext(doc.label)[0]
-            doc.script_mimetype = "application/json"
-            # set document metadata to indicate it's an OCR "draft"
-            doc.ocr_status = status.RUNNING
-            doc.save()
-
-            # process the nodes
-            [t.eval() for t in tree.get_terminals()]
-
-        except Exception, err:
-            logger.exception("Unhandled exception: %s", err)
-            # set document metadata to indicate it's an OCR "draft"
-            doc.ocr_status = status.ERROR
-        else:
-            # set document metadata to indicate it's an OCR "draft"
-            doc.ocr_status = status.UNCORRECTED
-        finally:
-            doc.save()
-            
+            batch = Batch.objects.get(pk=batch_pk)
+        except Batch.DoesNotExist:
+            logger.info("Batch %s no longer exists", batch_pk)
+            return
+        if pids:
+            numcreated = create_batch_tasks(batch, pids)
+            logger.debug("Created %d tasks for batch %s", numcreated, batch_pk)
+        numsent = dispatch_batch_tasks(batch)
+        logger.debug("Sent %d tasks for batch %s", numsent, batch_pk)
+        if batch.tasks.filter(status="INIT").exists():
+            self.apply_async(args=(batch_pk,),
+                    countdown=getattr(settings, "BATCH_DISPATCH_INTERVAL", 5))
+
+
+def create_batch_tasks(batch, pids):
+    """
+    Create INIT tasks for each pid that doesn't already
+    have one, in chunks.  Returns the number created.
+    """
+    storage = batch.project.get_storage()
+    pids = storage.sort_pidlist(storage.namespace, pids)
+    existing = set(batch.tasks.values_list("page_name", flat=True))
+    pids = [pid for pid in pids if pid not in existing]
+    chunksize = getattr(settings, "BATCH_CHUNK_SIZE", 100)
+    for start in range(0, len(pids), chunksize):
+        ocrtasks = []
+        for pid in pids[start:start + chunksize]:
+            ocrtasks.append(OcrTask(
+                task_id=OcrTask.get_new_task_id(),
+                user=batch.user,
+                batch=batch,
+                project=batch.project,
+                page_name=pid, # FIXME: This is wrong
+                task_name=batch.task_type,
+                status="INIT",
+                args=(batch.pk, pid, batchutils.document_overrides(pid),),
+                kwargs=dict(),
+            ))
+        with transaction.commit_on_success():
+            OcrTask.create_multiple(ocrtasks)
+    return len(pids)
+
+
+def dispatch_batch_tasks(batch):
+    """
+    Send as many of a batch's INIT tasks as the queue has
+    room for, up to a chunk.  Returns the number sent.
+    """
+    maxpending = getattr(settings, "BATCH_MAX_PENDING", 500)
+    pending = OcrTask.objects.filter(status__in=("PENDING", "RETRY")).count()
+    room = min(maxpending - pending, getattr(settings, "BATCH_CHUNK_SIZE", 100))
+    if room <= 0:
+        return 0
+    ocrtasks = claim_batch_tasks(batch, room)
+    if not ocrtasks:
+        return 0
+    groupsize = getattr(settings, "BATCH_PAGES_PER_TASK", 1)
+    if groupsize <= 1 or batch.task_type != DocBatchScriptTask.name:
+        celerytask = celery.registry.tasks[batch.task_type]
+        messages = [([t], dict(args=t.args, kwargs=t.kwargs,
+                task_id=t.task_id)) for t in ocrtasks]
+    else:
+        celerytask = DocBatchGroupTask
+        messages = []
+        for start in range(0, len(ocrtasks), groupsize):
+            group = ocrtasks[start:start + groupsize]
+            messages.append((group,
+                    dict(args=([t.task_id for t in group],))))
+    publisher = celerytask.get_publisher(connect_timeout=5)
+    sent = 0
+    try:
+        for tasks, message in messages:
+            celerytask.apply_async(publisher=publisher, loglevel=60,
+                    retries=2, **message)
+            sent += len(tasks)
+    finally:
+        publisher.close()
+        publisher.connection.close()
+        if sent < len(ocrtasks):
+            # put back what wasn't sent, for the next round
+            with transaction.commit_on_success():
+                OcrTask.objects.filter(
+                        pk__in=[t.pk for t in ocrtasks[sent:]],
+                        status="PENDING").update(status="INIT")
+            Batch.clear_summary(batch.pk)
+    return sent
+
 
+def claim_batch_tasks(batch, limit):
+    """
+    Move up to `limit` of a batch's INIT tasks to PENDING,
+    returning those that were.  Each row is only claimed if
+    it's still INIT, so overlapping scheduler runs never
+    send the same task twice.
+    """
+    claimed = []
+    with transaction.commit_on_success():
+        for task in batch.tasks.filter(status="INIT").order_by("id")[:limit]:
+            if OcrTask.objects.filter(pk=task.pk,
+                    status="INIT").update(status="PENDING"):
+                task.status = "PENDING"
+                claimed.append(task)
+    if claimed:
+        Batch.clear_summary(batch.pk)
+    return claimed
@@ -11,6 +11,8 @@ from django.conf import settings
 
 from ocradmin.presets.models import Preset
 from ocradmin.batch.models import Batch
+from ocradmin.batch.tasks import BatchSchedulerTask, claim_batch_tasks
+from ocradmin.batch.utils import apply_overrides, DOCUMENT_INPUT
 from ocradmin.ocrtasks.models import OcrTask
 from ocradmin.projects.models import Project
 from ocradmin.core.tests import testutils
@@ -99,6 +101,16 @@ class BatchTest(TestCase):
                 self.doc.pid)
         return pk
 
+    def test_summary_action(self):
+        """
+        Test fetching a batch summary.
+        """
+        pk = self._test_batch_action()
+        r = self.client.get("/batch/summary/%s/" % pk)
+        content = json.loads(r.content)
+        self.assertEqual(content["task_count"], 1)
+        self.assertEqual(sum(content["counts"].values()), 1)
+
     def test_page_results_page_action(self):
         """
         Test fetching task results.  Assume a page with offset 0
@@ -133,6 +145,43 @@ class BatchTest(TestCase):
         r = self.client.get("/batch/show/%s/" % pk)
         self.assertEqual(r.status_code, 200)
 
+    def test_schedule_resume(self):
+        """
+        Test re-running the scheduler doesn't duplicate tasks.
+        """
+        pk = self._test_batch_action()
+        batch = Batch.objects.get(pk=pk)
+        self.assertEqual(batch.tasks.count(), 1)
+        BatchSchedulerTask.apply(args=(batch.pk, [self.doc.pid]))
+        self.assertEqual(batch.tasks.count(), 1)
+
+    def test_claim_tasks(self):
+        """
+        Test a task is only claimed for sending once.
+        """
+        pk = self._test_batch_action()
+        batch = Batch.objects.get(pk=pk)
+        batch.tasks.update(status="INIT")
+        Batch.clear_summary(pk)
+        self.assertEqual(batch.summary()["counts"], {"INIT": 1})
+        self.assertEqual(len(claim_batch_tasks(batch, 10)), 1)
+        self.assertEqual(claim_batch_tasks(batch, 10), [])
+        self.assertEqual(batch.tasks.filter(status="PENDING").count(), 1)
+        # claiming clears the cached summary
+        self.assertEqual(batch.summary()["counts"], {"PENDING": 1})
+
+    def test_batch_template(self):
+        """
+        Test tasks only carry the per-document params.
+        """
+        pk = self._test_batch_action()
+        batch = Batch.objects.get(pk=pk)
+        task = batch.tasks.all()[0]
+        self.assertEqual(task.args[:2], (batch.pk, self.doc.pid))
+        nodelist = apply_overrides(json.loads(batch.script), task.args[2])
+        self.assertEqual(dict(nodelist[DOCUMENT_INPUT]["params"])["pid"],
+                self.doc.pid)
+
     def test_delete_action(self):
         """
         Test viewing batch details.
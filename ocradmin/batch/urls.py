@@ -16,6 +16,7 @@ urlpatterns = patterns('',
     (r'^retry/(?P<batch_pk>\d+)/?$', login_required(views.retry)),
     (r'^retry_errored/(?P<batch_pk>\d+)/?$', login_required(views.retry_errored)),
     (r'^show/(?P<batch_pk>\d+)/?$', login_required(views.show)),
+    (r'^summary/(?P<batch_pk>\d+)/?$', login_required(views.summary)),
     (r'^test/?$', login_required(views.test)),
 	(r'^upload_files/?$', login_required(views.upload_files)),
 )
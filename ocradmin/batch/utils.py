@@ -0,0 +1,118 @@
+"""
+Utilities for building per-document batch scripts.
+"""
+
+import os
+
+from django.utils import simplejson as json
+from ocradmin.core import utils as ocrutils
+from ocradmin.nodelib import stages
+from nodetree import script, exceptions
+
+
+def script_for_page_file(scriptjson, filepath, writepath):
+    """
+    Modify the given script for a specific file.
+    """
+    tree = script.Script(json.loads(scriptjson))
+    validate_batch_script(tree)
+    # get the input node and replace it with out path
+    input = tree.get_nodes_by_attr("stage", stages.INPUT)[0]
+    input.set_param("path", filepath)
+    # attach a fileout node to the binary input of the recognizer and
+    # save it as a binary file    
+    rec = tree.get_nodes_by_attr("stage", stages.RECOGNIZE)[0]
+    outpath = ocrutils.get_binary_path(filepath, writepath)
+    outbin = tree.add_node("util.FileOut", "OutputBinary",
+            params=[
+                ("path", os.path.abspath(outpath).encode()),
+                ("create_dir", True)])
+    outbin.set_input(0, rec.input(0))
+    return json.dumps(tree.serialize(), indent=2)
+
+
+# labels of the per-document nodes in a compiled batch script
+DOCUMENT_INPUT = "DocumentImage"
+DOCUMENT_TRANSCRIPT = "DocumentTranscript"
+DOCUMENT_BINARY = "DocumentBinary"
+
+
+def compile_batch_script(scriptjson, project):
+    """
+    Validate a script and turn it into a template for all
+    the documents in a batch, reading from and writing to
+    project storage.  The pids are filled in for each
+    document by `document_overrides`.
+    """
+    tree = script.Script(json.loads(scriptjson))
+    validate_batch_script(tree)
+
+    oldinput = tree.get_nodes_by_attr("stage", stages.INPUT)[0]
+    rec = tree.get_nodes_by_attr("stage", stages.RECOGNIZE)[0]
+    # assume the binary is the first input to the recogniser
+    bin = rec.input(0)
+
+    input = tree.new_node("storage.DocImageFileIn", DOCUMENT_INPUT,
+            params=[("project", project.pk), ("pid", "")])
+    recout = tree.add_node("storage.DocWriter", DOCUMENT_TRANSCRIPT,
+            params=[
+                ("project", project.pk),
+                ("pid", ""),
+                ("attribute", "transcript")])
+    binout = tree.add_node("storage.DocWriter", DOCUMENT_BINARY,
+            params=[
+                ("project", project.pk),
+                ("pid", ""),
+                ("attribute", "binary")])
+
+    tree.replace_node(oldinput, input)
+    recout.set_input(0, rec)
+    binout.set_input(0, bin)
+    return json.dumps(tree.serialize(), indent=2)
+
+
+def document_overrides(pid):
+    """
+    Params to set on a compiled batch script to
+    run it on a given document.
+    """
+    return dict([(label, dict(pid=pid)) for label in \
+            (DOCUMENT_INPUT, DOCUMENT_TRANSCRIPT, DOCUMENT_BINARY)])
+
+
+def apply_overrides(template, overrides):
+    """
+    Get a copy of a (deserialized) script with the given
+    {label: {param: value}} overrides set.  Nodes without
+    any overrides are shared with the template.
+    """
+    nodelist = template.copy()
+    for label, params in overrides.iteritems():
+        nodelist[label] = nodedict = template[label].copy()
+        nodedict["params"] = [[name, params.get(name, value)] \
+                for name, value in nodedict["params"]]
+    return nodelist
+
+
+def script_for_document(scriptjson, project, pid):
+    """
+    Modify the given script for a specific file.
+    """
+    template = json.loads(compile_batch_script(scriptjson, project))
+    return json.dumps(apply_overrides(template, document_overrides(pid)),
+            indent=2)
+
+
+def validate_batch_script(script):
+    """Check everything is A-OK before starting."""
+    inputs = script.get_nodes_by_attr("stage", stages.INPUT)
+    if not inputs:
+        raise exceptions.ScriptError("No input stages found in script")
+    if len(inputs) > 1:
+        raise exceptions.ScriptError("More than one input found for batch script")
+
+    recs = script.get_nodes_by_attr("stage", stages.RECOGNIZE)
+    if not recs:
+        raise exceptions.ScriptError("No recognize stages found in script")
+    
+
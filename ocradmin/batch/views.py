@@ -23,11 +23,12 @@ from ocradmin.core import generic_views as gv
 from ocradmin.core import utils as ocrutils
 from ocradmin.core.decorators import project_required, saves_files
 from ocradmin.batch.models import Batch
+from ocradmin.batch.tasks import BatchSchedulerTask
+from ocradmin.batch.utils import script_for_page_file, \
+        script_for_document, compile_batch_script
 from ocradmin.ocrtasks.models import OcrTask
 from ocradmin.core.views import AppException
 from ocradmin.presets.models import Preset
-from ocradmin.nodelib import stages
-from nodetree import script, exceptions
 
 
 class BatchForm(forms.ModelForm):
@@ -116,33 +117,18 @@ def create(request):
 
 
 def dispatch_batch(batch, pids):
-    """Dispatch a batch task."""
-    # hack - sort the incoming list of pids
-    storage = batch.project.get_storage()
-    pid = storage.sort_pidlist(storage.namespace, pids)
-
-    options = dict(loglevel=60, retries=2)
-    ocrtasks = []
-    for pid in pids:
-        docscript = script_for_document(batch.script,
-                batch.project, pid)
-        tid = OcrTask.get_new_task_id()
-        args = (batch.project.pk, pid, docscript,)
-        kwargs = dict()
-        ocrtask = OcrTask(
-            task_id=tid,
-            user=batch.user,
-            batch=batch,
-            project=batch.project,
-            page_name=pid, # FIXME: This is wrong
-            task_name=batch.task_type,
-            status="INIT",
-            args=args,
-            kwargs=kwargs,
-        )
-        ocrtask.save()
-        ocrtasks.append(ocrtask)
-    OcrTask.run_celery_task_multiple(batch.task_type, ocrtasks, **options)
+    """
+    Compile the batch's script and queue the scheduler for
+    it.  The page tasks themselves are created and sent by
+    the scheduler, on a worker, so this returns straight
+    away however many pids there are.
+    """
+    batch.script = compile_batch_script(batch.script, batch.project)
+    batch.save()
+    # the scheduler must be able to see the batch
+    if transaction.is_managed():
+        transaction.commit()
+    BatchSchedulerTask.apply_async(args=(batch.pk, pids))
 
 
 def results(request, batch_pk):
@@ -168,6 +154,16 @@ def results(request, batch_pk):
     return response
 
 
+def summary(request, batch_pk):
+    """
+    Get progress and task counts for a batch, without
+    any of its tasks.
+    """
+    batch = get_object_or_404(Batch, pk=batch_pk)
+    return HttpResponse(json.dumps(batch.summary()),
+            mimetype="application/json")
+
+
 def page_results(request, batch_pk, page_index):
     """
     Get the results for a single page.
@@ -259,9 +255,11 @@ def abort_batch(request, batch_pk):
     Abort an entire batch.
     """
     batch = get_object_or_404(Batch, pk=batch_pk)
-    for task in batch.tasks.all():
+    for task in batch.tasks.filter(status__in=OcrTask.ACTIVE_STATUSES)\
+            .defer(*OcrTask.DETAIL_FIELDS):
         task.abort()
     transaction.commit()
+    Batch.clear_summary(batch.pk)
     if request.is_ajax():
         return HttpResponse(json.dumps({"ok": True}),
                 mimetype="application/json")
@@ -278,6 +276,7 @@ def retry(request, batch_pk):
     for task in batch.tasks.all():
         task.retry()
     transaction.commit()
+    Batch.clear_summary(batch.pk)
     if request.is_ajax():
         return HttpResponse(json.dumps({"ok": True}),
                 mimetype="application/json")
@@ -294,6 +293,7 @@ def retry_errored(request, batch_pk):
     for task in batch.errored_tasks():
         task.retry()
     transaction.commit()
+    Batch.clear_summary(batch.pk)
     if request.is_ajax():
         return HttpResponse(json.dumps({"ok": True}),
                 mimetype="application/json")
@@ -330,7 +330,7 @@ def _serialize_batch(batch, start=0, limit=25, statuses=None, name=None):
     """
     taskqset = batch.tasks.all()
     if statuses:
-        taskqset = batch.tasks.filter(status__in=statuses)
+        taskqset = taskqset.filter(status__in=statuses)
     if name:
         taskqset = taskqset.filter(page_name__icontains=name)
     task_count = taskqset.count()
@@ -343,10 +343,15 @@ def _serialize_batch(batch, start=0, limit=25, statuses=None, name=None):
             "comparison": {"fields": ()},
         },
     )
-    taskssl = pyserializer.serialize(
-        taskqset.order_by("page_name")[start:start + limit],
-        excludes=("args", "kwargs", "traceback",),
-    )
+    # serialize the tasks by hand from just the columns
+    # needed, leaving the big pickled ones in the database
+    fields = [f.name for f in OcrTask._meta.fields \
+            if f.name not in OcrTask.DETAIL_FIELDS and not f.primary_key]
+    taskssl = []
+    for values in taskqset.order_by("page_name")\
+            .values("id", *fields)[start:start + limit]:
+        taskssl.append(dict(pk=values.pop("id"),
+                model="ocrtasks.ocrtask", fields=values))
     batchsl[0]["fields"]["tasks"] = taskssl
     batchsl[0]["extras"]["task_count"] = task_count
     return batchsl
@@ -418,74 +423,3 @@ def _handle_multipart_upload(request, outdir):
     else:
         paths = ocrutils.save_ocr_images(request.FILES.iteritems(), outdir)
     return paths
-
-
-def script_for_page_file(scriptjson, filepath, writepath):
-    """
-    Modify the given script for a specific file.
-    """
-    tree = script.Script(json.loads(scriptjson))
-    validate_batch_script(tree)
-    # get the input node and replace it with out path
-    input = tree.get_nodes_by_attr("stage", stages.INPUT)[0]
-    input.set_param("path", filepath)
-    # attach a fileout node to the binary input of the recognizer and
-    # save it as a binary file    
-    rec = tree.get_nodes_by_attr("stage", stages.RECOGNIZE)[0]
-    outpath = ocrutils.get_binary_path(filepath, writepath)
-    outbin = tree.add_node("util.FileOut", "OutputBinary",
-            params=[
-                ("path", os.path.abspath(outpath).encode()),
-                ("create_dir", True)])
-    outbin.set_input(0, rec.input(0))
-    return json.dumps(tree.serialize(), indent=2)
-
-
-def script_for_document(scriptjson, project, pid):
-    """
-    Modify the given script for a specific file.
-    """
-    doc = project.get_storage().get(pid)
-    tree = script.Script(json.loads(scriptjson))
-    validate_batch_script(tree)
-
-    # get the input node and replace it with out path
-    binname = ".bin".join(os.path.splitext(doc.image_label))
-    recname = os.path.splitext(doc.image_label)[0] + ".html"
-    oldinput = tree.get_nodes_by_attr("stage", stages.INPUT)[0]
-    rec = tree.get_nodes_by_attr("stage", stages.RECOGNIZE)[0]
-    # assume the binary is the first input to the recogniser
-    bin = rec.input(0)
-
-    input = tree.new_node("storage.DocImageFileIn", doc.image_label, 
-            params=[("project", project.pk), ("pid", pid)])
-    recout = tree.add_node("storage.DocWriter", recname, 
-            params=[
-                ("project", project.pk),
-                ("pid", pid),
-                ("attribute", "transcript")])
-    binout = tree.add_node("storage.DocWriter", binname, 
-            params=[
-                ("project", project.pk),
-                ("pid", pid),
-                ("attribute", "binary")])
-
-    tree.replace_node(oldinput, input)
-    recout.set_input(0, rec)
-    binout.set_input(0, bin)
-    return json.dumps(tree.serialize(), indent=2)
-
-
-def validate_batch_script(script):
-    """Check everything is A-OK before starting."""
-    inputs = script.get_nodes_by_attr("stage", stages.INPUT)
-    if not inputs:
-        raise exceptions.ScriptError("No input stages found in script")
-    if len(inputs) > 1:
-        raise exceptions.ScriptError("More than one input found for batch script")
-
-    recs = script.get_nodes_by_attr("stage", stages.RECOGNIZE)
-    if not recs:
-        raise exceptions.ScriptError("No recognize stages found in script")
-    
-
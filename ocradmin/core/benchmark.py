@@ -1,4 +1,11 @@
+import os
+import sys
+import glob
 import time
+import shutil
+import resource
+import tempfile
+import subprocess as sp
 import utils
 
 
@@ -24,12 +31,65 @@ def test_sp_binarize():
 
 
 
+def run_deepzoom(source, single_pass, workers):
+    """
+    Create a DZI, printing the wall time and peak RSS.
+    """
+    sys.path.insert(0, os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), "..", ".."))
+    from ocradmin.vendor import deepzoom
+    outdir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        creator = deepzoom.ImageCreator(tile_size=512,
+                tile_overlap=2, tile_format="png",
+                image_quality=1, resize_filter="nearest",
+                workers=workers, single_pass=single_pass)
+        creator.create(source, os.path.join(outdir, "bench.dzi"))
+        print time.time() - start, \
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        shutil.rmtree(outdir, True)
+
+
+def test_deepzoom(source, single_pass=True, workers=1):
+    """
+    Create a DZI in a fresh interpreter, returning the
+    wall time and peak RSS (in KB).
+    """
+    out = sp.Popen([sys.executable, os.path.abspath(__file__),
+            "deepzoom-run", source, str(int(single_pass)), str(workers)],
+            stdout=sp.PIPE).communicate()[0]
+    secs, rss = out.split()
+    return float(secs), int(rss)
+
+
+def benchmark_deepzoom(sources):
+    """
+    Compare the per-level and single-pass DZI pyramid builders.
+    """
+    for source in sources:
+        print os.path.basename(source)
+        for name, single_pass, workers in [
+                ("Per-level", False, 1),
+                ("Single-pass", True, 1),
+                ("Single-pass, 4 threads", True, 4)]:
+            secs, rss = test_deepzoom(source, single_pass, workers)
+            print "  %-24s %03f secs, %d KB peak RSS" % (name, secs, rss)
+
+
 if __name__ == "__main__":
-    
+    if len(sys.argv) > 1 and sys.argv[1] == "deepzoom-run":
+        run_deepzoom(sys.argv[2], bool(int(sys.argv[3])), int(sys.argv[4]))
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "deepzoom":
+        sources = sys.argv[2:] or glob.glob(os.path.join(
+                os.path.dirname(os.path.abspath(__file__)), "..", "etc", "*.png"))
+        benchmark_deepzoom(sources)
+        sys.exit(0)
+
     simple = sum([test_simple_binarize() for i in range(0, 5)]) / 5.0
     bespoke = sum([test_sp_binarize() for i in range(0, 5)]) / 5.0
 
     print "Simple:  %03f secs" % simple
     print "Bespoke: %03f secs" % bespoke
-
-
@@ -43,23 +43,31 @@ class UnhandledCreateDocDzi(AbortableTask):
         """
         Create a DZI of the given document, as <path>/dzi/<basename>.
         """
-        logger = self.get_logger()
         project = Project.objects.get(pk=project_pk)
         storage = project.get_storage()
-        doc = storage.get(pid)
-        path = storage.document_attr_dzi_path(doc, attr)
-        if not os.path.exists(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path))
-        if not os.path.exists(path):
-            with storage.document_attr_content(doc, attr) as handle:
-                creator = deepzoom.ImageCreator(tile_size=512,
-                        tile_overlap=2, tile_format="png",
-                        image_quality=1, resize_filter="nearest")
-                logger.debug("Creating DZI path: %s", path)
-                creator.create(handle, path)
+        path = create_document_dzi(storage, storage.get(pid), attr,
+                self.get_logger())
         return dict(pid=pid, dst=utils.media_path_to_url(path))
 
 
+def create_document_dzi(storage, doc, attr, logger):
+    """
+    Create a DZI of a document attribute, if there isn't
+    one already, and return its path.
+    """
+    path = storage.document_attr_dzi_path(doc, attr)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    if not os.path.exists(path):
+        with storage.document_attr_content(doc, attr) as handle:
+            creator = deepzoom.ImageCreator(tile_size=512,
+                    tile_overlap=2, tile_format="png",
+                    image_quality=1, resize_filter="nearest")
+            logger.debug("Creating DZI path: %s", path)
+            creator.create(handle, path)
+    return path
+
+
 
 
 class CleanupTempTask(PeriodicTask):
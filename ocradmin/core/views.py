@@ -70,7 +70,8 @@ def update_ocr_task(request, pid):
 
     ref = request.POST.get("ref", "/batch/show/%d/" % task.batch.pk)
     json.loads(script)
-    task.args = (task.args[0], task.args[1], script)
+    # run the edited script in full, rather than the batch template
+    task.args = (task.batch.project.pk, task.args[1], script)
     task.save()
     doc.ocr_status = docstatus.RUNNING
     doc.save()
@@ -0,0 +1,82 @@
+"""
+Bulk ingestion of document images from directories
+and tarballs of scans.
+"""
+
+import os
+import tarfile
+import mimetypes
+from django.conf import settings
+from ocradmin.documents import status as docstatus
+from ocradmin.documents.tasks import queue_document_images
+
+
+def image_mimetype(name):
+    """Guess the mimetype of an image file, or None if
+    it doesn't look like an image."""
+    mimetype = mimetypes.guess_type(name)[0]
+    if mimetype is not None and mimetype.startswith("image/"):
+        return mimetype
+
+
+def directory_images(path):
+    """List (label, mimetype, opener) for each image in
+    a directory, in name order."""
+    images = []
+    for name in sorted(os.listdir(path)):
+        filepath = os.path.join(path, name)
+        mimetype = image_mimetype(name)
+        if mimetype is not None and os.path.isfile(filepath):
+            images.append((name, mimetype,
+                    lambda filepath=filepath: open(filepath, "rb")))
+    return images
+
+
+def tarball_images(tar):
+    """List (label, mimetype, opener) for each image in
+    an open tarball.  They're left in archive order, so
+    compressed archives are read through just once."""
+    images = []
+    for member in tar.getmembers():
+        mimetype = image_mimetype(member.name)
+        if mimetype is not None and member.isfile():
+            images.append((os.path.basename(member.name), mimetype,
+                    lambda member=member: tar.extractfile(member)))
+    return images
+
+
+def ingest_images(project, images, dzi=None):
+    """Create a document for each (label, mimetype, opener)
+    image, streaming the image straight into storage.
+    Pids are allocated INGEST_CHUNK_SIZE at a time, and
+    thumbnails (and DZIs) for each chunk are queued as
+    Celery tasks.  Returns the new pids."""
+    storage = project.get_storage()
+    chunksize = max(1, getattr(settings, "INGEST_CHUNK_SIZE", 50))
+    pids = []
+    for start in range(0, len(images), chunksize):
+        chunk = images[start:start + chunksize]
+        docs = storage.create_documents([label for label, _, _ in chunk])
+        for doc, (label, mimetype, opener) in zip(docs, chunk):
+            doc.set_metadata(title=label, ocr_status=docstatus.INITIAL)
+            doc.save()
+            handle = opener()
+            try:
+                storage.write_document_attr(doc, "image", handle,
+                        mimetype, label)
+            finally:
+                handle.close()
+        queue_document_images(project.pk, [doc.pid for doc in docs], dzi)
+        pids.extend([doc.pid for doc in docs])
+    return pids
+
+
+def ingest_path(project, path, dzi=None):
+    """Ingest the images in a directory or tarball."""
+    if os.path.isdir(path):
+        return ingest_images(project, directory_images(path), dzi)
+    tar = tarfile.open(path, "r:*")
+    try:
+        return ingest_images(project, tarball_images(tar), dzi)
+    finally:
+        tar.close()
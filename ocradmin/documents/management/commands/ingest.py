@@ -0,0 +1,41 @@
+"""
+Ingest directories or tarballs of document images into a project.
+"""
+
+import os
+import tarfile
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from ocradmin.projects.models import Project
+from ocradmin.documents import ingest
+
+
+class Command(BaseCommand):
+    args = "<project> <dir or tarball 1> ... <dir or tarball N>"
+    help = "Create documents from directories or tarballs of images"
+    option_list = BaseCommand.option_list + (
+        make_option(
+            "--dzi",
+            action="store_true",
+            dest="dzi",
+            default=None,
+            help="Also queue DZI generation for the new documents' images"),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) < 2:
+            raise CommandError("A project and paths to ingest must be given.")
+        try:
+            project = Project.objects.get(name=args[0])
+        except Project.DoesNotExist:
+            raise CommandError("Project does not exist: %s" % args[0])
+        for path in args[1:]:
+            if not os.path.exists(path):
+                raise CommandError("Path does not exist: %s" % path)
+            if not os.path.isdir(path) and not tarfile.is_tarfile(path):
+                raise CommandError("Not a directory or tarball: %s" % path)
+        for path in args[1:]:
+            pids = ingest.ingest_path(project, path, options.get("dzi"))
+            self.stdout.write("Ingested %d documents from: %s\n" % (
+                len(pids), path))
@@ -0,0 +1,50 @@
+"""
+Celery tasks for document images.
+"""
+
+from celery.task import Task
+from django.conf import settings
+from ocradmin.core.tasks import create_document_dzi
+from ocradmin.projects.models import Project
+
+
+class DocumentImagesTask(Task):
+    """
+    Make thumbnails, and optionally image DZIs, for a
+    group of documents from a single message.
+    """
+    name = "documents.images"
+    ignore_result = True
+
+    def run(self, project_pk, pids, dzi=False):
+        logger = self.get_logger()
+        storage = Project.objects.get(pk=project_pk).get_storage()
+        for pid in pids:
+            doc = storage.get(pid)
+            try:
+                doc.make_thumbnail()
+                if dzi:
+                    create_document_dzi(storage, doc, "image", logger)
+            except Exception, err:
+                logger.exception("Error making images for %s: %s", pid, err)
+
+
+def queue_document_images(project_pk, pids, dzi=None):
+    """
+    Queue thumbnail (and DZI) generation for some documents,
+    INGEST_IMAGES_PER_TASK to a message.
+    """
+    pids = list(pids)
+    if not pids:
+        return
+    if dzi is None:
+        dzi = getattr(settings, "INGEST_CREATE_DZI", False)
+    groupsize = max(1, getattr(settings, "INGEST_IMAGES_PER_TASK", 20))
+    publisher = DocumentImagesTask.get_publisher(connect_timeout=5)
+    try:
+        for start in range(0, len(pids), groupsize):
+            DocumentImagesTask.apply_async(args=(project_pk,
+                    pids[start:start + groupsize], dzi), publisher=publisher)
+    finally:
+        publisher.close()
+        publisher.connection.close()
@@ -5,7 +5,19 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import os
+import errno
+import socket
+import shutil
+import httplib
+import tempfile
+import threading
+from cStringIO import StringIO
 from django.test import TestCase
+from django.conf import settings
+
+from fcrepo.http import pool
+from ocradmin.storage import index, fedora
 
 
 class SimpleTest(TestCase):
@@ -14,3 +26,245 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class MetadataIndexTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.index = index.MetadataIndex(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_merge_delete(self):
+        """
+        Test merging and deleting metadata, and telling
+        unindexed pids from those with no metadata.
+        """
+        self.assertTrue(self.index.get("test:1") is None)
+        self.index.set("test:1", {})
+        self.assertEqual(self.index.get("test:1"), {})
+        self.assertEqual(self.index.merge("test:1", dict(label="a", size=1)),
+                dict(label="a", size="1"))
+        self.assertEqual(self.index.merge("test:1", dict(label="b")),
+                dict(label="b", size="1"))
+        self.assertEqual(self.index.delete("test:1", ["size"]),
+                dict(label="b"))
+        self.index.set("test:1", dict(status="new"))
+        self.assertEqual(self.index.get_many(["test:1", "test:2"]),
+                {"test:1": dict(status="new")})
+        self.index.remove("test:1")
+        self.assertTrue(self.index.get("test:1") is None)
+
+
+class PidIndexTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for pid in ["test:3", "test:1", "other:9"]:
+            os.mkdir(os.path.join(self.root, pid))
+        self.index = index.PidIndex(self.root, "test")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_allocate(self):
+        """
+        Test the index is built from the document directories,
+        and new pids follow on from them, in order.
+        """
+        self.assertEqual(self.index.list(), ["test:1", "test:3"])
+        self.assertEqual(self.index.allocate(), "test:4")
+        self.assertEqual(self.index.allocate(2), ["test:5", "test:6"])
+        self.assertEqual(self.index.next("test:1"), "test:3")
+        self.assertEqual(self.index.prev("test:4"), "test:3")
+        self.assertTrue(self.index.prev("test:1") is None)
+        self.assertTrue(self.index.next("test:6") is None)
+        self.assertEqual(index.MetadataIndex(self.root).unindexed(),
+                ["test:1", "test:3", "test:4", "test:5", "test:6"])
+
+    def test_concurrent_allocate(self):
+        """
+        Test pids allocated at the same time, on separate
+        connections, are all different.
+        """
+        pids = []
+        def allocate():
+            pidindex = index.PidIndex(self.root, "test")
+            for i in range(10):
+                pids.extend(pidindex.allocate(2))
+        # start the allocators while the write lock is held
+        with self.index.transaction():
+            threads = [threading.Thread(target=allocate) for i in range(4)]
+            for thread in threads:
+                thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(pids, key=self.index.pidnum),
+                ["test:%d" % num for num in range(4, 84)])
+
+
+class MockResponse(object):
+    """
+    Just enough of an httplib response for the pool.
+    """
+    status = 200
+    will_close = False
+
+    def isclosed(self):
+        return True
+
+    def read(self, amt=None):
+        return ""
+
+    def close(self):
+        pass
+
+
+class MockConnection(object):
+    """
+    An httplib connection that records the requests sent
+    down it, and fails to read their responses as told.
+    """
+    requests = []
+    failures = []
+
+    def __init__(self, host, port, timeout=None):
+        self.sock = None
+
+    def connect(self):
+        self.sock = object()
+
+    def putrequest(self, method, path, **kwargs):
+        self.requests.append(method)
+
+    def putheader(self, name, value):
+        pass
+
+    def endheaders(self):
+        pass
+
+    def send(self, data):
+        pass
+
+    def getresponse(self):
+        if self.failures:
+            raise self.failures.pop(0)
+        return MockResponse()
+
+    def close(self):
+        self.sock = None
+
+
+class ConnectionPoolTest(TestCase):
+    def setUp(self):
+        MockConnection.requests = []
+        MockConnection.failures = []
+        self.pool = pool.ConnectionPool("http", "localhost", 8080,
+                retries=2, backoff=0)
+        self.pool._connclass = MockConnection
+
+    def _keep_alive(self):
+        conn = MockConnection("localhost", 8080)
+        conn.connect()
+        self.pool._idle.put(conn)
+
+    def test_resend_dropped(self):
+        """
+        Test a POST down a kept-alive connection the server
+        had closed is resent on a new one.
+        """
+        self._keep_alive()
+        MockConnection.failures = [httplib.BadStatusLine("")]
+        response = self.pool.request("POST", "/", {}, "body")
+        self.assertEqual(response.status, 200)
+        self.assertEqual(MockConnection.requests, ["POST", "POST"])
+
+    def test_no_resend_after_send(self):
+        """
+        Test a POST isn't resent once its body was sent,
+        or after a timeout.
+        """
+        MockConnection.failures = [socket.error(errno.ECONNRESET, "reset")]
+        self.assertRaises(socket.error, self.pool.request,
+                "POST", "/", {}, "body")
+        self.assertEqual(MockConnection.requests, ["POST"])
+        self._keep_alive()
+        MockConnection.failures = [socket.timeout("timed out")]
+        self.assertRaises(socket.timeout, self.pool.request,
+                "POST", "/", {}, "body")
+        self.assertEqual(MockConnection.requests, ["POST", "POST"])
+
+    def test_retry_limit(self):
+        """
+        Test every resend counts against the retries.
+        """
+        self._keep_alive()
+        MockConnection.failures = [httplib.BadStatusLine("")] * 5
+        self.assertRaises(httplib.BadStatusLine, self.pool.request,
+                "GET", "/", {})
+        self.assertEqual(len(MockConnection.requests), 3)
+        self.assertEqual(self.pool.getStats()["retries"], 2)
+
+
+class MockDatastreamResponse(object):
+    """
+    A streamed datastream response, which remembers
+    whether it was closed.
+    """
+    reason = "Error"
+
+    def __init__(self, status, content=""):
+        self.status = status
+        self.closed = False
+        self._content = StringIO(content)
+
+    def read(self, amt=None):
+        return self._content.read(amt) if amt is not None \
+                else self._content.read()
+
+    def close(self):
+        self.closed = True
+
+
+class MockRestApi(object):
+    def __init__(self, response):
+        self.response = response
+
+    def openDatastreamDissemination(self, pid, dsid):
+        return self.response
+
+
+class ReadDatastreamTest(TestCase):
+    def setUp(self):
+        self._spoolsize = getattr(settings, "FEDORA_SPOOL_SIZE", None)
+        settings.FEDORA_SPOOL_SIZE = 1024
+
+    def tearDown(self):
+        settings.FEDORA_SPOOL_SIZE = self._spoolsize
+
+    def test_spooling(self):
+        """
+        Test small datastreams stay in memory, and big
+        ones go to disk, with the response closed.
+        """
+        for size, rolled in [(100, False), (10000, True)]:
+            response = MockDatastreamResponse(200, "x" * size)
+            handle = fedora.read_datastream(MockRestApi(response),
+                    "test:1", "IMAGE")
+            self.assertEqual(handle._rolled, rolled)
+            self.assertEqual(handle.read(), "x" * size)
+            self.assertTrue(response.closed)
+
+    def test_missing(self):
+        """
+        Test a missing datastream gives None, and other
+        errors are raised.
+        """
+        response = MockDatastreamResponse(404)
+        self.assertTrue(fedora.read_datastream(MockRestApi(response),
+                "test:1", "IMAGE") is None)
+        self.assertTrue(response.closed)
+        response = MockDatastreamResponse(500)
+        self.assertRaises(fedora.RequestFailed, fedora.read_datastream,
+                MockRestApi(response), "test:1", "IMAGE")
+        self.assertTrue(response.closed)
@@ -13,6 +13,7 @@ from ocradmin import storage
 from ocradmin.storage.utils import DocumentEncoder
 from ocradmin.documents import status as docstatus
 from ocradmin.documents.utils import Aspell
+from ocradmin.documents.tasks import queue_document_images
 from ocradmin.core.decorators import project_required
 from ocradmin.presets.models import Preset, Profile
 from ocradmin.ocrtasks.models import OcrTask
@@ -33,9 +34,25 @@ logger = logging.getLogger(__name__)
 
 @project_required
 def doclist(request):
-    """List documents."""
+    """List documents.  A page of them can be requested
+    with `offset` and `limit`, and narrowed down with a
+    label `filter`.  With `format=json` the documents are
+    streamed as a JSON list."""
     project = request.project
     storage = project.get_storage()
+    try:
+        offset = max(0, int(request.GET.get("offset", 0)))
+    except ValueError:
+        offset = 0
+    try:
+        limit = max(1, int(request.GET["limit"]))
+    except (KeyError, ValueError):
+        limit = None
+    objects = storage.list_page(offset, limit, request.GET.get("filter"))
+    if request.GET.get("format") == "json":
+        return HttpResponse(_stream_documents(objects),
+                mimetype="application/json")
+
     template = "documents/list.html" if not request.is_ajax() \
             else "documents/includes/document_list.html"
     profiles = Profile.objects.filter(name="Batch OCR")
@@ -47,7 +64,7 @@ def doclist(request):
     context = dict(
             project=project,
             storage=storage,
-            objects=storage.list(),
+            objects=objects,
             presets=presets,
             newform=newform,
             pfields=["tags", "description", "created_on", "storage_backend"],
@@ -56,6 +73,14 @@ def doclist(request):
     return render(request, template, context)
 
 
+def _stream_documents(docs):
+    """Encode documents as a JSON list, a row at a time."""
+    yield "["
+    for i, doc in enumerate(docs):
+        yield ("," if i else "") + json.dumps(doc, cls=DocumentEncoder)
+    yield "]"
+
+
 @project_required
 def quick_batch(request):
     """Quickly dispatch a batch job."""
@@ -166,16 +191,13 @@ def create(request):
         if not form.cleaned_data["label"]:
             form.cleaned_data["label"] = request.FILES["file"].name 
         doc = store.create_document(form.cleaned_data["label"])
-        doc.image_content = request.FILES["file"]
-        doc.image_mimetype = request.FILES["file"].content_type
-        doc.image_label = request.FILES["file"].name
         doc.set_metadata(
                 title=form.cleaned_data["label"],
                 ocr_status=docstatus.INITIAL)
-        doc.make_thumbnail()
         doc.save()
-        # TODO: Make async
-        #doc.save()
+        store.write_document_attr(doc, "image", request.FILES["file"],
+                request.FILES["file"].content_type, request.FILES["file"].name)
+        queue_document_images(request.session["project"].pk, [doc.pid])
     return HttpResponseRedirect("/documents/list")
 
 
@@ -198,12 +220,12 @@ def create_ajax(request):
         filename = request.GET.get("inlinefile")
         doc = storage.create_document(filename)
         try:
-            doc.image_content = StringIO(request.raw_post_data)
-            doc.image_mimetype = request.META.get("HTTP_X_FILE_TYPE")
-            doc.image_label = filename
             doc.set_metadata(title=filename, ocr_status=docstatus.INITIAL)
-            doc.make_thumbnail()
             doc.save()
+            storage.write_document_attr(doc, "image",
+                    StringIO(request.raw_post_data),
+                    request.META.get("HTTP_X_FILE_TYPE"), filename)
+            queue_document_images(request.project.pk, [doc.pid])
         except Exception, err:
             logger.exception(err)
     if request.is_ajax():
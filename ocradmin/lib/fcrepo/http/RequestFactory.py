@@ -2,8 +2,8 @@
 """
 import base64
 from types import StringTypes
-from httplib2 import Http
 
+from fcrepo.http import pool
 from fcrepo.http.base import B_FCRepoRequestFactory
 from fcrepo.http.base import B_FCRepoResponse
 from fcrepo.http.base import B_FCRepoResponseBody
@@ -67,6 +67,9 @@ class FCRepoResponse(B_FCRepoResponse):
 #
 class FCRepoRequestFactory(B_FCRepoRequestFactory):
 
+    # size of the blocks file-like content is uploaded in
+    BLOCK_SIZE = pool.ConnectionPool.BLOCK_SIZE
+
     def DELETE(self, request_uri):
         return self.submit('DELETE', request_uri)
 
@@ -85,29 +88,57 @@ class FCRepoRequestFactory(B_FCRepoRequestFactory):
 
     def submit(self, method, request_uri, content=None, content_type=None,
                      content_length=None, chunked=False):
-        headers = { 'Connection' : 'Keep-Alive'
-                  , 'Keep-Alive' : '300'
-                  }
         repository = self.getRepositoryURL()
         url = self.getRequestURL(request_uri)
-        #
-        http = Http()
-        #http.add_credentials(self.auth_user, self.auth_pwd, self.domain)
-        auth = base64.encodestring("%s:%s" % (self.auth_user, self.auth_pwd))
-        headers['Authorization'] = 'Basic ' + auth
         if content is None:
             self._last_request = '%s ' % method + url
-            response, body = http.request(url, method, headers=headers)
         else:
             self._last_request = '%s (%s) ' % (method, content_type)  + url
-            headers['Content-Type'] = content_type
-            if content_length:
-                headers['Content-Length'] = str(content_length)
-            response, body = http.request(url, method, body=content,
-                                          headers=headers)
-        response = FCRepoResponse(repository, method, request_uri,
-                                  response, body)
-        return response
+        raw = self.open(method, request_uri, content, content_type,
+                        content_length, chunked)
+        try:
+            response = dict(raw.getheaders())
+            response['status'] = str(raw.status)
+            body = raw.read()
+        finally:
+            raw.close()
+        return FCRepoResponse(repository, method, request_uri,
+                              response, body)
+
+    def open(self, method, request_uri, content=None, content_type=None,
+                   content_length=None, chunked=False):
+        """ Submit a request on a pooled keep-alive connection, and return
+            the response unread so that its body can be streamed.  The
+            connection goes back to the pool once the body has been read
+            or the response closed.  File-like content is sent in blocks
+            rather than read into memory; if its content_length isn't
+            given it's sent with chunked transfer-encoding.
+        """
+        url = self.getRequestURL(request_uri)
+        auth = base64.b64encode("%s:%s" % (self.auth_user, self.auth_pwd))
+        headers = { 'Authorization' : 'Basic ' + auth }
+        if isinstance(content, unicode):
+            content = content.encode('utf-8')
+        if isinstance(content, str):
+            content_length, chunked = len(content), False
+        if content is not None:
+            headers['Content-Type'] = content_type or 'unknown'
+            chunked = chunked or content_length is None
+        if chunked:
+            headers['Transfer-Encoding'] = 'chunked'
+        elif content is not None or method in ('POST', 'PUT'):
+            headers['Content-Length'] = str(content_length or 0)
+        return self.getPool().request(method,
+                url[url.find('/', len(self.protocol) + 3):], headers,
+                content, chunked)
+
+    def getPool(self):
+        return pool.getPool(self.protocol, self.domain, self.port)
+
+    def getStats(self):
+        """ Get the request counters of this repository's connection pool.
+        """
+        return self.getPool().getStats()
 
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -0,0 +1,274 @@
+""" Thread-safe pools of keep-alive HTTP connections, one per repository
+    host, shared by every FCRepoRequestFactory in the process.
+"""
+import time
+import errno
+import socket
+import httplib
+import logging
+import threading
+import Queue
+
+LOG = logging.getLogger('fcrepo.http')
+
+# settings for pools created from now on; see configure()
+DEFAULTS = { 'maxsize' : 4
+           , 'timeout' : 60
+           , 'retries' : 2
+           , 'backoff' : 0.5
+           }
+
+# methods it's safe to send again if we don't know whether
+# the server saw them
+IDEMPOTENT = ('GET', 'HEAD', 'PUT', 'DELETE')
+
+# socket errors that mean the server had closed the connection
+DROPPED = (errno.ECONNRESET, errno.EPIPE)
+
+_pools = {}
+_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    """ Change the maximum size, socket timeout, retry count or initial
+        backoff (in seconds) of pools created from now on.
+    """
+    DEFAULTS.update(kwargs)
+
+def getPool(protocol, host, port):
+    """ Get the process-wide pool for a host.
+    """
+    key = (protocol, host, int(port))
+    _lock.acquire()
+    try:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(protocol, host, port, **DEFAULTS)
+        return _pools[key]
+    finally:
+        _lock.release()
+
+def getStats():
+    """ Get the request counters of every pool, keyed by host URL.
+    """
+    _lock.acquire()
+    try:
+        pools = _pools.items()
+    finally:
+        _lock.release()
+    return dict([('%s://%s:%d' % key, pool.getStats()) \
+            for key, pool in pools])
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+class PooledResponse:
+    """ An httplib response whose connection goes back to its pool once
+        the body has been read, or the response closed.  Connections
+        that can't be reused (because the body wasn't all read, or the
+        server is closing them) are closed instead.
+    """
+
+    def __init__(self, pool, conn, response):
+        self._pool = pool
+        self._conn = conn
+        self._response = response
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self._response.read()
+        else:
+            data = self._response.read(amt)
+        if self._response.isclosed():
+            self.close()
+        return data
+
+    def close(self):
+        if self._conn is not None:
+            reusable = self._response.isclosed() \
+                    and not self._response.will_close
+            self._response.close()
+            self._pool.release(self._conn, reusable)
+            self._conn = None
+
+
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+#
+class ConnectionPool:
+    """ Bounded pool of connections to one host.  Requests that fail on
+        a kept-alive connection the server has since dropped are resent
+        straight away on another.  Those that fail to connect are retried
+        with exponential backoff, as are other failures of idempotent
+        methods.  Nothing is resent after a timeout, and every resend
+        counts against `retries`.
+    """
+
+    # size of the blocks file-like content is uploaded in
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, protocol, host, port, maxsize=4, timeout=60,
+                       retries=2, backoff=0.5):
+        if protocol == 'https':
+            self._connclass = httplib.HTTPSConnection
+        else:
+            self._connclass = httplib.HTTPConnection
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max(1, maxsize))
+        self._statslock = threading.Lock()
+        self._stats = { 'requests' : 0
+                      , 'errors' : 0
+                      , 'retries' : 0
+                      , 'connections' : 0
+                      , 'seconds' : 0.0
+                      , 'methods' : {}
+                      }
+
+    def acquire(self):
+        """ Get an idle connection, or a new one if there are none,
+            waiting if the pool is at its maximum size.
+        """
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            return self._connclass(self.host, self.port,
+                                   timeout=self.timeout)
+
+    def release(self, conn, reusable=True):
+        if reusable:
+            self._idle.put(conn)
+        else:
+            conn.close()
+        self._slots.release()
+
+    def getStats(self):
+        self._statslock.acquire()
+        try:
+            stats = dict(self._stats)
+            stats['methods'] = dict([(m, dict(s)) \
+                    for m, s in self._stats['methods'].iteritems()])
+            return stats
+        finally:
+            self._statslock.release()
+
+    def _count(self, method, seconds=None, **counts):
+        self._statslock.acquire()
+        try:
+            for name, value in counts.iteritems():
+                self._stats[name] += value
+            if seconds is not None:
+                self._stats['requests'] += 1
+                self._stats['seconds'] += seconds
+                mstats = self._stats['methods'].setdefault(method,
+                        { 'requests' : 0, 'seconds' : 0.0 })
+                mstats['requests'] += 1
+                mstats['seconds'] += seconds
+        finally:
+            self._statslock.release()
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+    def request(self, method, path, headers, content=None, chunked=False):
+        """ Send a request and return its PooledResponse, unread.  String
+            content is sent as is, file-like content in blocks (as chunks
+            if `chunked`.)  File-like content is only resent on a retry
+            if it can be rewound.
+        """
+        try:
+            start = content.tell()
+        except (AttributeError, IOError):
+            start = None
+        attempt = 0
+        while True:
+            conn = self.acquire()
+            began = time.time()
+            reused = connected = conn.sock is not None
+            sent = False
+            try:
+                if not reused:
+                    conn.connect()
+                    connected = True
+                    self._count(method, connections=1)
+                self._send(conn, method, path, headers, content, chunked)
+                sent = True
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException), err:
+                self.release(conn, False)
+                self._count(method, errors=1)
+                dropped = reused and self._dropped(err, sent)
+                rewindable = start is not None or isinstance(content, str) \
+                        or content is None
+                if not self._resendable(method, err, connected, dropped) \
+                        or not rewindable or attempt >= self.retries:
+                    raise
+                if start is not None:
+                    content.seek(start)
+                self._count(method, retries=1)
+                attempt += 1
+                if dropped:
+                    # the server dropped an idle connection; that's no
+                    # reason to wait, and it'll be replaced with a new one
+                    continue
+                delay = self.backoff * 2 ** (attempt - 1)
+                LOG.warning('%s %s failed (%s), retrying in %.1fs' % (
+                        method, path, err, delay))
+                time.sleep(delay)
+                continue
+            except:
+                self.release(conn, False)
+                raise
+            elapsed = time.time() - began
+            self._count(method, seconds=elapsed)
+            LOG.debug('%s %s: %s (%.3fs)' % (method, path, response.status,
+                    elapsed))
+            return PooledResponse(self, conn, response)
+
+    def _dropped(self, err, sent):
+        """ Whether a failure on a kept-alive connection means the server
+            had already closed it, so it never saw the request: either
+            sending failed, or the first read found the connection gone.
+        """
+        if isinstance(err, socket.timeout):
+            return False
+        if not sent:
+            return True
+        if isinstance(err, httplib.BadStatusLine):
+            return True
+        return isinstance(err, socket.error) \
+                and getattr(err, 'errno', None) in DROPPED
+
+    def _resendable(self, method, err, connected, dropped):
+        """ Whether a failed request can safely be sent again.
+        """
+        if not connected or dropped:
+            # it never reached the server
+            return True
+        if isinstance(err, socket.timeout):
+            # the server may still be working on it
+            return False
+        return method in IDEMPOTENT
+
+    def _send(self, conn, method, path, headers, content, chunked):
+        conn.putrequest(method, path, skip_accept_encoding=True)
+        for name, value in headers.iteritems():
+            conn.putheader(name, value)
+        conn.endheaders()
+        if isinstance(content, str):
+            conn.send(content)
+        elif content is not None:
+            while True:
+                block = content.read(self.BLOCK_SIZE)
+                if not block:
+                    break
+                if chunked:
+                    block = '%x\r\n%s\r\n' % (len(block), block)
+                conn.send(block)
+            if chunked:
+                conn.send('0\r\n\r\n')
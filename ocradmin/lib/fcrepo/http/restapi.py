@@ -201,6 +201,18 @@ class FCRepoRestAPI:
     METHOD_PARAMS['getDatastreamDissemination'] = ('asOfDateTime',)    
     RETURN_STATUS['getDatastreamDissemination'] = '200'
 
+    def openDatastreamDissemination(self, pid, dsID, **kwargs):
+        """ As getDatastreamDissemination, but returns the unread httplib
+            response so that the content can be streamed.
+        """
+        uri = '/objects/' + pid + '/datastreams/' + dsID + '/content'
+        param_uri = self.paramsAsURI('getDatastreamDissemination', kwargs)
+        if param_uri:
+            uri += '?' + param_uri
+        #
+        repo = self.getRequestFactory()
+        return repo.open('GET', uri)
+
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
     def getDatastreams(self, **kwargs):
@@ -337,7 +349,7 @@ class FCRepoRestAPI:
         mimetype = kwargs.get('mimeType',None)
         if mimetype is None:
             mimetype = self.guessMimeType(content)
-        return repo.POST(uri, content, mimetype)
+        return repo.POST(uri, content, mimetype, content_length=content_length)
 
     METHOD_PARAMS['modifyDatastream'] = ( 'dsLocation', 'altIDs', 'dsLabel'
                                         , 'versionable', 'dsState', 'formatURI'
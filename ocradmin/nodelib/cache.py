@@ -2,27 +2,306 @@
 OCR-specific nodetree cacher classes.
 """
 import os
+import copy
+import gzip
+import time
+import uuid
+import errno
+import fcntl
 import shutil
+import sqlite3
+import tempfile
+import threading
 from contextlib import contextmanager
+from ordereddict import OrderedDict
 
+from django.conf import settings
 from nodetree import cache
 from ocradmin.vendor import deepzoom
+from ocradmin.nodelib import stages
 import hashlib
 import bencode
 
 from pymongo import Connection
+from pymongo.errors import DuplicateKeyError
 import gridfs
+import numpy
+import PIL.Image
 
 class UnsupportedCacheTypeError(StandardError):
     pass
 
 
+# bytes of decoded images to keep for cutting lazy DZI tiles from
+TILE_SOURCE_CACHE = 64 * 1024 * 1024
+
+
+class TouchTimes(object):
+    """
+    When cache entries were last marked as used by this
+    process, so reads don't write to the index every time.
+    """
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._times = OrderedDict()
+        self._lock = threading.Lock()
+
+    def due(self, key, interval):
+        """
+        Check if it's more than `interval` seconds since
+        the key was last due and, if so, reset it.
+        """
+        now = time.time()
+        with self._lock:
+            last = self._times.pop(key, None)
+            if last is not None and now - last < interval:
+                self._times[key] = last
+                return False
+            self._times[key] = now
+            while len(self._times) > self.maxsize:
+                self._times.popitem(last=False)
+            return True
+
+
+_touches = TouchTimes()
+
+
+class CacheIndex(object):
+    """
+    Access-ordered index of node cache entries, kept in an
+    SQLite database at the root of the cache path so it can
+    be shared between processes.  Each entry is a node's cache
+    directory (relative to the root) and everything in it.
+    Entries in the shared tier belong to the shared key, and
+    other keys hold references to them; an entry is only
+    deleted when nothing references it any more.
+    """
+    dbname = ".cacheindex.db"
+
+    def __init__(self, root):
+        self._root = root
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            if not os.path.exists(self._root):
+                os.makedirs(self._root, 0777)
+            self._conn = sqlite3.connect(
+                    os.path.join(self._root, self.dbname), timeout=30)
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                    entry TEXT PRIMARY KEY, key TEXT NOT NULL,
+                    size INTEGER NOT NULL DEFAULT 0,
+                    atime REAL NOT NULL)""")
+            self._conn.execute("""CREATE INDEX IF NOT EXISTS
+                    entries_key_atime ON entries (key, atime)""")
+            self._conn.execute("""CREATE INDEX IF NOT EXISTS
+                    entries_atime ON entries (atime)""")
+            self._conn.execute("""CREATE TABLE IF NOT EXISTS refs (
+                    key TEXT NOT NULL, entry TEXT NOT NULL,
+                    atime REAL NOT NULL, PRIMARY KEY (key, entry))""")
+            self._conn.execute("""CREATE INDEX IF NOT EXISTS
+                    refs_entry ON refs (entry)""")
+            self._conn.commit()
+        return self._conn
+
+    def touch(self, key, entry, size=None, ref=None):
+        """
+        Mark an entry as used, optionally (re)setting its size.
+        If `ref` is given it's the key using a shared entry,
+        which then holds a reference to it.
+        """
+        now = time.time()
+        with self.conn:
+            if ref is not None:
+                self.conn.execute("INSERT OR REPLACE INTO refs "
+                        "(key, entry, atime) VALUES (?, ?, ?)",
+                        (ref, entry, now))
+            if size is None:
+                cur = self.conn.execute(
+                        "UPDATE entries SET atime = ? WHERE entry = ?",
+                        (now, entry))
+                if cur.rowcount:
+                    return
+                size = 0
+            self.conn.execute("INSERT OR REPLACE INTO entries "
+                    "(entry, key, size, atime) VALUES (?, ?, ?, ?)",
+                    (entry, key, size, now))
+
+    def grow(self, entry, size):
+        """
+        Add to an entry's size, marking it as used.
+        """
+        with self.conn:
+            self.conn.execute("UPDATE entries SET size = size + ?, "
+                    "atime = ? WHERE entry = ?", (size, time.time(), entry))
+
+    def remove(self, entry):
+        with self.conn:
+            self.conn.execute("DELETE FROM entries WHERE entry = ?", (entry,))
+            self.conn.execute("DELETE FROM refs WHERE entry = ?", (entry,))
+
+    def release(self, key, entry):
+        """
+        Drop a key's reference to a shared entry, returning
+        True (and removing the entry) if nothing else uses it.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM refs WHERE key = ? AND entry = ?",
+                    (key, entry))
+            return bool(self._orphans([entry]))
+
+    def clear(self, key):
+        """
+        Remove a key's entries and references, returning
+        the shared entries nothing uses any more.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            entries = [entry for (entry,) in self.conn.execute(
+                    "SELECT entry FROM refs WHERE key = ?", (key,))]
+            self.conn.execute("DELETE FROM refs WHERE key = ?", (key,))
+            return self._orphans(entries)
+
+    def _orphans(self, entries):
+        orphans = [entry for entry in entries \
+                if not self.conn.execute("SELECT COUNT(*) FROM refs "
+                    "WHERE entry = ?", (entry,)).fetchone()[0]]
+        self.conn.executemany("DELETE FROM entries WHERE entry = ?",
+                [(entry,) for entry in orphans])
+        return orphans
+
+    def count(self, key=None):
+        if key is None:
+            cur = self.conn.execute("SELECT COUNT(*) FROM entries")
+        else:
+            cur = self.conn.execute("SELECT COUNT(*) FROM entries "
+                    "WHERE key = ? OR entry IN "
+                    "(SELECT entry FROM refs WHERE key = ?)", (key, key))
+        return cur.fetchone()[0]
+
+    def size(self, key=None):
+        """
+        Total bytes for a given key, including shared entries
+        it references, or for all keys.
+        """
+        if key is None:
+            cur = self.conn.execute("SELECT SUM(size) FROM entries")
+        else:
+            cur = self.conn.execute("SELECT SUM(size) FROM entries "
+                    "WHERE key = ? OR entry IN "
+                    "(SELECT entry FROM refs WHERE key = ?)", (key, key))
+        return cur.fetchone()[0] or 0
+
+    def lru(self, key=None):
+        """
+        List (key, entry, size) tuples, least recently used first.
+        For a given key that includes the shared entries it
+        references, by when it last used them, with the key
+        that owns them.
+        """
+        if key is None:
+            cur = self.conn.execute(
+                    "SELECT key, entry, size FROM entries ORDER BY atime")
+            return cur.fetchall()
+        cur = self.conn.execute("SELECT key, entry, size, atime FROM entries "
+                "WHERE key = ? UNION ALL "
+                "SELECT entries.key, entries.entry, entries.size, refs.atime "
+                "FROM refs JOIN entries ON entries.entry = refs.entry "
+                "WHERE refs.key = ? ORDER BY atime", (key, key))
+        return [row[:3] for row in cur]
+
+
+class NodeDigests(object):
+    """
+    Memo of node cache digests.  A node's digest is the md5
+    of its name, its params and its inputs' digests, so each
+    node is hashed just once however deep the graph is,
+    rather than bencoding its whole upstream `hash_value`
+    every time.  Nodes that don't expose their params and
+    inputs are hashed by their `hash_value`.  Anything that
+    changes a node that's already been hashed must go through
+    `set_param`/`set_input`, or call `invalidate`.
+    """
+    def __init__(self):
+        # id(node) -> (node, digest), keeping the node so
+        # its id can't be reused
+        self._digests = {}
+        # id(node) -> ids of the nodes it's an input to
+        self._outputs = {}
+
+    @classmethod
+    def encodable(cls, value):
+        if isinstance(value, unicode):
+            return value.encode("utf8")
+        if isinstance(value, (int, long, str)) and not isinstance(value, bool):
+            return value
+        return repr(value)
+
+    def digest(self, n):
+        try:
+            return self._digests[id(n)][1]
+        except KeyError:
+            pass
+        inputs = getattr(n, "_inputs", None)
+        params = getattr(n, "_params", None)
+        if inputs is None or params is None:
+            value = n.hash_value()
+        else:
+            inputs = [i for i in inputs if i is not None]
+            value = dict(
+                name=self.encodable(n.name),
+                params=[[self.encodable(k), self.encodable(v)] \
+                        for k, v in sorted(params.items())],
+                inputs=[self.digest(i) for i in inputs])
+            for i in inputs:
+                self._outputs.setdefault(id(i), set()).add(id(n))
+        digest = hashlib.md5(bencode.bencode(value)).hexdigest()
+        self._digests[id(n)] = (n, digest)
+        return digest
+
+    def invalidate(self, n):
+        """
+        Forget the digests of a node and everything downstream.
+        """
+        pending = [id(n)]
+        while pending:
+            key = pending.pop()
+            if self._digests.pop(key, None) is not None:
+                pending.extend(self._outputs.pop(key, ()))
+
+    def set_param(self, n, name, value):
+        """
+        Set a node param, invalidating it if it changed.
+        """
+        if n._params.get(name) != value:
+            n.set_param(name, value)
+            self.invalidate(n)
+
+    def set_input(self, n, num, input):
+        """
+        Set a node input, invalidating it if it changed.
+        """
+        if n.input(num) is not input:
+            n.set_input(num, input)
+            self.invalidate(n)
+
+    def clear(self):
+        self._digests.clear()
+        self._outputs.clear()
+
+
 class BaseCacher(cache.BasicCacher):
     cachetype = "memory"
-    def __init__(self, path="", key="", **kwargs):
+    def __init__(self, path="", key="", digests=None, **kwargs):
         super(BaseCacher, self).__init__(**kwargs)
         self._key = key
         self._path = path
+        self._digests = digests if digests is not None else NodeDigests()
+
+    @property
+    def digests(self):
+        return self._digests
 
     def set_cache(self, n, data):
         pass
@@ -33,9 +312,22 @@ class BaseCacher(cache.BasicCacher):
     def has_cache(self, n):
         return False
 
+    def is_cached(self, n):
+        """
+        Check for a node's data without waiting for
+        anybody else computing it.
+        """
+        return self.has_cache(n)
+
+    def release_locks(self):
+        pass
+
+    def get_digest(self, n):
+        return self._digests.digest(n)
+
     def get_path(self, n):
-        hash = hashlib.md5(bencode.bencode(n.hash_value())).hexdigest()
-        return os.path.join(self._path, self._key, n.label, hash)
+        return os.path.join(self._path, self._key, n.label,
+                self.get_digest(n))
 
     def clear(self):
         pass
@@ -46,34 +338,130 @@ class BaseCacher(cache.BasicCacher):
     def size(self):
         pass
 
+    def prune(self, maxsize, allkeys=False):
+        pass
 
 
 class PersistantFileCacher(BaseCacher):
     """
-    Store data in files for persistance.
+    Store data in files for persistance.  In shared mode node
+    data is stored once, by digest alone, under the shared key,
+    and each key just holds references to what it uses, so the
+    same node evaluated for different users (or by batch runs)
+    is only computed and stored once.
+
+    With a lock timeout, evaluation is single-flight: asking
+    whether an uncached node has data takes a per-digest lock,
+    so whoever gets it first computes the node while anybody
+    else asking waits and then reads what it wrote.  The lock
+    is held until the data is set (or `release_locks` called.)
+    Files are written to a temporary name and then renamed,
+    so they're never read half-written.
     """
     cachetype = "file"
+    indexed = True
+    mmap = True
+    arrayformats = ("png", "npy", "npy.gz")
+    # can entries be shared between keys?
+    shareable = True
+    # seconds between index writes for reads of an entry
+    touch_interval = 60
+    sharedkey = "shared"
+
+    def __init__(self, *args, **kwargs):
+        """
+        arrayformat: how to store image (ndarray) data, either "png",
+        raw "npy" (memory-mapped on read) or gzipped "npy.gz".
+        shared: store node data in the shared tier.
+        readonly: only read from the cache, never writing to it or
+        serving output nodes (which are only run for what they write.)
+        locktimeout: how long, in seconds, to wait for anybody else
+        computing the same node before computing it anyway, or 0
+        for no locking.
+        """
+        self._arrayformat = kwargs.pop("arrayformat", "png")
+        if not self._arrayformat in self.arrayformats:
+            raise UnsupportedCacheTypeError(
+                    "Unknown array format: %s" % self._arrayformat)
+        self._shared = kwargs.pop("shared", False) and self.shareable
+        self._readonly = kwargs.pop("readonly", False)
+        self._locktimeout = kwargs.pop("locktimeout", 0)
+        super(PersistantFileCacher, self).__init__(*args, **kwargs)
+        self._index = None
+        self._locks = {}
+
+    @property
+    def shared(self):
+        return self._shared
+
+    def get_path(self, n):
+        if not self._shared:
+            return super(PersistantFileCacher, self).get_path(n)
+        digest = self.get_digest(n)
+        return os.path.join(self._path, self.sharedkey, digest[:2], digest)
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = CacheIndex(self._path)
+        return self._index
+
+    def get_file_name(self, node):
+        """
+        Name of the file a node's data is cached in, which
+        for images depends on the array format.
+        """
+        fname = node.get_file_name()
+        base, ext = os.path.splitext(fname)
+        if ext == ".png" and self._arrayformat != "png":
+            return "%s.%s" % (base, self._arrayformat)
+        return fname
 
     def read_node_data(self, node, path):
         """
         Get the file data under path and return it.
         """
-        readpath = os.path.join(path, node.get_file_name())
+        readpath = os.path.join(path, self.get_file_name(node))
         self.logger.debug("Reading %s cache: %s", self.cachetype, readpath)
+        return self.read_file(readpath, node.reader)
+
+    def read_file(self, readpath, reader):
+        """
+        Read a cache file, using reader for anything that
+        isn't a numpy array.
+        """
+        if readpath.endswith(".npy") and self.mmap:
+            return numpy.load(readpath, mmap_mode="r")
         with self.get_read_handle(readpath) as fh:
-            return node.reader(fh)
+            if readpath.endswith(".npy"):
+                return numpy.load(fh)
+            elif readpath.endswith(".npy.gz"):
+                return numpy.load(gzip.GzipFile(fileobj=fh, mode="rb"))
+            return reader(fh)
 
     def write_node_data(self, node, path, data):
-        filepath = os.path.join(path, node.get_file_name())
+        fname = self.get_file_name(node)
+        filepath = os.path.join(path, fname)
         self.logger.info("Writing %s cache: %s", self.cachetype, filepath)
         if data is not None:
             with self.get_write_handle(filepath) as fh:
-                node.writer(fh, data)
+                if fname.endswith(".npy"):
+                    numpy.save(fh, data)
+                elif fname.endswith(".npy.gz"):
+                    with gzip.GzipFile(fileobj=fh, mode="wb",
+                            compresslevel=1) as gz:
+                        numpy.save(gz, data)
+                else:
+                    node.writer(fh, data)
 
     def get_cache(self, n):
+        if self._readonly and cache.BasicCacher.has_cache(self, n):
+            return cache.BasicCacher.get_cache(self, n)
         path = self.get_path(n)
-        if self.has_cache(n):
-            return self.read_node_data(n, path)
+        if self.is_cached(n):
+            data = self.read_node_data(n, path)
+            self.touch_entry(path)
+            return data
 
     @contextmanager
     def get_read_handle(self, readpath):
@@ -85,114 +473,552 @@ class PersistantFileCacher(BaseCacher):
 
     @contextmanager
     def get_write_handle(self, filepath):
-        if not os.path.exists(os.path.dirname(filepath)):
-            os.makedirs(os.path.dirname(filepath), 0777)
+        dirname = os.path.dirname(filepath)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname, 0777)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+        fd, temppath = tempfile.mkstemp(dir=dirname, prefix=".tmp")
+        h = os.fdopen(fd, "wb")
         try:
-            h = open(filepath, "wb")
             yield h
-        finally:
             h.close()
+            os.chmod(temppath, 0644)
+            os.rename(temppath, filepath)
+        finally:
+            if not h.closed:
+                h.close()
+            if os.path.exists(temppath):
+                os.unlink(temppath)
 
     def set_cache(self, n, data):
-        self.write_node_data(n, self.get_path(n), data)
+        if self._readonly:
+            # just keep it for this run, like the default cacher
+            return cache.BasicCacher.set_cache(self, n, data)
+        path = self.get_path(n)
+        try:
+            self.write_node_data(n, path, data)
+            self.touch_entry(path, self.entry_size(path))
+        finally:
+            self.release_lock(path)
 
     def has_cache(self, n):
-        return os.path.exists(os.path.join(self.get_path(n), n.get_file_name()))
+        if self._readonly:
+            if cache.BasicCacher.has_cache(self, n):
+                return True
+            if getattr(n, "stage", None) == stages.OUTPUT:
+                return False
+        if self.is_cached(n):
+            return True
+        path = self.get_path(n)
+        if not self._locktimeout or path in self._locks:
+            return False
+        if not self.acquire_lock(path):
+            self.logger.warning("Timed out waiting for %s cache: %s",
+                    self.cachetype, path)
+            return False
+        # somebody else might have computed it while we waited
+        if self.is_cached(n) or self._readonly:
+            self.release_lock(path)
+            return self.is_cached(n)
+        return False
 
-    def clear(self):
-        shutil.rmtree(os.path.join(self._path, self._key), True)
+    def is_cached(self, n):
+        return self.has_file(os.path.join(self.get_path(n), self.get_file_name(n)))
 
-    def clear_cache(self, n):
-        if self.has_cache(n):
-            path = self.get_path(n)
-            fpath = os.path.join(path, n.get_file_name())
-            os.unlink(fpath)
+    def acquire_lock(self, path):
+        """
+        Take the lock on a node's cache, waiting up to the
+        lock timeout.  Returns whether it was taken.
+        """
+        parent = os.path.dirname(path)
+        if not os.path.exists(parent):
             try:
-                os.rmdir(path)
-            except OSError, (errno, strerr):
-                if errno != 39:
+                os.makedirs(parent, 0777)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
                     raise
+        fd = os.open("%s.lock" % path, os.O_RDWR | os.O_CREAT, 0666)
+        deadline = time.time() + self._locktimeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, err:
+                if err.errno not in (errno.EAGAIN, errno.EACCES) \
+                        or time.time() >= deadline:
+                    os.close(fd)
+                    return False
+                time.sleep(0.1)
+            else:
+                self._locks[path] = fd
+                return True
 
-    def size(self):
-        folder = os.path.join(self._path, self._key)
+    def release_lock(self, path):
+        fd = self._locks.pop(path, None)
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def release_locks(self):
+        """
+        Release any locks still held, i.e. for nodes
+        whose evaluation failed.
+        """
+        for path in self._locks.keys():
+            self.release_lock(path)
+
+    @contextmanager
+    def lock(self, path):
+        """
+        Run a block with the lock on a node's cache held,
+        unless it's already held or locking is off.
+        """
+        acquired = self._locktimeout and not path in self._locks \
+                and self.acquire_lock(path)
+        try:
+            yield
+        finally:
+            if acquired:
+                self.release_lock(path)
+
+    def has_file(self, filepath):
+        return os.path.exists(filepath)
+
+    def entry_size(self, path):
+        """
+        Size of all files in a single node's cache dir.
+        """
         size = 0
-        for (path, dirs, files) in os.walk(folder):
+        for (dirpath, dirs, files) in os.walk(path):
             for file in files:
-                filename = os.path.join(path, file)
-                size += os.path.getsize(filename)
+                size += os.path.getsize(os.path.join(dirpath, file))
         return size
 
+    def touch_entry(self, path, size=None):
+        """
+        Record use of a node's cache dir in the LRU index.
+        Uses are only written once every `touch_interval`
+        seconds per entry, which is near enough for pruning.
+        """
+        if not self.indexed:
+            return
+        entry = os.path.relpath(path, self._path)
+        if size is None and not _touches.due((self._path, self._key, entry),
+                self.touch_interval):
+            return
+        if self._shared:
+            self.index.touch(self.sharedkey, entry, size,
+                    ref=None if self._readonly else self._key)
+        else:
+            self.index.touch(self._key, entry, size)
+
+    def grow_entry(self, path, size):
+        """
+        Record a file added to a node's cache dir.
+        """
+        if self.indexed:
+            self.index.grow(os.path.relpath(path, self._path), size)
+
+    def remove_entry(self, path):
+        """
+        Delete a node's cache dir and everything in it.
+        """
+        shutil.rmtree(path, True)
+        if os.path.exists("%s.lock" % path):
+            os.unlink("%s.lock" % path)
+        if self.indexed:
+            self.index.remove(os.path.relpath(path, self._path))
+
+    def release_entry(self, path):
+        """
+        Drop this key's reference to a shared node cache dir,
+        deleting it if nothing else uses it.
+        """
+        if self.index.release(self._key, os.path.relpath(path, self._path)):
+            shutil.rmtree(path, True)
+            if os.path.exists("%s.lock" % path):
+                os.unlink("%s.lock" % path)
+
+    def clear(self):
+        shutil.rmtree(os.path.join(self._path, self._key), True)
+        if self.indexed:
+            for entry in self.index.clear(self._key):
+                shutil.rmtree(os.path.join(self._path, entry), True)
+
+    def clear_cache(self, n):
+        if self._shared and self.indexed:
+            self.release_entry(self.get_path(n))
+        elif self.is_cached(n):
+            self.remove_entry(self.get_path(n))
+
+    def reindex(self):
+        """
+        Rebuild the index entries for this key from what is on
+        disk.  Only needed for caches written before indexing.
+        """
+        folder = os.path.join(self._path, self._key)
+        self.index.clear(self._key)
+        if not os.path.isdir(folder):
+            return
+        for label in os.listdir(folder):
+            labelpath = os.path.join(folder, label)
+            if not os.path.isdir(labelpath):
+                continue
+            for hash in os.listdir(labelpath):
+                path = os.path.join(labelpath, hash)
+                if os.path.isdir(path):
+                    self.touch_entry(path, self.entry_size(path))
+
+    def size(self):
+        return self.index.size(self._key)
+
+    def prune(self, maxsize, allkeys=False):
+        """
+        Delete whole node caches, least recently used first,
+        till the cache is no bigger than maxsize bytes.  If
+        allkeys is given, consider entries belonging to every
+        key under this cacher's path.  Otherwise shared entries
+        are only deleted once no other key references them.
+        """
+        key = None if allkeys else self._key
+        total = self.index.size(key)
+        for entkey, entry, size in self.index.lru(key):
+            if total <= maxsize:
+                break
+            self.logger.debug("Evicting %s cache: %s (%d bytes)",
+                    self.cachetype, entry, size)
+            if key is not None and entkey != key:
+                self.release_entry(os.path.join(self._path, entry))
+            else:
+                self.remove_entry(os.path.join(self._path, entry))
+            total -= size
+        return total
+
+
+_mongo_connection = None
+_mongo_lock = threading.Lock()
+# databases whose indexes have been ensured
+_mongo_indexed = set()
+
+def get_mongo_connection():
+    """
+    Get the process-wide MongoDB connection, which pools
+    sockets for all the cachers using it.
+    """
+    global _mongo_connection
+    with _mongo_lock:
+        if _mongo_connection is None:
+            _mongo_connection = Connection(
+                    getattr(settings, "NODETREE_MONGODB_HOST", "localhost"),
+                    getattr(settings, "NODETREE_MONGODB_PORT", 27017),
+                    max_pool_size=getattr(settings,
+                        "NODETREE_MONGODB_POOL_SIZE", 10))
+        return _mongo_connection
+
 
 class MongoDBCacher(PersistantFileCacher):
     """
-    Write data to MongoDB instead of the FS.
+    Write data to MongoDB instead of the FS.  Locks are lease
+    documents, which anybody can take over once they expire
+    (after the lock timeout), and GridFS files only appear
+    once they've been completely written.  The size and last
+    use of each file is kept in an `entries` collection, with
+    a running total in `stats`, for pruning.
     """
     cachetype = "MongoDB"
+    indexed = False
+    mmap = False
+    # nothing stops one key clearing another's data
+    shareable = False
+
     def __init__(self, *args, **kwargs):
         super(MongoDBCacher, self).__init__(*args, **kwargs)
-        self._db = getattr(Connection(), self._key)
+        self._db = getattr(get_mongo_connection(), self._key)
         self._fs = gridfs.GridFS(self._db)
+        self._owner = uuid.uuid4().hex
+        self._found = (None, None)
+        self.ensure_indexes()
+
+    def ensure_indexes(self):
+        """
+        Index files by name, and entries by last use, once
+        per database per process.
+        """
+        if self._key in _mongo_indexed:
+            return
+        self._db.fs.files.ensure_index([("filename", 1), ("uploadDate", -1)])
+        self._db.entries.ensure_index("atime")
+        _mongo_indexed.add(self._key)
+
+    def find_file(self, filepath):
+        """
+        Look up the latest version of a file, keeping it so
+        it can be opened without looking it up again.
+        """
+        doc = self._db.fs.files.find_one({"filename": filepath},
+                sort=[("uploadDate", -1)])
+        self._found = (filepath, doc)
+        return doc
 
     @contextmanager
     def get_read_handle(self, readpath):
-        try:
-            yield self._fs.get_last_version(readpath)
-        finally:
-            pass
+        foundpath, doc = self._found
+        self._found = (None, None)
+        if foundpath != readpath or doc is None:
+            doc = self.find_file(readpath)
+        if doc is None:
+            raise gridfs.NoFile("no file in gridfs with filename %r" % readpath)
+        yield gridfs.GridOut(self._db.fs, file_document=doc)
 
     @contextmanager
     def get_write_handle(self, filepath):
+        h = self._fs.new_file(filename=filepath, encoding="utf-8")
         try:
-            h = self._fs.new_file(filename=filepath, encoding="utf-8")
             yield h
-        finally:
-            h.close()
+        except:
+            # don't publish a partial file; the chunks written
+            # so far go with it
+            self._fs.delete(h._id)
+            raise
+        h.close()
+        # drop any older versions
+        for doc in self._db.fs.files.find({"filename": filepath,
+                "_id": {"$ne": h._id}}, fields=["_id"]):
+            self._fs.delete(doc["_id"])
+        self.track_file(filepath, h.length)
 
-    def has_cache(self, n):
-        return self._fs.exists(filename=os.path.join(self.get_path(n), n.get_file_name()))
+    def get_cache(self, n):
+        # has_cache has usually just found the file, so
+        # don't look for it again before reading it
+        try:
+            return self.read_node_data(n, self.get_path(n))
+        except gridfs.NoFile:
+            pass
+
+    def read_file(self, readpath, reader):
+        data = super(MongoDBCacher, self).read_file(readpath, reader)
+        self._db.entries.update({"_id": readpath},
+                {"$set": {"atime": time.time()}})
+        return data
+
+    def has_file(self, filepath):
+        return self.find_file(filepath) is not None
+
+    def track_file(self, filepath, size):
+        """
+        Record a file's size and use in the entries.
+        """
+        old = self._db.entries.find_and_modify({"_id": filepath},
+                {"$set": dict(size=size, atime=time.time())},
+                upsert=True, new=False)
+        self._add_size(size - (old or {}).get("size", 0))
+
+    def delete_file(self, filepath):
+        for doc in self._db.fs.files.find({"filename": filepath},
+                fields=["_id"]):
+            self._fs.delete(doc["_id"])
+        old = self._db.entries.find_and_modify({"_id": filepath}, remove=True)
+        if old is not None:
+            self._add_size(-old["size"])
+
+    def _add_size(self, size):
+        if size:
+            self._db.stats.update({"_id": "size"},
+                    {"$inc": {"bytes": size}}, upsert=True)
+
+    def acquire_lock(self, path):
+        deadline = time.time() + self._locktimeout
+        while True:
+            now = time.time()
+            lease = dict(owner=self._owner, expires=now + self._locktimeout)
+            try:
+                self._db.leases.insert(dict(_id=path, **lease), safe=True)
+                taken = True
+            except DuplicateKeyError:
+                # take it over if it's expired
+                result = self._db.leases.update(
+                        {"_id": path, "expires": {"$lt": now}},
+                        {"$set": lease}, safe=True)
+                taken = bool(result and result.get("n"))
+            if taken:
+                self._locks[path] = True
+                return True
+            if now >= deadline:
+                return False
+            time.sleep(0.1)
+
+    def release_lock(self, path):
+        if self._locks.pop(path, None) is not None:
+            self._db.leases.remove({"_id": path, "owner": self._owner})
 
     def clear_cache(self, n):
-        if self.has_cache(n):
-            path = self.get_path(n)
-            filepath = os.path.join(path, n.get_file_name())
-            gridout = self._fs.get_last_version(filepath)
-            self._fs.delete(gridout._id)
+        self.delete_file(os.path.join(self.get_path(n), self.get_file_name(n)))
 
     def clear(self):
-        self._db.drop_collection("fs.files")
-        self._db.drop_collection("fs.chunks")
+        for name in ("fs.files", "fs.chunks", "entries", "stats"):
+            self._db.drop_collection(name)
+        _mongo_indexed.discard(self._key)
+        self.ensure_indexes()
+
+    def reindex(self):
+        """
+        Rebuild the entries from the files in GridFS.  Only
+        needed for caches written before they were tracked.
+        """
+        self._db.drop_collection("entries")
+        self._db.drop_collection("stats")
+        _mongo_indexed.discard(self._key)
+        self.ensure_indexes()
+        for doc in self._db.fs.files.find(fields=["filename", "length"]):
+            self.track_file(doc["filename"], doc["length"])
+
+    def size(self):
+        stats = self._db.stats.find_one({"_id": "size"})
+        return stats["bytes"] if stats is not None else 0
+
+    def prune(self, maxsize, allkeys=False):
+        """
+        Delete files, least recently used first, till the
+        cache is no bigger than maxsize bytes.  Each key has
+        its own database, so allkeys makes no difference.
+        """
+        total = self.size()
+        if total <= maxsize:
+            return total
+        for entry in self._db.entries.find().sort("atime", 1):
+            if total <= maxsize:
+                break
+            self.logger.debug("Evicting %s cache: %s (%d bytes)",
+                    self.cachetype, entry["_id"], entry["size"])
+            self.delete_file(entry["_id"])
+            total -= entry["size"]
+        return total
 
 
 class DziFileCacher(PersistantFileCacher):
     """
-    Write a DZI after having written a PNG.
+    Write a DZI after having written a PNG.  When images are
+    cached in another format the PNG and DZI are only written
+    when asked for via `ensure_dzi`.  In lazy mode only the DZI
+    descriptor is written, and tiles are rendered individually
+    when requested via `get_dzi_tile`.
     """
+    dzi_workers = 4
+
+    def __init__(self, *args, **kwargs):
+        self._lazydzi = kwargs.pop("lazydzi", False)
+        super(DziFileCacher, self).__init__(*args, **kwargs)
+
     def write_node_data(self, node, path, data):
         super(DziFileCacher, self).write_node_data(node, path, data)
-        filepath = os.path.join(path, node.get_file_name())
+        filepath = os.path.join(path, self.get_file_name(node))
         if not filepath.endswith(".png"):
             return
+        if self._lazydzi:
+            if data is not None:
+                self.create_dzi_descriptor(data, path, self.get_dzi_path(node))
+            return
         with self.get_read_handle(filepath) as fh:
-            if not os.path.exists(path):
-                os.makedirs(path)
-            creator = deepzoom.ImageCreator(tile_size=512,
-                    tile_overlap=2, tile_format="png",
-                    image_quality=1, resize_filter="nearest")
-            creator.create(fh, "%s.dzi" % os.path.splitext(filepath)[0])
+            self.create_dzi(fh, path, self.get_dzi_path(node))
+
+    def get_dzi_creator(self):
+        return deepzoom.ImageCreator(tile_size=512,
+                tile_overlap=2, tile_format="png",
+                image_quality=1, resize_filter="nearest",
+                workers=self.dzi_workers)
+
+    def create_dzi(self, source, path, dzipath):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.get_dzi_creator().create(source, dzipath)
+
+    def create_dzi_descriptor(self, data, path, dzipath):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        height, width = data.shape[:2]
+        self.get_dzi_creator().create_descriptor(width, height, dzipath)
+
+    def get_dzi_path(self, n):
+        return os.path.join(self.get_path(n),
+                "%s.dzi" % os.path.splitext(n.get_file_name())[0])
+
+    def ensure_dzi(self, n):
+        """
+        Return the path to a node's DZI, writing the PNG and
+        DZI from the cached array first if necessary.
+        """
+        dzipath = self.get_dzi_path(n)
+        if os.path.exists(dzipath) or not self.is_cached(n) \
+                or not n.get_file_name().endswith(".png"):
+            return dzipath
+        path = self.get_path(n)
+        with self.lock(path):
+            # somebody else might have written it while we waited
+            if os.path.exists(dzipath):
+                return dzipath
+            if self._lazydzi:
+                self.create_dzi_descriptor(self.read_node_data(n, path),
+                        path, dzipath)
+            elif self.get_file_name(n) == n.get_file_name():
+                with self.get_read_handle(
+                        os.path.join(path, n.get_file_name())) as fh:
+                    self.create_dzi(fh, path, dzipath)
+            else:
+                pngpath = os.path.join(path, n.get_file_name())
+                data = self.read_node_data(n, path)
+                with self.get_write_handle(pngpath) as fh:
+                    n.writer(fh, data)
+                self.create_dzi(pngpath, path, dzipath)
+                self.touch_entry(path, self.entry_size(path))
+        return dzipath
+
+    def get_dzi_tile(self, dzipath, level, column, row):
+        """
+        Return the path to a single DZI tile, rendering
+        it from the cached image if it doesn't yet exist.
+        """
+        creator = self.get_dzi_creator()
+        tilepath = creator.get_tile_path(dzipath, level, column, row)
+        if os.path.exists(tilepath):
+            return tilepath
+        image = self.get_dzi_tile_source(os.path.splitext(dzipath)[0])
+        if image is None:
+            return
+        tilepath = creator.create_tile(image, dzipath, level, column, row)
+        self.grow_entry(os.path.dirname(dzipath), os.path.getsize(tilepath))
+        return tilepath
+
+    def get_dzi_tile_source(self, base):
+        """
+        Get the full-size image tiles are cut from.  Decoded
+        images are kept in a small LRU, since tiles are asked
+        for in bursts; memory-mapped arrays are just mapped
+        again.
+        """
+        found, data = _tile_sources.get(base)
+        if not found:
+            for ext in (".npy", ".npy.gz", ".png"):
+                srcpath = "%s%s" % (base, ext)
+                if self.has_file(srcpath):
+                    break
+            else:
+                return
+            data = self.read_file(srcpath,
+                    lambda fh: numpy.asarray(PIL.Image.open(fh)))
+            if not isinstance(data, numpy.memmap):
+                _tile_sources.set(base, data)
+        return PIL.Image.fromarray(data)
 
     def clear_cache(self, n):
+        path = self.get_path(n)
         super(DziFileCacher, self).clear_cache(n)
-        if self.has_cache(n):
-            path = self.get_path(n)
-            fpath = os.path.join(path, n.get_file_name())
-            if fpath.endswith(".png"):
-                dzipath = "%s.dzi" % os.path.splitext(filepath)[0]
-                os.unlink(fpath)
-                try:
-                    os.rmdir(path)
-                except OSError, (errno, strerr):
-                    if errno != 39:
-                        raise
+        # the DZI descriptor and its _files pyramid live
+        # alongside the node data, which other keys might
+        # still be using if it's shared
+        if not self.shared:
+            shutil.rmtree(path, True)
 
     def clear(self):
         super(DziFileCacher, self).clear()
@@ -200,6 +1026,187 @@ class DziFileCacher(PersistantFileCacher):
             shutil.rmtree(os.path.join(self._path, self._key))
 
 
+class MemoryStore(object):
+    """
+    Byte-bounded LRU store of decoded node data, shared by
+    all cachers in a process.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def data_size(cls, data):
+        """
+        Rough size, in bytes, of a piece of node data.
+        """
+        if isinstance(data, numpy.ndarray):
+            return data.nbytes
+        if isinstance(data, basestring):
+            return len(data)
+        return len(repr(data))
+
+    def get(self, key):
+        """
+        Get a (found, data) tuple and mark the data as recently used.
+        """
+        with self._lock:
+            if not key in self._data:
+                return False, None
+            data, size = self._data.pop(key)
+            self._data[key] = (data, size)
+        return True, data
+
+    def set(self, key, data):
+        size = self.data_size(data)
+        with self._lock:
+            if key in self._data:
+                self._size -= self._data.pop(key)[1]
+            if size > self.maxsize:
+                return
+            while self._data and self._size + size > self.maxsize:
+                self._size -= self._data.popitem(last=False)[1][1]
+            self._data[key] = (data, size)
+            self._size += size
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._data:
+                self._size -= self._data.pop(key)[1]
+
+    def discard_prefix(self, prefix):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                self._size -= self._data.pop(key)[1]
+
+    def size(self):
+        return self._size
+
+
+_memory_store = None
+_tile_sources = MemoryStore(TILE_SOURCE_CACHE)
+
+def get_memory_store(maxsize):
+    """
+    Get the process-wide memory store, creating it if necessary.
+    """
+    global _memory_store
+    if _memory_store is None:
+        _memory_store = MemoryStore(maxsize)
+    _memory_store.maxsize = maxsize
+    return _memory_store
+
+
+class TieredCacher(BaseCacher):
+    """
+    Keep decoded node data in an in-process LRU in front of
+    a persistent cacher, so re-evaluating an unchanged node
+    in the same worker skips reading and decoding its file.
+    Memory-mapped arrays aren't kept, since they're cheap to
+    map again and aren't really in memory.
+    """
+    cachetype = "tiered"
+
+    def __init__(self, cacher, maxsize, **kwargs):
+        kwargs.setdefault("logger", cacher.logger)
+        super(TieredCacher, self).__init__(path=cacher._path,
+                key=cacher._key, **kwargs)
+        self._cacher = cacher
+        self._store = get_memory_store(maxsize)
+
+    @property
+    def shared(self):
+        return getattr(self._cacher, "shared", False)
+
+    @property
+    def digests(self):
+        return self._cacher.digests
+
+    def get_digest(self, n):
+        return self._cacher.get_digest(n)
+
+    def get_path(self, n):
+        return self._cacher.get_path(n)
+
+    def has_cache(self, n):
+        return self._cacher.has_cache(n)
+
+    def is_cached(self, n):
+        return self._cacher.is_cached(n)
+
+    def release_locks(self):
+        self._cacher.release_locks()
+
+    def get_cache(self, n):
+        path = self.get_path(n)
+        found, data = self._store.get(path)
+        if found:
+            # the persistent copy may have been cleared or
+            # evicted by another process
+            if not self._cacher.is_cached(n):
+                self._store.discard(path)
+                return
+            self.logger.debug("Reading memory cache: %s", path)
+            if hasattr(self._cacher, "touch_entry"):
+                self._cacher.touch_entry(path)
+            return self.copy_data(data)
+        data = self._cacher.get_cache(n)
+        self.keep(path, data)
+        return data
+
+    def set_cache(self, n, data):
+        self._cacher.set_cache(n, data)
+        self.keep(self.get_path(n), data)
+
+    def keep(self, path, data):
+        """
+        Keep a copy of node data in memory, if it's worth it.
+        """
+        if data is None or isinstance(data, numpy.memmap):
+            self._store.discard(path)
+            return
+        self._store.set(path, self.copy_data(data))
+
+    def ensure_dzi(self, n):
+        return self._cacher.ensure_dzi(n)
+
+    def get_dzi_path(self, n):
+        return self._cacher.get_dzi_path(n)
+
+    def get_dzi_tile(self, dzipath, level, column, row):
+        return self._cacher.get_dzi_tile(dzipath, level, column, row)
+
+    def clear_cache(self, n):
+        self._store.discard(self.get_path(n))
+        self._cacher.clear_cache(n)
+
+    def clear(self):
+        self._store.discard_prefix(os.path.join(self._path, self._key))
+        self._cacher.clear()
+
+    def size(self):
+        return self._cacher.size()
+
+    def prune(self, maxsize, allkeys=False):
+        return self._cacher.prune(maxsize, allkeys=allkeys)
+
+    @classmethod
+    def copy_data(cls, data):
+        """
+        Arrays are kept (and handed out) read-only so they can be
+        shared without copying, as with arrays read from a PNG.
+        Other data is copied so callers can't change the cache.
+        """
+        if isinstance(data, numpy.ndarray):
+            if data.flags.writeable:
+                data = data.copy()
+                data.flags.writeable = False
+            return data
+        return copy.deepcopy(data)
+
+
 class TestMockCacher(BaseCacher):
     """
     Mock cacher that doesn't do anything.
@@ -21,6 +21,7 @@ class AbbyyRecognizer(base.CommandLineRecognizerNode):
     Recognize an image using Abbyy Finereader.
     """
     binary = "abbyyocr"
+    batchable = True
     stage = stages.RECOGNIZE
     intypes = [numpy.ndarray]
     parameters = [
@@ -43,6 +44,21 @@ class AbbyyRecognizer(base.CommandLineRecognizerNode):
         args.extend(["-if", image, "-f", "XML", "-of", outfile])
         return args
 
+    def get_batch_command(self, outfile, image):
+        """
+        Abbyy command line for a strip of lines.
+        """
+        args = self.get_command(outfile, image)
+        if not "--singleColumnMode" in args:
+            args.insert(1, "--singleColumnMode")
+        return args
+
+    def prepare_image(self, imagepath):
+        self.set_image_dpi(imagepath)
+
+    def read_hocr(self, outfile):
+        return utils.hocr_from_abbyy(outfile)
+
     def set_image_dpi(self, image):
         """
         Hack to set 300 PPI on all images.  This should hopefully
@@ -63,7 +79,7 @@ class AbbyyRecognizer(base.CommandLineRecognizerNode):
             with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as btmp:
                 btmp.close()
                 self.write_binary(btmp.name, binary)
-                self.set_image_dpi(btmp.name)
+                self.prepare_image(btmp.name)
                 args = self.get_command(tmp.name, btmp.name)
                 self.logger.debug("Running: '%s'", " ".join(args))
                 proc = sp.Popen(args, stderr=sp.PIPE)
@@ -72,7 +88,7 @@ class AbbyyRecognizer(base.CommandLineRecognizerNode):
                     return "!!! %s CONVERSION ERROR %d: %s !!!" % (
                             os.path.basename(self.binary).upper(),
                             proc.returncode, err)
-                hocr = utils.hocr_from_abbyy(tmp.name)
+                hocr = self.read_hocr(tmp.name)
             os.unlink(tmp.name)
             os.unlink(btmp.name)
         utils.set_progress(self.logger, self.progress_func, 100, 100)
@@ -7,8 +7,13 @@ from __future__ import absolute_import
 import os
 import codecs
 import json
+import tempfile
+import itertools
+import threading
 import subprocess as sp
+from multiprocessing.pool import ThreadPool
 
+from django.conf import settings
 from nodetree import node, writable_node, exceptions
 import ocrolib
 from PIL import Image
@@ -19,6 +24,23 @@ from .. import stages, types, utils
 class ExternalToolError(StandardError):
     pass
 
+
+# line recognizer threads, by pool size, kept for the life of
+# the process so the converters each thread loads stay loaded
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+
+def get_thread_pool(size):
+    """
+    Get the process's pool of `size` recognizer threads.
+    """
+    with _thread_pools_lock:
+        if size not in _thread_pools:
+            _thread_pools[size] = ThreadPool(size)
+        return _thread_pools[size]
+
+
 class TextWriterMixin(writable_node.WritableNodeMixin):
     """
     Write text data.
@@ -86,12 +108,18 @@ class GrayPngWriterMixin(BinaryPngWriterMixin):
 class LineRecognizerNode(node.Node, TextWriterMixin):
     """
     Node which takes a binary and a segmentation and
-    recognises text one line at a time.
+    recognises text one line at a time.  If `workers` (or
+    the NODETREE_RECOGNIZER_WORKERS setting) is more than
+    one, lines are recognised that many at a time on a pool
+    of threads, so get_transcript must be thread-safe.  The
+    threads are kept between pages, along with anything
+    get_transcript keeps per thread.
     """
     stage = stages.RECOGNIZE
     intypes = [ocrolib.numpy.ndarray, dict]
     outtype = types.HocrString
     abstract = True
+    workers = None
 
     def init_converter(self):
         raise NotImplementedError
@@ -105,6 +133,35 @@ class LineRecognizerNode(node.Node, TextWriterMixin):
     def prepare(self):
         pass
 
+    def use_batch(self):
+        """
+        Whether to recognise all the lines in one go
+        with get_batch_transcripts.
+        """
+        return False
+
+    def get_batch_transcripts(self, lines):
+        raise NotImplementedError
+
+    def get_workers(self):
+        """
+        Number of lines to recognise at once.
+        """
+        if self.workers is not None:
+            return max(1, self.workers)
+        return max(1, getattr(settings, "NODETREE_RECOGNIZER_WORKERS", 1))
+
+    def extract_line(self, iulibbin, pageheight, coords):
+        """
+        Cut a line out of the (iulib) page binary.
+        """
+        iulibcoords = (
+                coords[0], pageheight - coords[3], coords[2],
+                pageheight - coords[1])
+        lineimage = ocrolib.iulib.bytearray()
+        ocrolib.iulib.extract_subimage(lineimage, iulibbin, *iulibcoords)
+        return ocrolib.narray2numpy(lineimage)
+
     def process(self, binary, boxes):
         """
         Recognize page text.
@@ -116,19 +173,28 @@ class LineRecognizerNode(node.Node, TextWriterMixin):
         pageheight, pagewidth = binary.shape
         iulibbin = ocrolib.numpy2narray(binary)
         out = dict(bbox=[0, 0, pagewidth, pageheight], lines=[])
-        numlines = len(boxes.get("lines", []))
-        for i in range(numlines):
+        lines = boxes.get("lines", [])
+        numlines = len(lines)
+        def recognize(coords):
+            return self.get_transcript(
+                    self.extract_line(iulibbin, pageheight, coords))
+        workers = self.get_workers()
+        # results come back in line order, so progress
+        # is still reported from this thread
+        if self.use_batch():
+            texts = self.get_batch_transcripts([self.extract_line(
+                    iulibbin, pageheight, coords) for coords in lines])
+        elif workers < 2 or numlines < 2:
+            texts = itertools.imap(recognize, lines)
+        else:
+            texts = get_thread_pool(workers).imap(recognize, lines)
+        for i, text in enumerate(texts):
             set_progress(self.logger, self.progress_func, i, numlines)
-            coords = boxes.get("lines")[i]
-            iulibcoords = (
-                    coords[0], pageheight - coords[3], coords[2],
-                    pageheight - coords[1])
-            lineimage = ocrolib.iulib.bytearray()
-            ocrolib.iulib.extract_subimage(lineimage, iulibbin, *iulibcoords)
+            coords = lines[i]
             out["lines"].append(dict(
                     index=i+1,
                     bbox=[coords[0], coords[1], coords[2], coords[3]],
-                    text=self.get_transcript(ocrolib.narray2numpy(lineimage)),
+                    text=text,
             ))
         set_progress(self.logger, self.progress_func, numlines, numlines)
         self.cleanup()
@@ -201,10 +267,14 @@ def set_progress(logger, progress_func, step, end, granularity=5):
 
 class CommandLineRecognizerNode(LineRecognizerNode):
     """
-    Generic recogniser based on a command line tool.
+    Generic recogniser based on a command line tool.  Tools
+    that can output HOCR can implement get_batch_command and
+    set batchable, in which case (if NODETREE_RECOGNIZER_BATCH is set) all the
+    lines on a page are recognised with a single invocation.
     """
     binary = "unimplemented"
     abstract = True
+    batchable = False
 
     def validate(self):
         super(CommandLineRecognizerNode, self).validate()
@@ -215,6 +285,61 @@ class CommandLineRecognizerNode(LineRecognizerNode):
         """
         raise NotImplementedError
 
+    def get_batch_command(self, outfile, image):
+        """
+        Get the command line for converting an image of several
+        lines to HOCR, or None if the tool can't do it.
+        """
+        return None
+
+    def prepare_image(self, imagepath):
+        """
+        Do anything the tool needs to an image file before
+        it's converted.
+        """
+        pass
+
+    def read_hocr(self, outfile):
+        """
+        Read the HOCR output written by the tool.
+        """
+        with codecs.open(outfile, "r", "utf8") as tread:
+            return tread.read()
+
+    def use_batch(self):
+        return self.batchable and \
+                getattr(settings, "NODETREE_RECOGNIZER_BATCH", False)
+
+    @utils.check_aborted
+    def get_batch_transcripts(self, lines):
+        """
+        Recognise several lines by stacking them into a single
+        temporary image and running the tool on that once.
+        """
+        strip, offsets = utils.make_line_strip(lines)
+        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".html")
+        tmp.close()
+        btmp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
+        btmp.close()
+        try:
+            self.write_binary(btmp.name, strip)
+            self.prepare_image(btmp.name)
+            args = self.get_batch_command(tmp.name, btmp.name)
+            self.logger.debug("Running: '%s'", " ".join(args))
+            proc = sp.Popen(args, stderr=sp.PIPE)
+            err = proc.stderr.read()
+            if proc.wait() != 0:
+                error = u"!!! %s CONVERSION ERROR %d: %s !!!" % (
+                        os.path.basename(self.binary).upper(),
+                        proc.returncode, err)
+                return [error for line in lines]
+            hocr = self.read_hocr(tmp.name)
+        finally:
+            for path in (tmp.name, btmp.name):
+                if os.path.exists(path):
+                    os.unlink(path)
+        return utils.split_strip_hocr(hocr, offsets)
+
     @classmethod
     def write_binary(cls, path, data):
         """
@@ -5,7 +5,6 @@ Cuneiform Recogniser
 from __future__ import absolute_import
 
 import os
-import codecs
 import shutil
 import tempfile
 import subprocess as sp
@@ -23,6 +22,7 @@ class CuneiformRecognizer(base.CommandLineRecognizerNode):
     Recognize an image using Cuneiform.
     """
     binary = "cuneiform"
+    batchable = True
     stage = stages.RECOGNIZE
     intypes = [numpy.ndarray]
     parameters = [
@@ -38,6 +38,15 @@ class CuneiformRecognizer(base.CommandLineRecognizerNode):
             args.extend(["--singlecolumn"])
         return args + [image]
 
+    def get_batch_command(self, outfile, image):
+        """
+        Cuneiform command line for a strip of lines.
+        """
+        args = self.get_command(outfile, image)
+        if not "--singlecolumn" in args:
+            args.insert(-1, "--singlecolumn")
+        return args
+
     def process(self, binary):
         """
         Convert a full page.
@@ -57,8 +66,7 @@ class CuneiformRecognizer(base.CommandLineRecognizerNode):
                     return u"!!! %s CONVERSION ERROR %d: %s !!!" % (
                             os.path.basename(self.binary).upper(),
                             proc.returncode, err)
-                with codecs.open(tmp.name, "r", "utf8") as tread:
-                    hocr = tread.read()
+                hocr = self.read_hocr(tmp.name)
             os.unlink(tmp.name)
             os.unlink(btmp.name)
         utils.set_progress(self.logger, self.progress_func, 100, 100)
@@ -3,18 +3,20 @@ Nodes for interoperating with Fedora Commons.
 """
 
 import os
+import socket
+import tempfile
+import httplib
 import ocrolib
 from nodetree import node, exceptions
-from cStringIO import StringIO
 
 from . import base, util as utilnodes
 from .. import stages, utils
 
-from eulfedora.server import Repository
-from eulfedora.models import DigitalObject, FileDatastream
 from eulfedora.util import RequestFailed
 from PIL import Image
 
+from ocradmin.storage.fedora import get_rest_api, read_datastream
+
 
 class FedoraIOMixin(object):
     """Common Mixin for objects that require access to a
@@ -37,17 +39,11 @@ class FedoraIOMixin(object):
             raise exceptions.ValidationError(
                     "Missing parameter(s): %s" % ", ".join(missing), self)
 
-
-
-def get_fedora_proxy_class(dsid):
-    fcm = "info:fedora/genrepo:File-1.0"
-    return type("FedoraProxyObject", (DigitalObject,), dict(
-        FILE_CONTENT_MODEL=fcm,
-        CONTENT_MODELS=[fcm],
-        DATASTREAM=FileDatastream(dsid, "Binary datastream", defaults={
-            "versionable": True,
-        })
-    ))
+    def get_api(self):
+        """REST client for the repository, on pooled
+        connections shared with the storage backend."""
+        return get_rest_api(self._params.get("url"),
+                self._params.get("username"), self._params.get("password"))
 
 
 class FedoraImageIn(FedoraIOMixin, base.ImageGeneratorNode,
@@ -57,20 +53,22 @@ class FedoraImageIn(FedoraIOMixin, base.ImageGeneratorNode,
     outtype = ocrolib.numpy.ndarray
 
     def process(self):
-        repo = Repository(self._params.get("url"), self._params.get("username"),
-                self._params.get("password"))
-        # Fixme... this is not the correct way of downloading a datastream!
         try:
-            iodata = StringIO(repo.api.getDatastreamDissemination(
-                    self._params.get("pid"), self._params.get("dsid"))[0])
-            pil = Image.open(iodata)
-        except IOError:
+            handle = read_datastream(self.get_api(), self._params.get("pid"),
+                    self._params.get("dsid"))
+        except (RequestFailed, socket.error, httplib.HTTPException), err:
             raise exceptions.NodeError(
-                    "Error reading datastream contents as an image.", self)
-        except RequestFailed:
+                    "Error communicating with Fedora Repository: %s" % err, self)
+        if handle is None:
             raise exceptions.NodeError(
                     "Error communicating with Fedora Repository: 404", self)
-        return ocrolib.numpy.asarray(pil)
+        try:
+            return ocrolib.numpy.asarray(Image.open(handle))
+        except IOError:
+            raise exceptions.NodeError(
+                    "Error reading datastream contents as an image.", self)
+        finally:
+            handle.close()
 
 
 class FedoraImageOut(FedoraIOMixin, utilnodes.FileOut):
@@ -104,22 +102,35 @@ class FedoraImageOut(FedoraIOMixin, utilnodes.FileOut):
         #if not os.environ.get("NODETREE_WRITE_FILEOUT"):
         #    return input
 
-        repo = Repository(self._params.get("url"), self._params.get("username"),
-                self._params.get("password"))
         try:
-            buf = StringIO()
+            buf = tempfile.TemporaryFile()
             Image.fromarray(input).save(buf, self._params.get("format").upper())
         except IOError:
             raise exceptions.NodeError(
                     "Error obtaining image buffer in format: %s" % 
                         self._params.get("format").upper(), self)
 
-        pclass = get_fedora_proxy_class(self._params.get("dsid"))
-        obj = repo.get_object(self._params.get("pid"), type=pclass)
-        obj.DATASTREAM.content = buf
-        obj.DATASTREAM.label = "Test Ingest Datastream 1"
-        obj.DATASTREAM.mimetype = "image/%s" % self._params.get("format")
-        obj.save()
+        api = self.get_api()
+        pid, dsid = self._params.get("pid"), self._params.get("dsid")
+        params = dict(content=buf, contentLength=buf.tell(),
+                dsLabel="Test Ingest Datastream 1",
+                mimeType="image/%s" % self._params.get("format"))
+        buf.seek(0)
+        try:
+            if api.getDatastream(pid, dsid).getStatus() == "200":
+                response = api.modifyDatastream(pid, dsid, **params)
+            else:
+                response = api.addDatastream(pid, dsid, controlGroup="M",
+                        versionable="true", **params)
+        except (socket.error, httplib.HTTPException), err:
+            raise exceptions.NodeError(
+                    "Error communicating with Fedora Repository: %s" % err, self)
+        finally:
+            buf.close()
+        if response.getStatus() not in ("200", "201"):
+            raise exceptions.NodeError(
+                    "Error communicating with Fedora Repository: %s" % (
+                        response.getStatus()), self)
         return input
 
 
@@ -7,6 +7,7 @@ from __future__ import absolute_import
 import os
 import sys
 import json
+import threading
 
 from nodetree import node, writable_node, exceptions
 from nodetree import utils as nodeutils
@@ -293,19 +294,34 @@ class OcropusRecognizer(base.LineRecognizerNode):
             raise exceptions.ValidationError("no language model given: %s" % self._params, self)
 
 
+    def prepare(self):
+        """
+        Converters aren't thread-safe, so each thread
+        recognising lines loads its own, once.  Look up the
+        model files up front so the threads don't touch the
+        DB, and again only if the model params change.
+        """
+        models = (self._params["character_model"],
+                self._params["language_model"])
+        if getattr(self, "_models", None) == models:
+            return
+        self._converters = threading.local()
+        self._cmodpath = utils.lookup_model_file(models[0])
+        self._lmodpath = utils.lookup_model_file(models[1])
+        self._models = models
+
     def init_converter(self):
         """
         Load the line-recogniser and the lmodel FST objects.
         """
         try:
-            self._linerec = ocrolib.RecognizeLine()
-            cmodpath = utils.lookup_model_file(self._params["character_model"])
-            self.logger.debug("Loading char mod file: %s" % cmodpath)
-            self._linerec.load_native(cmodpath)
-            self._lmodel = ocrolib.OcroFST()
-            lmodpath = utils.lookup_model_file(self._params["language_model"])
-            self.logger.debug("Loading lang mod file: %s" % lmodpath)
-            self._lmodel.load(lmodpath)
+            converters = self._converters
+            converters.linerec = ocrolib.RecognizeLine()
+            self.logger.debug("Loading char mod file: %s" % self._cmodpath)
+            converters.linerec.load_native(self._cmodpath)
+            converters.lmodel = ocrolib.OcroFST()
+            self.logger.debug("Loading lang mod file: %s" % self._lmodpath)
+            converters.lmodel.load(self._lmodpath)
         except (StandardError, RuntimeError):
             raise
 
@@ -315,11 +331,13 @@ class OcropusRecognizer(base.LineRecognizerNode):
         Run line-recognition on an ocrolib.iulib.bytearray images of a
         single line.
         """
-        if not hasattr(self, "_lmodel"):
+        if not hasattr(self, "_converters"):
+            self.prepare()
+        if not hasattr(self._converters, "lmodel"):
             self.init_converter()
-        fst = self._linerec.recognizeLine(line)
+        fst = self._converters.linerec.recognizeLine(line)
         # NOTE: This returns the cost - not currently used
-        out, _ = ocrolib.beam_search_simple(fst, self._lmodel, 1000)
+        out, _ = ocrolib.beam_search_simple(fst, self._converters.lmodel, 1000)
         return out
 
 class Manager(object):
@@ -79,34 +79,27 @@ class DocWriter(DocMixin, utilnodes.FileOut):
         doc = storage.get(self._params.get("pid"))
         attr = self._params.get("attribute")
 
-        # FIXME: More memory processing... want to somehow make this
-        # more efficient for large files
-        # FIXME: This also seems to fail on a semi-random basis when
-        # using a Fedora backend.
-        #try:
-        #    memstream = StringIO()
-        #    self.input(0).writer(memstream, input)
-        #    memstream.flush()
-        #    memstream.seek(0)
-        #    storage.set_document_attr_content(doc, attr, memstream)        
-        #    mimetype = "image/png" if attr == "binary" else "text/html"
-        #    storage.set_document_attr_mimetype(doc, attr, mimetype)        
-        #    storage.set_document_attr_label(doc, attr, self.label)        
-        #    doc.save()
-        #    return input
-        #finally:
-        #    memstream.close()
-        with tempfile.NamedTemporaryFile(delete=False, mode="w") as temp:
+        # write to an anonymous temp file, which the storage
+        # can stream from without holding it all in memory
+        mimetype = "image/png" if attr == "binary" else "text/html"
+        with tempfile.TemporaryFile() as temp:
             self.input(0).writer(temp, input)
-            temp.close()
-            mimetype = "image/png" if attr == "binary" else "text/html"
-            with open(temp.name, "rb") as rtemp:
-                storage.set_document_attr_content(doc, attr, rtemp)
-                storage.set_document_attr_mimetype(doc, attr, mimetype)        
-                storage.set_document_attr_label(doc, attr, self.label)        
-                doc.save()
-                os.unlink(temp.name)
-                return input
+            temp.flush()
+            temp.seek(0)
+            storage.write_document_attr(doc, attr, temp, mimetype,
+                    self.get_attr_label(doc, attr))
+        return input
+
+    def get_attr_label(self, doc, attr):
+        """
+        Label for the written attribute, named after the
+        document's image, i.e. page.bin.png or page.html.
+        """
+        if not doc.image_label:
+            return self.label
+        if attr == "binary":
+            return ".bin".join(os.path.splitext(doc.image_label))
+        return "%s.html" % os.path.splitext(doc.image_label)[0]
 
 
 class DocImageFileIn(DocMixin, base.GrayPngWriterMixin):
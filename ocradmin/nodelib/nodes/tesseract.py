@@ -5,15 +5,15 @@ Tesseract Recogniser
 from __future__ import absolute_import
 
 import os
-import shutil
 import codecs
 import tempfile
 import subprocess as sp
 
+from django.conf import settings
 from nodetree import node, exceptions, utils as nodeutils
 
 from . import base
-from .. import stages, utils, exceptions
+from .. import stages, utils, exceptions, tesspool
 
 from ocradmin.ocrmodels.models import OcrModel
 
@@ -26,6 +26,9 @@ class TesseractRecognizer(base.CommandLineRecognizerNode):
     """
     stage = stages.RECOGNIZE
     binary = "tesseract"
+    batchable = True
+    # recognise lines with pooled API handles, if available
+    use_api_pool = True
 
     @nodeutils.ClassProperty
     @classmethod
@@ -49,23 +52,65 @@ class TesseractRecognizer(base.CommandLineRecognizerNode):
 
     def prepare(self):
         """
-        Extract the lmodel to a temporary directory.  This is
-        cleaned up in the destructor.
+        Find the (cached) unpacked lmodel, and a pool of
+        Tesseract API handles if libtesseract is available.
+        The lmodel is found again if the param has changed
+        since the last run.
         """
-        if not hasattr(self, "_tessdata") is None:
-            modpath = utils.lookup_model_file(self._params["language_model"])
+        modpath = utils.lookup_model_file(self._params["language_model"])
+        if modpath != getattr(self, "_modpath", None):
             self.unpack_tessdata(modpath)
+            self._modpath = modpath
         self._tesseract = utils.get_binary("tesseract")
-        self.logger.debug("Using Tesseract: %s" % self._tesseract)
+        self._pool = None
+        if self.use_api_pool:
+            self._pool = tesspool.get_pool(self._tessdata, self._lang,
+                    max(getattr(settings, "TESSERACT_POOL_SIZE", 1),
+                        self.get_workers()))
+        if self._pool is None:
+            self.logger.debug("Using Tesseract: %s" % self._tesseract)
+        else:
+            self.logger.debug("Using Tesseract API pool: %s" % self._lang)
+
+    def use_batch(self):
+        return super(TesseractRecognizer, self).use_batch() \
+                and getattr(self, "_pool", None) is None
+
+    def write_hocr_config(self):
+        """
+        Write a temp config file specifying the output format.
+        """
+        if getattr(self, "_configtmp", None) is None:
+            configtmp = tempfile.NamedTemporaryFile(delete=False)
+            configtmp.write("tessedit_create_hocr\t\t1")
+            configtmp.close()
+            self._configtmp = configtmp.name
+        return self._configtmp
+
+    def get_batch_command(self, outfile, image):
+        """
+        Tesseract command line for a strip of lines, treated
+        as a single uniform block of text.
+        """
+        args = [self._tesseract, image, os.path.splitext(outfile)[0],
+                "-psm", "6"]
+        if self._lang is not None:
+            args.extend(["-l", self._lang])
+        args.append(self.write_hocr_config())
+        return args
 
     @utils.check_aborted
     def get_transcript(self, line):
         """
-        Recognise each individual line by writing it as a temporary
-        PNG, converting it to Tiff, and calling Tesseract on the
-        image.  Unfortunately I can't get the current stable
-        Tesseract 2.04 to support anything except TIFFs.
+        Recognise each individual line.  If we've got a pool of
+        Tesseract API handles the image is passed to one of them
+        directly.  Otherwise, write it as a temporary PNG, convert
+        it to Tiff, and call Tesseract on the image.  Unfortunately
+        I can't get the current stable Tesseract 2.04 to support
+        anything except TIFFs.
         """
+        if getattr(self, "_pool", None) is not None:
+            return self._pool.recognize(line)
         with tempfile.NamedTemporaryFile(suffix=".png") as tmp:
             tmp.close()
             self.write_binary(tmp.name, line)
@@ -77,21 +122,12 @@ class TesseractRecognizer(base.CommandLineRecognizerNode):
 
     def unpack_tessdata(self, lmodelpath):
         """
-        Unpack the tar-gzipped Tesseract language files into
-        a temporary directory and set TESSDATA_PREFIX environ
-        var to point at it.
-        """
-        # might as well make this even less efficient!
-        self.logger.debug("Unpacking tessdata: %s" % lmodelpath)
-        import tarfile
-        self._tessdata = tempfile.mkdtemp() + "/"
-        datapath = os.path.join(self._tessdata, "tessdata")
-        os.mkdir(datapath)
-        # let this throw an exception if it fails.
-        tgz = tarfile.open(lmodelpath, "r:*")
-        self._lang = os.path.splitext(tgz.getnames()[0])[0]
-        tgz.extractall(path=datapath)
-        tgz.close()
+        Unpack the tar-gzipped Tesseract language files, if
+        they haven't been already, and set TESSDATA_PREFIX environ
+        var to point at them.
+        """
+        self.logger.debug("Using tessdata: %s" % lmodelpath)
+        self._tessdata, self._lang = tesspool.get_tessdata(lmodelpath)
 
         # set environ var where tesseract picks up the tessdata dir
         # this DOESN'T include the "tessdata" part
@@ -131,16 +167,13 @@ class TesseractRecognizer(base.CommandLineRecognizerNode):
 
     def cleanup(self):
         """
-        Cleanup temporarily-extracted lmodel directory.
+        Remove the temp config file, if any.  The unpacked
+        lmodel and API handles are kept for the next run.
         """
-        if hasattr(self, "_tessdata") and os.path.exists(self._tessdata):
-            try:
-                self.logger.debug(
-                    "Cleaning up temp tessdata folder: %s" % self._tessdata)
-                shutil.rmtree(self._tessdata)
-            except OSError, (errno, strerr):
-                self.logger.error(
-                    "RmTree raised error: %s, %s" % (errno, strerr))
+        if getattr(self, "_configtmp", None) is not None:
+            if os.path.exists(self._configtmp):
+                os.unlink(self._configtmp)
+            self._configtmp = None
 
 
 class TesseractPageSeg(TesseractRecognizer):
@@ -148,6 +181,8 @@ class TesseractPageSeg(TesseractRecognizer):
     Recognize an image using Tesseract, including segmentation.
     """
     intypes = [numpy.ndarray]
+    # whole pages are run through the command line tool
+    use_api_pool = False
 
     def __init__(self, *args, **kwargs):
         super(TesseractPageSeg, self).__init__(*args, **kwargs)
@@ -163,15 +198,7 @@ class TesseractPageSeg(TesseractRecognizer):
 
     def prepare(self):
         super(TesseractPageSeg, self).prepare()
-        # write a temp config file specifying the output format
-        configtmp = tempfile.NamedTemporaryFile(delete=False)
-        configtmp.write("tessedit_create_hocr\t\t1")
-        configtmp.close()
-        self._configtmp = configtmp.name
-
-    def cleanup(self):
-        super(TesseractPageSeg, self).prepare()
-        os.unlink(self._configtmp)
+        self.write_hocr_config()
 
     def process(self, binary):
         """
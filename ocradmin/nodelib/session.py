@@ -0,0 +1,115 @@
+"""
+Long-lived script graphs for interactive evaluation.
+"""
+
+import copy
+from ordereddict import OrderedDict
+
+from nodetree import script
+
+
+class ScriptSession(object):
+    """
+    A script graph kept between interactive runs.  When a
+    new version of the script only differs in node params,
+    those are changed in place, so only the changed nodes
+    and those downstream of them get new cache digests;
+    everything upstream is served from the cache without
+    being re-hashed.  Any other change (nodes added, removed,
+    retyped, rewired or ignored) rebuilds the graph.  Each run
+    binds its own cacher and logger to the graph.
+    """
+    def __init__(self, nodelist, cacher, logger=None):
+        self.cacher = cacher
+        self.logger = logger
+        self.build(nodelist)
+
+    def build(self, nodelist):
+        self.nodelist = copy.deepcopy(nodelist)
+        self.cacher.digests.clear()
+        self.tree = script.Script(nodelist, nodekwargs=dict(
+                logger=self.logger, cacher=self.cacher))
+
+    def bind(self, cacher, logger=None):
+        """
+        Hand the graph's nodes the cacher and logger of
+        the current run.
+        """
+        self.cacher = cacher
+        self.logger = logger
+        for label in self.nodelist:
+            if label.startswith("__"):
+                continue
+            n = self.tree.get_node(label)
+            n._cacher = cacher
+            if logger is not None:
+                n.logger = logger
+
+    def _shape(self, nodelist):
+        return dict([(label, (n.get("type"), n.get("ignored", False),
+                sorted([k for k, v in n.get("params", [])]),
+                n.get("inputs", []))) \
+                for label, n in nodelist.iteritems() \
+                if not label.startswith("__")])
+
+    def update(self, nodelist):
+        """
+        Bring the graph up to date with a new version of the
+        script, returning the labels of the nodes that changed,
+        or None if it had to be rebuilt.
+        """
+        if self._shape(nodelist) != self._shape(self.nodelist):
+            self.build(nodelist)
+            return
+        digests = self.cacher.digests
+        changed = []
+        for label, new in nodelist.iteritems():
+            if label.startswith("__"):
+                continue
+            old = self.nodelist[label]
+            n = self.tree.get_node(label)
+            if new.get("params", []) != old.get("params", []):
+                for name, value in new.get("params", []):
+                    digests.set_param(n, name, value)
+                changed.append(label)
+        self.nodelist = copy.deepcopy(nodelist)
+        return changed
+
+    def get_node(self, label):
+        return self.tree.get_node(label)
+
+    def get_terminals(self):
+        return self.tree.get_terminals()
+
+
+class SessionStore(object):
+    """
+    Most recently used script sessions, by name.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._sessions = OrderedDict()
+
+    def get(self, name, nodelist, cacherfunc, logger=None):
+        """
+        Get the named session updated to the given script,
+        starting a new one if there isn't one.  Every call gets
+        a new cacher from `cacherfunc`, which is passed the
+        session's node digests to carry on with (or None.)
+        """
+        session = self._sessions.pop(name, None)
+        if session is None:
+            session = ScriptSession(nodelist, cacherfunc(None), logger)
+        else:
+            session.bind(cacherfunc(session.cacher.digests), logger)
+            changed = session.update(nodelist)
+            if logger is not None:
+                logger.debug("Updated session %s: %s", name,
+                        "rebuilt" if changed is None else changed)
+        self._sessions[name] = session
+        while len(self._sessions) > self.maxsize:
+            self._sessions.popitem(last=False)
+        return session
+
+    def discard(self, name):
+        self._sessions.pop(name, None)
@@ -0,0 +1,224 @@
+"""
+Long-lived Tesseract API handles, shared between recognizer
+nodes in a worker process.  Saves spawning Tesseract (and
+re-reading its language data) for every line.
+"""
+
+from __future__ import absolute_import
+
+import os
+import shutil
+import ctypes
+import ctypes.util
+import hashlib
+import tarfile
+import tempfile
+import threading
+import Queue
+
+import numpy
+
+from . import exceptions
+
+
+# tesseract::PageSegMode
+PSM_SINGLE_LINE = 7
+
+_libtess = None
+_pools = {}
+_poolslock = threading.Lock()
+_tessdatalock = threading.Lock()
+
+
+def get_library():
+    """
+    Load libtesseract's C API, or return None if
+    it isn't available.
+    """
+    global _libtess
+    if _libtess is None:
+        libname = ctypes.util.find_library("tesseract")
+        if libname is None:
+            _libtess = False
+            return
+        try:
+            lib = ctypes.CDLL(libname)
+            lib.TessBaseAPICreate.restype = ctypes.c_void_p
+            lib.TessBaseAPIInit3.argtypes = [ctypes.c_void_p,
+                    ctypes.c_char_p, ctypes.c_char_p]
+            lib.TessBaseAPISetPageSegMode.argtypes = [ctypes.c_void_p,
+                    ctypes.c_int]
+            lib.TessBaseAPISetImage.argtypes = [ctypes.c_void_p,
+                    ctypes.c_char_p, ctypes.c_int, ctypes.c_int,
+                    ctypes.c_int, ctypes.c_int]
+            lib.TessBaseAPIGetUTF8Text.argtypes = [ctypes.c_void_p]
+            lib.TessBaseAPIGetUTF8Text.restype = ctypes.c_void_p
+            lib.TessDeleteText.argtypes = [ctypes.c_void_p]
+            lib.TessBaseAPIEnd.argtypes = [ctypes.c_void_p]
+            lib.TessBaseAPIDelete.argtypes = [ctypes.c_void_p]
+        except (OSError, AttributeError):
+            _libtess = False
+            return
+        _libtess = lib
+    return _libtess or None
+
+
+def get_tessdata(modelpath, cachedir=None):
+    """
+    Unpack a tar-gzipped Tesseract language model, once per
+    model file, returning the (TESSDATA_PREFIX, lang) pair.
+    The prefix DOESN'T include the "tessdata" part.
+    """
+    if cachedir is None:
+        cachedir = os.path.join(tempfile.gettempdir(), "ocradmin_tessdata")
+    stat = os.stat(modelpath)
+    key = hashlib.md5("%s:%s:%s" % (
+            os.path.abspath(modelpath), stat.st_size, stat.st_mtime)).hexdigest()
+    prefix = os.path.join(cachedir, key) + "/"
+    langfile = os.path.join(prefix, "lang")
+    with _tessdatalock:
+        if not os.path.exists(langfile):
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir)
+            # unpack somewhere private then move it into
+            # place so other workers never see half a model
+            tmpdir = tempfile.mkdtemp(dir=cachedir)
+            datapath = os.path.join(tmpdir, "tessdata")
+            os.mkdir(datapath)
+            # let this throw an exception if it fails.
+            tgz = tarfile.open(modelpath, "r:*")
+            lang = os.path.splitext(tgz.getnames()[0])[0]
+            tgz.extractall(path=datapath)
+            tgz.close()
+            with open(os.path.join(tmpdir, "lang"), "w") as f:
+                f.write(lang)
+            try:
+                os.rename(tmpdir, prefix)
+            except OSError:
+                # somebody else got there first
+                shutil.rmtree(tmpdir, True)
+    with open(langfile, "r") as f:
+        return prefix, f.read().strip()
+
+
+class TesseractHandle(object):
+    """
+    A single initialised Tesseract API instance.  Not
+    to be used by more than one thread at once.
+    """
+    def __init__(self, lib, prefix, lang):
+        self._lib = lib
+        self._api = lib.TessBaseAPICreate()
+        if lib.TessBaseAPIInit3(self._api, prefix, lang) != 0:
+            lib.TessBaseAPIDelete(self._api)
+            self._api = None
+            raise exceptions.ExternalToolError(
+                    "Unable to initialise Tesseract with '%s' in %s" % (
+                        lang, prefix))
+
+    def recognize(self, line, psm=PSM_SINGLE_LINE):
+        """
+        Recognise a line image (8-bit grey, dark text on light.)
+        """
+        if not line.size:
+            return u""
+        data = numpy.ascontiguousarray(line, dtype=numpy.uint8)
+        if line.dtype == numpy.bool or data.max() == 1:
+            data = data * 255
+        height, width = data.shape[:2]
+        self._lib.TessBaseAPISetPageSegMode(self._api, psm)
+        self._lib.TessBaseAPISetImage(self._api, data.tostring(),
+                width, height, 1, width)
+        textp = self._lib.TessBaseAPIGetUTF8Text(self._api)
+        if not textp:
+            return u""
+        try:
+            text = ctypes.string_at(textp)
+        finally:
+            self._lib.TessDeleteText(textp)
+        return unicode(" ".join([l.rstrip() for l in text.splitlines() \
+                if l.strip()]), "utf8")
+
+    def close(self):
+        if self._api is not None:
+            self._lib.TessBaseAPIEnd(self._api)
+            self._lib.TessBaseAPIDelete(self._api)
+            self._api = None
+
+
+class TesseractPool(object):
+    """
+    Pool of Tesseract handles for one language.  Handles are
+    created as needed, up to the pool size, which can grow
+    but never shrinks.
+    """
+    def __init__(self, lib, prefix, lang, size=1):
+        self._lib = lib
+        self._prefix = prefix
+        self._lang = lang
+        self._size = max(1, size)
+        self._created = 0
+        self._idle = Queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self._size
+
+    def grow(self, size):
+        with self._lock:
+            self._size = max(self._size, size)
+
+    def acquire(self):
+        with self._lock:
+            if self._idle.empty() and self._created < self._size:
+                self._created += 1
+                try:
+                    return TesseractHandle(self._lib, self._prefix, self._lang)
+                except Exception:
+                    self._created -= 1
+                    raise
+        return self._idle.get()
+
+    def release(self, handle):
+        self._idle.put(handle)
+
+    def recognize(self, line, psm=PSM_SINGLE_LINE):
+        handle = self.acquire()
+        try:
+            return handle.recognize(line, psm)
+        finally:
+            self.release(handle)
+
+    def close(self):
+        """
+        Close the idle handles.  Any that are checked
+        out are left alone.
+        """
+        while True:
+            try:
+                handle = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
+            handle.close()
+
+
+def get_pool(prefix, lang, size=1):
+    """
+    Get the process-wide pool for a given language, grown to
+    at least the given size, or None if the Tesseract library
+    isn't available.
+    """
+    lib = get_library()
+    if lib is None:
+        return
+    with _poolslock:
+        pool = _pools.get((prefix, lang))
+        if pool is None:
+            pool = _pools[(prefix, lang)] = TesseractPool(
+                    lib, prefix, lang, size)
+        else:
+            pool.grow(size)
+        return pool
@@ -3,6 +3,9 @@
 """
 import os
 import glob
+import shutil
+import tempfile
+import threading
 from django.test import TestCase
 from django.utils import simplejson as json
 from django.conf import settings
@@ -11,8 +14,9 @@ from ocradmin.core.tests import testutils
 
 from nodetree import script, node, exceptions
 import numpy
+from pymongo.errors import ConnectionFailure
 
-from ocradmin.nodelib import nodes
+from ocradmin.nodelib import nodes, cache, utils, session, tesspool
 
 VALID_SCRIPTDIR = "nodelib/scripts/valid"
 INVALID_SCRIPTDIR = "nodelib/scripts/invalid"
@@ -61,6 +65,41 @@ class ScriptsTest(TestCase):
                         msg="Unexpected output type for node %s: %s" % (
                             n.name, type(out)))
 
+    def test_script_session(self):
+        """
+        Test a session changes params in place, and
+        rebuilds when the script's shape changes.
+        """
+        nodes = self.validscripts["binarize.json"]
+        sess = session.ScriptSession(nodes, cache.TestMockCacher())
+        tree = sess.tree
+        changed = json.loads(json.dumps(nodes))
+        changed["BinarizeBySauvola1"]["params"][1][1] = 30
+        self.assertEqual(sess.update(changed), ["BinarizeBySauvola1"])
+        self.assertTrue(sess.tree is tree)
+        self.assertEqual(int(sess.get_node(
+                "BinarizeBySauvola1")._params["w"]), 30)
+        del changed["Rotate360_1"]
+        self.assertEqual(sess.update(changed), None)
+        self.assertFalse(sess.tree is tree)
+
+    def test_session_store(self):
+        """
+        Test a stored session is rebound to each run's
+        cacher, keeping the digests it has worked out.
+        """
+        nodes = self.validscripts["binarize.json"]
+        store = session.SessionStore(1)
+        cachers = []
+        def cacherfunc(digests):
+            cachers.append(cache.TestMockCacher(digests=digests))
+            return cachers[-1]
+        sess = store.get("test", nodes, cacherfunc)
+        self.assertTrue(store.get("test", nodes, cacherfunc) is sess)
+        self.assertTrue(sess.cacher is cachers[1])
+        self.assertTrue(sess.get_node("BinarizeBySauvola1")._cacher is cachers[1])
+        self.assertTrue(cachers[1].digests is cachers[0].digests)
+
     def test_invalid_scripts(self):
         """
         Test supposedly invalid script DO raise errors.
@@ -76,7 +115,306 @@ class ScriptsTest(TestCase):
                 self.assertRaises(exceptions.ValidationError, n.eval)
 
 
+class LineStripTest(TestCase):
+    def test_split_strip_hocr(self):
+        """
+        Test HOCR for a strip of lines is split back
+        into the original lines.
+        """
+        lines = [numpy.zeros((20, 50), dtype=numpy.uint8) + 255,
+                numpy.zeros((30, 80), dtype=numpy.uint8) + 255]
+        strip, offsets = utils.make_line_strip(lines)
+        self.assertEqual(offsets, [(15, 35), (50, 80)])
+        self.assertEqual(strip.shape, (95, 110))
+        hocr = "<div class='ocr_page'>" \
+                "<span class='ocr_line' title='bbox 10 12 50 30'>" \
+                "<span>Hello</span> <span>world</span></span>" \
+                "<span class='ocr_line' title='bbox 60 45 90 78'>two</span>" \
+                "<span class='ocr_line' title='bbox 10 48 50 70'>line</span>" \
+                "</div>"
+        self.assertEqual(utils.split_strip_hocr(hocr, offsets),
+                [u"Hello world", u"line two"])
 
-        
+
+class MockTessLib(object):
+    """
+    Just enough of libtesseract's C API to make handles.
+    """
+    def TessBaseAPICreate(self):
+        return object()
+
+    def TessBaseAPIInit3(self, api, prefix, lang):
+        return 0
+
+    def TessBaseAPIEnd(self, api):
+        pass
+
+    def TessBaseAPIDelete(self, api):
+        pass
+
+
+class TesseractPoolTest(TestCase):
+    def setUp(self):
+        self._libtess = tesspool._libtess
+        tesspool._libtess = MockTessLib()
+
+    def tearDown(self):
+        tesspool._libtess = self._libtess
+        tesspool._pools.pop(("test/", "eng"), None)
+
+    def test_pool_grows(self):
+        """
+        Test asking for a bigger pool grows the existing one,
+        leaving handles that are in use alone.
+        """
+        pool = tesspool.get_pool("test/", "eng", 1)
+        handle = pool.acquire()
+        self.assertTrue(tesspool.get_pool("test/", "eng", 3) is pool)
+        self.assertEqual(pool.size, 3)
+        self.assertTrue(tesspool.get_pool("test/", "eng", 2) is pool)
+        self.assertEqual(pool.size, 3)
+        self.assertTrue(handle._api is not None)
+        pool.release(handle)
+
+
+class MockCacheNode(object):
+    """
+    Just enough of a node for the cachers to work with.
+    """
+    def __init__(self, label, value):
+        self.label = label
+        self.value = value
+
+    def hash_value(self):
+        return dict(label=self.label, value=self.value)
+
+    def get_file_name(self):
+        return "%s.txt" % self.label
+
+    def reader(self, handle):
+        return handle.read()
+
+    def writer(self, handle, data):
+        handle.write(data)
+
+
+class MockImageCacheNode(MockCacheNode):
+    """
+    Mock node that outputs an image.
+    """
+    def get_file_name(self):
+        return "%s.png" % self.label
+
+
+class MockGraphNode(MockCacheNode):
+    """
+    Mock node with params and inputs, counting how
+    often its whole hash value is asked for.
+    """
+    name = "Test::Mock"
+    hashed = 0
+
+    def __init__(self, label, value, *inputs):
+        super(MockGraphNode, self).__init__(label, value)
+        self._params = dict(value=value)
+        self._inputs = list(inputs)
+
+    def hash_value(self):
+        MockGraphNode.hashed += 1
+        return super(MockGraphNode, self).hash_value()
+
+    def input(self, num):
+        return self._inputs[num]
+
+    def set_param(self, name, value):
+        self._params[name] = value
 
 
+class CacheTest(TestCase):
+    def setUp(self):
+        """
+            Setup a cache dir.
+        """
+        self.cachedir = tempfile.mkdtemp()
+        self.cacher = cache.PersistantFileCacher(path=self.cachedir, key="test")
+
+    def tearDown(self):
+        """
+            Cleanup the cache dir.
+        """
+        shutil.rmtree(self.cachedir, True)
+
+    def test_size_index(self):
+        """
+        Test the index tracks cache sizes.
+        """
+        n1, n2 = MockCacheNode("n1", 1), MockCacheNode("n2", 2)
+        self.cacher.set_cache(n1, "x" * 100)
+        self.cacher.set_cache(n2, "x" * 50)
+        self.assertEqual(self.cacher.size(), 150)
+        self.cacher.clear_cache(n1)
+        self.assertEqual(self.cacher.size(), 50)
+        self.assertFalse(os.path.exists(self.cacher.get_path(n1)))
+
+    def test_prune_lru(self):
+        """
+        Test least recently used entries are evicted first.
+        """
+        n1, n2, n3 = [MockCacheNode("n%d" % i, i) for i in range(1, 4)]
+        for n in (n1, n2, n3):
+            self.cacher.set_cache(n, "x" * 100)
+        self.assertEqual(self.cacher.get_cache(n1), "x" * 100)
+        self.assertEqual(self.cacher.prune(200), 200)
+        self.assertTrue(self.cacher.has_cache(n1))
+        self.assertFalse(self.cacher.has_cache(n2))
+        self.assertTrue(self.cacher.has_cache(n3))
+
+    def test_memory_tier(self):
+        """
+        Test the memory tier serves data without re-reading
+        the file, and notices when the file goes away.
+        """
+        tiered = cache.TieredCacher(self.cacher, 1024)
+        n1 = MockCacheNode("n1", 1)
+        tiered.set_cache(n1, "x" * 100)
+        with open(os.path.join(self.cacher.get_path(n1),
+                n1.get_file_name()), "w") as f:
+            f.write("changed")
+        self.assertEqual(tiered.get_cache(n1), "x" * 100)
+        self.cacher.clear_cache(n1)
+        self.assertEqual(tiered.get_cache(n1), None)
+
+    def test_memory_tier_skips(self):
+        """
+        Test misses and memory-mapped arrays aren't
+        kept in the memory tier.
+        """
+        cacher = cache.PersistantFileCacher(path=self.cachedir,
+                key="test", arrayformat="npy")
+        tiered = cache.TieredCacher(cacher, 1024 * 1024)
+        store = cache.get_memory_store(1024 * 1024)
+        size = store.size()
+        n1 = MockImageCacheNode("n1", 1)
+        self.assertEqual(tiered.get_cache(n1), None)
+        cacher.set_cache(n1, numpy.zeros((10, 10), dtype=numpy.uint8))
+        self.assertTrue(isinstance(tiered.get_cache(n1), numpy.memmap))
+        self.assertEqual(store.size(), size)
+
+    def test_npy_format(self):
+        """
+        Test images can be cached as memory-mapped arrays.
+        """
+        cacher = cache.PersistantFileCacher(path=self.cachedir,
+                key="test", arrayformat="npy")
+        n1 = MockImageCacheNode("n1", 1)
+        data = numpy.arange(100, dtype=numpy.uint8).reshape((10, 10))
+        cacher.set_cache(n1, data)
+        self.assertTrue(os.path.exists(
+                os.path.join(cacher.get_path(n1), "n1.npy")))
+        cached = cacher.get_cache(n1)
+        self.assertTrue(isinstance(cached, numpy.memmap))
+        self.assertTrue((cached == data).all())
+        self.assertRaises(cache.UnsupportedCacheTypeError,
+                cache.PersistantFileCacher, path=self.cachedir,
+                key="test", arrayformat="tiff")
+
+    def test_lazy_dzi(self):
+        """
+        Test lazy DZI mode only writes the descriptor
+        until a tile is asked for.
+        """
+        cacher = cache.DziFileCacher(path=self.cachedir,
+                key="test", arrayformat="npy", lazydzi=True)
+        n1 = MockImageCacheNode("n1", 1)
+        cacher.set_cache(n1, numpy.zeros((600, 700), dtype=numpy.uint8))
+        dzipath = cacher.ensure_dzi(n1)
+        self.assertTrue(os.path.exists(dzipath))
+        self.assertFalse(os.path.exists(
+                os.path.join(cacher.get_path(n1), "n1_files")))
+        tilepath = cacher.get_dzi_tile(dzipath, 10, 1, 0)
+        self.assertTrue(tilepath.endswith("n1_files/10/1_0.png"))
+        self.assertTrue(os.path.exists(tilepath))
+
+    def test_shared_cache(self):
+        """
+        Test shared node data is stored once, and only
+        deleted when no key references it.
+        """
+        ca = cache.PersistantFileCacher(path=self.cachedir, key="a", shared=True)
+        cb = cache.PersistantFileCacher(path=self.cachedir, key="b", shared=True)
+        n1 = MockCacheNode("n1", 1)
+        ca.set_cache(n1, "x" * 100)
+        self.assertEqual(ca.get_path(n1), cb.get_path(n1))
+        self.assertEqual(cb.get_cache(n1), "x" * 100)
+        self.assertEqual(cb.size(), 100)
+        ca.clear_cache(n1)
+        self.assertEqual(ca.size(), 0)
+        self.assertTrue(cb.has_cache(n1))
+        self.assertEqual(cb.prune(0), 0)
+        self.assertFalse(os.path.exists(cb.get_path(n1)))
+
+    def test_single_flight(self):
+        """
+        Test a second evaluator waits for the first to
+        write a node's data, then reads it.
+        """
+        first = cache.PersistantFileCacher(path=self.cachedir,
+                key="test", locktimeout=5)
+        second = cache.PersistantFileCacher(path=self.cachedir,
+                key="test", locktimeout=5)
+        n1 = MockCacheNode("n1", 1)
+        self.assertFalse(first.has_cache(n1))
+        writer = threading.Timer(0.2, first.set_cache, (n1, "x" * 100))
+        writer.start()
+        self.assertTrue(second.has_cache(n1))
+        self.assertEqual(second.get_cache(n1), "x" * 100)
+        writer.join()
+        self.assertEqual(os.listdir(first.get_path(n1)), ["n1.txt"])
+
+    def test_mongodb_cacher(self):
+        """
+        Test the MongoDB cacher tracks sizes and evicts the
+        least recently used files first.
+        """
+        try:
+            cacher = cache.MongoDBCacher(path=self.cachedir,
+                    key="ocradmin_test_cache")
+        except ConnectionFailure:
+            self.skipTest("No MongoDB server")
+        cacher.clear()
+        try:
+            n1, n2, n3 = [MockCacheNode("n%d" % i, i) for i in range(1, 4)]
+            for n in (n1, n2, n3):
+                self.assertFalse(cacher.has_cache(n))
+                cacher.set_cache(n, "x" * 100)
+            self.assertEqual(cacher.size(), 300)
+            self.assertTrue(cacher.has_cache(n1))
+            self.assertEqual(cacher.get_cache(n1), "x" * 100)
+            self.assertEqual(cacher.prune(200), 200)
+            self.assertTrue(cacher.has_cache(n1))
+            self.assertFalse(cacher.has_cache(n2))
+            cacher.clear_cache(n1)
+            self.assertEqual(cacher.size(), 100)
+        finally:
+            cacher.clear()
+
+    def test_node_digests(self):
+        """
+        Test node digests are computed once, from their
+        inputs' digests, and invalidated downstream.
+        """
+        n1 = MockGraphNode("n1", 1)
+        n2 = MockGraphNode("n2", 2, n1)
+        n3 = MockGraphNode("n3", 3, n2)
+        other = MockGraphNode("n4", 4, n1)
+        digests = self.cacher.digests
+        first = [digests.digest(n) for n in (n3, other)]
+        self.assertEqual(self.cacher.get_path(n3),
+                os.path.join(self.cachedir, "test", "n3", first[0]))
+        self.assertEqual(MockGraphNode.hashed, 0)
+        digests.set_param(n2, "value", 2)
+        self.assertEqual(digests.digest(n3), first[0])
+        digests.set_param(n1, "value", 5)
+        self.assertNotEqual(digests.digest(n3), first[0])
+        self.assertNotEqual(digests.digest(other), first[1])
+        self.assertEqual(cache.NodeDigests().digest(n3), digests.digest(n3))
@@ -6,6 +6,7 @@ from __future__ import absolute_import
 
 import os
 import re
+import bisect
 import tempfile
 import subprocess as sp
 from lxml import etree
@@ -97,6 +98,107 @@ class HocrToTextHelper(HTMLParser):
         self._gotline = False
 
 
+class HocrLineHelper(HTMLParser):
+    """
+    Get the bbox and text of each line in a HOCR document.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self._lines = []
+        self._depth = 0
+        self._boxre = re.compile("bbox (\d+) (\d+) (\d+) (\d+)")
+
+    def parse(self, string):
+        self._lines = []
+        self._depth = 0
+        self.feed(string)
+        self.close()
+        return [(bbox, " ".join("".join(text).split())) \
+                for bbox, text in self._lines]
+
+    def handle_starttag(self, tag, attrs):
+        if self._depth:
+            # words are usually separate elements
+            self._lines[-1][1].append(" ")
+            if tag.lower() != "br":
+                self._depth += 1
+            return
+        attrs = dict(attrs)
+        if attrs.get("class", "").find("ocr_line") == -1:
+            return
+        match = self._boxre.search(attrs.get("title", ""))
+        if match:
+            self._lines.append(([int(i) for i in match.groups()], []))
+            self._depth = 1
+
+    def handle_data(self, data):
+        if self._depth:
+            self._lines[-1][1].append(data)
+
+    def handle_entityref(self, name):
+        from htmlentitydefs import name2codepoint
+        if self._depth and name in name2codepoint:
+            self._lines[-1][1].append(unichr(name2codepoint[name]))
+
+    def handle_endtag(self, tag):
+        if self._depth and tag.lower() != "br":
+            self._lines[-1][1].append(" ")
+            self._depth -= 1
+
+
+def make_line_strip(lines, background=None):
+    """
+    Stack line images vertically into a single image,
+    separated by blank space, so they can all be recognised
+    in one go.  Returns the image and the (top, bottom) offset
+    of each line within it.
+    """
+    import numpy
+    lines = [l for l in lines]
+    if background is None:
+        nonempty = [l.ravel() for l in lines if l.size]
+        background = numpy.bincount(
+                numpy.concatenate(nonempty).astype(numpy.uint8)).argmax() \
+                        if nonempty else 255
+    height = max([l.shape[0] for l in lines] + [1])
+    pad = max(10, height / 2)
+    width = max([l.shape[1] for l in lines] + [1]) + 2 * pad
+    offsets = []
+    top = pad
+    for line in lines:
+        offsets.append((top, top + line.shape[0]))
+        top += line.shape[0] + pad
+    dtype = lines[0].dtype if lines else numpy.uint8
+    strip = numpy.empty((top, width), dtype=dtype)
+    strip.fill(background)
+    for line, (y0, y1) in zip(lines, offsets):
+        strip[y0:y1, pad:pad + line.shape[1]] = line
+    return strip, offsets
+
+
+def split_strip_hocr(hocr, offsets):
+    """
+    Divide the lines in a HOCR document for a strip image
+    made with `make_line_strip` between the original lines,
+    according to where the middle of each falls.
+    """
+    texts = [[] for o in offsets]
+    if not offsets:
+        return []
+    tops = [top for top, bottom in offsets]
+    for bbox, text in HocrLineHelper().parse(hocr):
+        if not text:
+            continue
+        middle = (bbox[1] + bbox[3]) / 2.0
+        i = max(0, bisect.bisect_right(tops, middle) - 1)
+        # belongs to whichever line it's nearer
+        if i + 1 < len(offsets) and \
+                middle - offsets[i][1] > offsets[i + 1][0] - middle:
+            i += 1
+        texts[i].append((bbox[0], text))
+    return [u" ".join([t for x, t in sorted(l)]) for l in texts]
+
+
 def merge_hocr(hocrlist):
     """Merge several HOCR files (i.e. representing
     individual columns) into one page file."""
@@ -148,6 +250,23 @@ def get_dzi_cacher(settings):
     return cacher
 
 
+def get_node_cacher(settings, key, **kwargs):
+    """
+    Build the configured (DZI) node cacher for a cache key,
+    with the cache options from settings.  Keyword args
+    override them.
+    """
+    options = dict(
+            path=os.path.join(settings.MEDIA_ROOT, settings.TEMP_PATH),
+            key=key,
+            arrayformat=getattr(settings, "NODETREE_CACHE_ARRAY_FORMAT", "png"),
+            lazydzi=getattr(settings, "NODETREE_LAZY_DZI", False),
+            shared=getattr(settings, "NODETREE_SHARED_CACHE", False),
+            locktimeout=getattr(settings, "NODETREE_CACHE_LOCK_TIMEOUT", 0))
+    options.update(kwargs)
+    return get_dzi_cacher(settings)(**options)
+
+
 def lookup_model_file(modelname):
     """
     Lookup the filename of a model from its
@@ -199,7 +318,7 @@ def check_aborted(method):
         if instance.abort_func is not None:
             if instance.abort_func():
                 instance.logger.warning("Aborted")
-                raise AbortedAction(method.func_name)
+                raise exceptions.AbortedAction(method.func_name)
         return method(*args, **kwargs)
     return wrapper
 
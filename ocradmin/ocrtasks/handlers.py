@@ -1,28 +1,44 @@
 """
 Callbacks to run when certain celery signals are recieved in response
-to the ConvertPageTask.
+to the ConvertPageTask.  Each is a single UPDATE, rather than a fetch
+and save of the whole task, plus a lookup of the task's batch so its
+cached summary can be cleared.
 """
 
+import datetime
 from ocradmin.ocrtasks.models import OcrTask
+from ocradmin.batch.models import Batch
 from celery.datastructures import ExceptionInfo
 
 
+def _update_task(task_id, **kwargs):
+    """
+    Update the given fields of a task, unless it
+    has been aborted in the meantime, and clear the
+    summary of its batch.
+    """
+    updated = OcrTask.objects.filter(task_id=task_id).exclude(
+            status="ABORTED").update(
+                    updated_on=datetime.datetime.now(), **kwargs)
+    if not updated:
+        return
+    for batch_pk in OcrTask.objects.filter(task_id=task_id,
+            batch__isnull=False).values_list("batch_id", flat=True):
+        Batch.clear_summary(batch_pk)
+
+
 def on_task_sent(**kwargs):
     """
     Update the database when a task is sent to the broker.
     """
-    task = OcrTask.objects.get(task_id=kwargs.get("task_id"))
-    task.status = "PENDING"
-    task.save()
+    _update_task(kwargs.get("task_id"), status="PENDING")
 
 
 def on_task_prerun(**kwargs):
     """
     Update the database when a task is about to run.
     """
-    task = OcrTask.objects.get(task_id=kwargs.get("task_id"))
-    task.status = "STARTED"
-    task.save()
+    _update_task(kwargs.get("task_id"), status="STARTED")
 
 
 def on_task_postrun(**kwargs):
@@ -30,11 +46,9 @@ def on_task_postrun(**kwargs):
     Update the database when a task is finished.  Create a new
     transcript entry with the retval of the task.
     """
-    task = OcrTask.objects.get(task_id=kwargs.get("task_id"))
     retval = kwargs.get("retval")
     if not isinstance(retval, ExceptionInfo):
-        task.status = "SUCCESS"
-        task.save()
+        _update_task(kwargs.get("task_id"), status="SUCCESS")
 
 
 def on_task_failure(**kwargs):
@@ -42,10 +56,7 @@ def on_task_failure(**kwargs):
     Store the exception and traceback when a task
     fails.
     """
-    task = OcrTask.objects.get(task_id=kwargs.get("task_id"))
-    task.error = kwargs.get("exception")
-    task.traceback = kwargs.get("traceback")
-    task.status = "FAILURE"
-    task.save()
-
-
+    _update_task(kwargs.get("task_id"),
+            error=kwargs.get("exception"),
+            traceback=kwargs.get("traceback"),
+            status="FAILURE")
@@ -28,16 +28,21 @@ class OcrTask(models.Model):
         ("SUCCESS", "Success"),
         ("FAILURE", "Failure"),
     )
+    ACTIVE_STATUSES = ("INIT", "PENDING", "RETRY", "STARTED")
+    # large, pickled or free-text columns that listings
+    # of tasks shouldn't load
+    DETAIL_FIELDS = ("args", "kwargs", "error", "traceback")
 
     user = models.ForeignKey(User)
     batch = models.ForeignKey(Batch,
             related_name="tasks", blank=True, null=True)
     project = models.ForeignKey(Project,
             related_name="tasks", blank=True, null=True)
-    task_id = models.CharField(max_length=100)
+    task_id = models.CharField(max_length=100, db_index=True)
     task_name = models.CharField(max_length=100)
     page_name = models.CharField(max_length=255)
-    status = models.CharField(max_length=20, choices=STATUS_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES,
+            db_index=True)
     lines = models.IntegerField(blank=True, null=True)
     progress = models.FloatField(default=0.0, blank=True, null=True)
     args = fields.PickledObjectField(blank=True, null=True)
@@ -60,12 +65,21 @@ class OcrTask(models.Model):
         """
         if not self.is_active():
             return
+        aborted = False
+        if self.is_revokable():
+            # make sure it isn't sent, or run, later on
+            aborted = True
         asyncres = AbortableAsyncResult(self.task_id)
         if self.is_abortable():
             asyncres.abort()
-            if asyncres.is_aborted():
-                self.status = "ABORTED"
-                self.save()
+            aborted = asyncres.is_aborted()
+        if aborted:
+            # update just the status, so this works on
+            # tasks fetched without their detail fields
+            self.status = "ABORTED"
+            self.updated_on = datetime.datetime.now()
+            OcrTask.objects.filter(pk=self.pk).update(
+                    status=self.status, updated_on=self.updated_on)
         celery.task.control.revoke(self.task_id,
                 terminate=True, signal="SIGTERM")
 
@@ -120,7 +134,7 @@ class OcrTask(models.Model):
         """
         The task is running or awaiting running.
         """
-        return self.status in ("INIT", "PENDING", "RETRY", "STARTED")
+        return self.status in self.ACTIVE_STATUSES
 
 
     @classmethod
@@ -135,6 +149,21 @@ class OcrTask(models.Model):
                 else task.apply
         return func(args=args, kwargs=taskkwargs, **kwargs)
 
+    @classmethod
+    def create_multiple(cls, tasks):
+        """
+        Insert several new tasks at once, with a single
+        query where the database layer supports it.
+        """
+        now = datetime.datetime.now()
+        for task in tasks:
+            task.created_on = now
+        if hasattr(cls.objects, "bulk_create"):
+            return cls.objects.bulk_create(tasks)
+        for task in tasks:
+            task.save()
+        return tasks
+
     @classmethod
     def run_celery_task_multiple(cls, taskname, tasks, **kwargs):
         """
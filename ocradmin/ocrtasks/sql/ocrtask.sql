@@ -0,0 +1,4 @@
+-- Composite indexes for the batch views, which filter a batch's
+-- tasks by status and page through them by page name.
+CREATE INDEX ocrtasks_ocrtask_batch_status ON ocrtasks_ocrtask (batch_id, status);
+CREATE INDEX ocrtasks_ocrtask_batch_page_name ON ocrtasks_ocrtask (batch_id, page_name);
@@ -12,6 +12,19 @@ from django.test.client import Client
 from ocradmin.core import utils as ocrutils
 from models import OcrTask
 from testutils import TestTask
+from utils import ProgressBuffer, AbortCheck
+
+
+class FakeResult(object):
+    """
+    Stand-in for an AbortableAsyncResult.
+    """
+    aborted = False
+    checks = 0
+
+    def is_aborted(self):
+        self.checks += 1
+        return self.aborted
 
 
 class OcrTaskTest(TestCase):
@@ -64,6 +77,35 @@ class OcrTaskTest(TestCase):
         self.assertEqual(r.status_code, 200)
         self.assertNotEqual(t1, t2)
 
+    def test_progress_buffer(self):
+        """
+        Test progress is only written once per interval.
+        """
+        task = OcrTask.objects.all()[0]
+        progress = ProgressBuffer(task.task_id, 60)
+        progress(10, 20)
+        progress(50, 20)
+        self.assertEqual(OcrTask.objects.get(pk=task.pk).progress, 10)
+        self.assertEqual(OcrTask.objects.get(pk=task.pk).lines, 20)
+        progress.flush()
+        self.assertEqual(OcrTask.objects.get(pk=task.pk).progress, 50)
+
+    def test_abort_check(self):
+        """
+        Test abort checks are cached, and stick once aborted.
+        """
+        abort = AbortCheck("test", 60)
+        abort._result = FakeResult()
+        self.assertFalse(abort())
+        abort._result.aborted = True
+        self.assertFalse(abort())
+        self.assertEqual(abort._result.checks, 1)
+        abort.interval = 0
+        self.assertTrue(abort())
+        abort._result.aborted = False
+        self.assertTrue(abort())
+        self.assertEqual(abort._result.checks, 2)
+
     def _start_test_task(self, args):
         """
         Create a test task and return both the wrapper
@@ -2,40 +2,94 @@
 Utilities for managing OcrTasks.
 """
 
+import time
+import threading
+from django.conf import settings
 from celery.contrib.abortable import AbortableAsyncResult
 from models import OcrTask
 
 
-
-def get_progress_callback(task_id):
+class ProgressBuffer(object):
     """
-    Closure for generating a function that refers to
-    a task id in outer scope.
+    Progress callback for a given task id.  Rather than
+    writing every tick, it keeps the latest values and
+    writes them at most once per `interval` seconds,
+    with a single UPDATE.
     """
-    def progress_func(progress, lines=None):
+    def __init__(self, task_id, interval):
+        self.task_id = task_id
+        self.interval = interval
+        self._pending = {}
+        self._lines = None
+        self._flushed = 0
+
+    def __call__(self, progress, lines=None):
         """
         Set progress for the given task.
         """
-        task = OcrTask.objects.get(task_id=task_id)
-        task.progress = progress
-        if lines is not None:
-            task.lines = lines
-        task.save()
-    return progress_func
+        self._pending["progress"] = progress
+        # the line count changes rarely, and tells the
+        # batch how to weight the task, so write it now
+        urgent = lines is not None and lines != self._lines
+        if urgent:
+            self._pending["lines"] = self._lines = lines
+        if urgent or progress <= 0 or progress >= 100 \
+                or time.time() - self._flushed >= self.interval:
+            self.flush()
 
+    def flush(self):
+        """
+        Write any outstanding progress.
+        """
+        if not self._pending:
+            return
+        OcrTask.objects.filter(task_id=self.task_id).exclude(
+                status="ABORTED").update(**self._pending)
+        self._pending = {}
+        self._flushed = time.time()
 
-def get_abort_callback(task_id):
+
+def get_progress_callback(task_id):
     """
-    Closure for generating a function that takes
-    no params but uses a task_id in outer scope.
+    Get a (rate-limited) function that sets the
+    progress of the given task id.  Call its `flush`
+    method when the task is done.
     """
-    def abort_func():
+    return ProgressBuffer(task_id,
+            getattr(settings, "OCRTASK_PROGRESS_INTERVAL", 500) / 1000.0)
+
+
+class AbortCheck(object):
+    """
+    Abort callback for a given task id.  Asking the result
+    backend is a query, so the answer is kept for `interval`
+    seconds, and once a task is aborted it stays that way.
+    """
+    def __init__(self, task_id, interval):
+        self.interval = interval
+        self._result = AbortableAsyncResult(task_id)
+        self._aborted = False
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
         """
         Check whether the task in question has been aborted.
         """
-        asyncres = AbortableAsyncResult(task_id)
-        return asyncres.is_aborted()
-    return abort_func
-
+        if self._aborted:
+            return True
+        with self._lock:
+            now = time.time()
+            if self._checked is None or now - self._checked >= self.interval:
+                self._aborted = self._result.is_aborted()
+                self._checked = now
+        return self._aborted
 
 
+def get_abort_callback(task_id):
+    """
+    Get a function that takes no params and says
+    whether the given task id has been aborted.
+    """
+    return AbortCheck(task_id,
+            getattr(settings, "OCRTASK_ABORT_INTERVAL", 1000) / 1000.0)
@@ -10,7 +10,18 @@ from ocradmin.ocrtasks.models import OcrTask
 from ocradmin.core import generic_views as gv
 
 
-tasklist = gv.GenericListView.as_view(
+class OcrTaskListView(gv.GenericListView):
+    """Task list view that doesn't load the tasks'
+    pickled args and results."""
+    def get_queryset(self):
+        qset = super(OcrTaskListView, self).get_queryset()
+        # the serializers can't handle deferred models
+        if self.request.GET.get("format", "html") == "json":
+            return qset
+        return qset.defer(*OcrTask.DETAIL_FIELDS)
+
+
+tasklist = OcrTaskListView.as_view(
         model=OcrTask,
         page_name="OCR Tasks",
         fields=["id", "page_name", "user", "status", "progress", "created_on"],)
@@ -13,13 +13,19 @@ from django.contrib.auth.models import User
 
 from ocradmin.core import utils
 from ocradmin.ocrtasks.decorators import register_handlers
-from ocradmin.nodelib import cache, types, nodes
+from ocradmin.nodelib import cache, types, nodes, session
 from ocradmin.nodelib import utils as pluginutils
 
-from nodetree import node, script, exceptions
+from nodetree import exceptions
 import numpy
 
 
+# each user's script graph, kept between interactive
+# runs for the lifetime of the worker process
+_sessions = session.SessionStore(
+        getattr(settings, "NODETREE_MAX_SESSIONS", 10))
+
+
 class UnhandledRunScriptTask(AbortableTask):
     """
     Convert an image of text into some JSON.  This is done using
@@ -33,24 +39,43 @@ class UnhandledRunScriptTask(AbortableTask):
         Runs the convert action.
         """
         logger = self.get_logger()
-        cacheclass = pluginutils.get_dzi_cacher(settings)
-        cacher = cacheclass(
-                path=os.path.join(settings.MEDIA_ROOT, settings.TEMP_PATH),
-                key=cachedir, logger=logger)
-        logger.debug("Using cacher: %s, Bases %s", cacher, cacheclass.__bases__)
         try:
-            tree = script.Script(nodelist,
-                    nodekwargs=dict(logger=logger, cacher=cacher))
-            term = tree.get_node(evalnode)
+            session = _sessions.get(cachedir, nodelist,
+                    lambda digests: self.get_cacher(cachedir, logger, digests),
+                    logger)
+            term = session.get_node(evalnode)
             if term is None:
-                term = tree.get_terminals()[0]
-            result = term.eval()
+                term = session.get_terminals()[0]
+            try:
+                result = term.eval()
+            finally:
+                # don't keep anybody waiting for nodes that failed
+                session.cacher.release_locks()
         except exceptions.NodeError, err:
             logger.error("Node Error (%s): %s", err.node, err.message)
             return dict(type="error", node=err.node.label, error=err.message)
 
-        return self.handle_output(term, cacher, result)
+        return self.handle_output(term, session.cacher, result)
 
+    def get_cacher(self, cachedir, logger, digests=None):
+        cacher = pluginutils.get_node_cacher(settings, cachedir,
+                logger=logger, digests=digests)
+        if getattr(settings, "NODETREE_MEMORY_CACHE", 0):
+            cacher = cache.TieredCacher(cacher,
+                    settings.NODETREE_MEMORY_CACHE * 1024 * 1024)
+        logger.debug("Using cacher: %s", cacher)
+        return cacher
+
+    def dzi_url(self, cacher, node):
+        """
+        URL for a node's DZI.  Lazy DZIs are served via the
+        preset views, which render tiles as they're requested.
+        """
+        dzipath = cacher.ensure_dzi(node)
+        if getattr(settings, "NODETREE_LAZY_DZI", False):
+            return "/presets/dzi/%s" % os.path.relpath(dzipath,
+                    os.path.join(settings.MEDIA_ROOT, settings.TEMP_PATH))
+        return utils.media_path_to_url(dzipath)
 
     def handle_output(self, term, cacher, result):
 
@@ -58,16 +83,10 @@ class UnhandledRunScriptTask(AbortableTask):
         if term.__class__.__name__ == "Switch":
             return self.handle_output(term.first_active(), cacher, result)
 
-        outpath = cacher.get_path(term.first_active())
-        outname = term.first_active().get_file_name()
-        outdzi = utils.media_path_to_url(
-                os.path.join(outpath, "%s.dzi" % os.path.splitext(outname)[0]))
+        outdzi = self.dzi_url(cacher, term.first_active())
         indzi = None
         if term.arity > 0 and term.input(0):
-            inpath = cacher.get_path(term.input(0).first_active())
-            inname = term.input(0).first_active().get_file_name()
-            indzi = utils.media_path_to_url(
-                    os.path.join(inpath, "%s.dzi" % os.path.splitext(inname)[0]))
+            indzi = self.dzi_url(cacher, term.input(0).first_active())
 
         if term.outtype == numpy.ndarray:
             out = dict(type="image", output=outdzi)
@@ -93,7 +112,8 @@ class PruneCacheTask(PeriodicTask):
     """
     Periodically prune a user's cache directory by deleting
     node cache's (oldest first) till the dir is under
-    NODETREE_USER_MAX_CACHE size.
+    NODETREE_USER_MAX_CACHE size, and then the whole cache
+    till it is under NODETREE_MAX_CACHE.
     """
     name = "cleanup.cache"
     run_every = timedelta(seconds=600)
@@ -102,18 +122,23 @@ class PruneCacheTask(PeriodicTask):
 
     def run(self, **kwargs):
         """
-        Clean the modia folder of any files that haven't
-        been accessed for X minutes.
+        Evict least-recently used node caches for each user,
+        then globally.
         """
         logger = self.get_logger()
-        cacheclass = pluginutils.get_dzi_cacher(settings)
+        usermax = settings.NODETREE_USER_MAX_CACHE * 1024 * 1024
         for user in User.objects.all():
-            cachedir = "cache_%s" % user.username
-            cacher = cacheclass(
-                    path=os.path.join(settings.MEDIA_ROOT, settings.TEMP_PATH),
-                    key=cachedir, logger=logger)
-            logger.debug("Using cacher: %s, Bases %s", cacher, cacheclass.__bases__)
-
-
-
+            cacher = pluginutils.get_node_cacher(settings,
+                    "cache_%s" % user.username, logger=logger)
+            size = cacher.prune(usermax)
+            logger.debug("Cache size for %s: %s", user.username, size)
+        # caches that aren't indexed (i.e. MongoDB) have a
+        # database per key, so there's nothing global to prune
+        if not pluginutils.get_dzi_cacher(settings).indexed:
+            return
+        globalmax = getattr(settings, "NODETREE_MAX_CACHE",
+                settings.NODETREE_USER_MAX_CACHE) * 1024 * 1024
+        cacher = pluginutils.get_node_cacher(settings, "", logger=logger)
+        size = cacher.prune(globalmax, allkeys=True)
+        logger.debug("Total cache size: %s", size)
 
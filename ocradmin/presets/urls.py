@@ -16,6 +16,9 @@ urlpatterns = patterns('',
     (r'^data/(?P<slug>[-\w]+)/?$', views.data),
     (r'^delete/(?P<slug>[-\w]+)/?$', login_required(views.presetdelete)),
     (r'^download/(?P<slug>[-\w]+)/?$', views.download),
+    (r'^dzi/(?P<path>.+)_files/(?P<level>\d+)/(?P<column>\d+)_(?P<row>\d+)\.png$',
+        login_required(views.dzi_tile)),
+    (r'^dzi/(?P<path>.+)\.dzi$', login_required(views.dzi)),
     (r'^edit/(?P<slug>[-\w]+)/?$', login_required(views.presetedit)),
     (r'^fetch/?$', views.fetch),
     (r'^layout_graph/?$', views.layout_graph),
@@ -4,11 +4,12 @@ Interface to interacting with OCR presets.
 
 import os
 import glob
+import zlib
 import json
 
 from django import forms
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
 from django.shortcuts import get_object_or_404, render
 from django.core.exceptions import ValidationError
 from django.views.decorators.csrf import csrf_exempt
@@ -218,7 +219,7 @@ def run_preset(request):
         term = terms[0]
     async = OcrTask.run_celery_task("run.script", (evalnode, nodes,
             request.output_path, _cache_name(request)),
-            untracked=True, asyncronous=True, queue="interactive")
+            untracked=True, asyncronous=True, queue=_interactive_queue(request))
     out = dict(
         node=evalnode,
         task_id=async.task_id,
@@ -269,14 +270,40 @@ def _cache_name(request):
     return "cache_%s" % request.user.username
 
 
+def _interactive_queue(request):
+    """
+    Queue for a user's interactive runs.  Users always get
+    the same one so, with a worker on each queue, their
+    script session stays on the same worker.
+    """
+    queues = getattr(settings, "NODETREE_INTERACTIVE_QUEUES", ["interactive"])
+    return queues[zlib.crc32(request.user.username.encode("utf8")) % len(queues)]
+
+
+def _cacher(request):
+    """
+    Cacher for a user's preset cache.
+    """
+    return pluginutils.get_node_cacher(settings, _cache_name(request))
+
+
+def _cache_file_path(path):
+    """
+    Full path to a file in the cache dir, making
+    sure it doesn't point outside it.
+    """
+    root = os.path.abspath(os.path.join(settings.MEDIA_ROOT, settings.TEMP_PATH))
+    fullpath = os.path.abspath(os.path.join(root, path))
+    if not fullpath.startswith(root + os.sep) or not os.path.exists(fullpath):
+        raise Http404
+    return fullpath
+
+
 def clear_cache(request):
     """
     Clear a preset data cache.
     """
-    cacheclass = pluginutils.get_dzi_cacher(settings)
-    cacher = cacheclass(
-            path=os.path.join(settings.MEDIA_ROOT, settings.TEMP_PATH),
-            key=_cache_name(request))
+    cacher = _cacher(request)
     cacher.clear()
     return HttpResponse(json.dumps({"ok": True}),
             mimetype="application/json")
@@ -291,12 +318,32 @@ def clear_node_cache(request):
     nodes = json.loads(jsondata)
     tree = script.Script(nodes)
     node = tree.get_node(evalnode)
-    cacheclass = pluginutils.get_dzi_cacher(settings)
-    cacher = cacheclass(
-            path=os.path.join(settings.MEDIA_ROOT, settings.TEMP_PATH),
-            key=_cache_name(request))
+    cacher = _cacher(request)
     cacher.clear_cache(node)
     return HttpResponse(json.dumps({"ok": True}),
             mimetype="application/json")
 
 
+def dzi(request, path):
+    """
+    Serve a lazily-rendered DZI descriptor.
+    """
+    with open(_cache_file_path("%s.dzi" % path), "rb") as fh:
+        return HttpResponse(fh.read(), mimetype="application/xml")
+
+
+def dzi_tile(request, path, level, column, row):
+    """
+    Serve a single DZI tile, rendering it on
+    first request.
+    """
+    dzipath = _cache_file_path("%s.dzi" % path)
+    try:
+        tilepath = _cacher(request).get_dzi_tile(dzipath,
+                int(level), int(column), int(row))
+    except (AssertionError, ValueError):
+        tilepath = None
+    if tilepath is None:
+        raise Http404
+    with open(tilepath, "rb") as fh:
+        return HttpResponse(fh.read(), mimetype="image/png")
@@ -48,7 +48,33 @@ os.environ["PATH"] = "%s:%s" % (
 
 NODETREE_PERSISTANT_CACHER = "ocradmin.nodelib.cache.PersistantFileCacher"
 #NODETREE_PERSISTANT_CACHER = "ocradmin.nodelib.cache.MongoDBCacher"
+NODETREE_MONGODB_HOST = "localhost" # MongoDB server for the MongoDB cacher
+NODETREE_MONGODB_PORT = 27017
+NODETREE_MONGODB_POOL_SIZE = 10 # Connections kept per worker process
 NODETREE_USER_MAX_CACHE = 10 # Maximum cache size, in Megabytes
+NODETREE_MAX_CACHE = 1024 # Maximum cache size for all users, in Megabytes
+NODETREE_MEMORY_CACHE = 256 # In-process cache per worker, in Megabytes (0 to disable)
+NODETREE_CACHE_ARRAY_FORMAT = "png" # Image cache format: "png", "npy" or "npy.gz"
+NODETREE_LAZY_DZI = False # Only write DZI descriptors, rendering tiles on request
+NODETREE_SHARED_CACHE = False # Store node data once for all users, by digest
+NODETREE_BATCH_SHARED_CACHE = False # Let batch runs read from the shared cache
+NODETREE_CACHE_LOCK_TIMEOUT = 5 # Seconds an interactive run waits for another worker computing the same node (0 to disable)
+NODETREE_BATCH_CACHE_LOCK_TIMEOUT = 300 # Seconds a batch run waits for the same (0 to disable)
+NODETREE_MAX_SESSIONS = 10 # Users' script graphs kept between runs per worker
+NODETREE_INTERACTIVE_QUEUES = ["interactive"] # Queues for interactive runs, each user sticking to one
+NODETREE_RECOGNIZER_WORKERS = 1 # Lines recognised at once per page
+NODETREE_RECOGNIZER_BATCH = False # Recognise all lines on a page with one tool run
+TESSERACT_POOL_SIZE = 1 # Tesseract API handles kept per worker process
+BATCH_CHUNK_SIZE = 100 # Batch tasks created/sent per scheduler step
+BATCH_MAX_PENDING = 500 # Queued tasks before the batch scheduler holds back
+BATCH_PAGES_PER_TASK = 1 # Documents run from each batch task message
+BATCH_DISPATCH_INTERVAL = 5 # Seconds between batch scheduler steps
+BATCH_SUMMARY_CACHE = 2 # Seconds a batch's progress summary is cached for
+OCRTASK_PROGRESS_INTERVAL = 500 # Minimum milliseconds between task progress writes
+OCRTASK_ABORT_INTERVAL = 1000 # Milliseconds a task abort check is cached for
+INGEST_CHUNK_SIZE = 50 # Documents created per pid allocation when ingesting
+INGEST_IMAGES_PER_TASK = 20 # Documents thumbnailed per image task message
+INGEST_CREATE_DZI = False # Queue image DZIs along with ingested thumbnails
 
 ADMINS = (
 )
@@ -223,6 +249,10 @@ FEDORA_PASSWORD = 'fedora'
 FEDORA_PIDSPACE = 'simplerepo'
 FEDORA_IMAGE_NAME = "IMAGE"
 FEDORA_TRANSCRIPT_NAME = "TRANSCRIPT"
+FEDORA_SPOOL_SIZE = 4 * 1024 * 1024 # Bytes of fetched content kept in memory before spooling to disk
+FEDORA_POOL_SIZE = 4 # Keep-alive connections per Fedora host
+FEDORA_TIMEOUT = 60 # Seconds before a Fedora request times out
+FEDORA_RETRIES = 2 # Times a failed Fedora connection is retried
 
 
 COMPRESS_ROOT = STATIC_ROOT
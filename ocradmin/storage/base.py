@@ -6,6 +6,7 @@ import os
 import re
 import io
 import textwrap
+import itertools
 from contextlib import contextmanager
 from django import forms
 from django.conf import settings
@@ -89,10 +90,8 @@ class BaseStorage(object):
         raise NotImplementedError
 
     def document_attr_content_handle(self, doc, attr):
-        """Get document image content.  Currently
-        EULFedora doesn't support a streaming content
-        API so we have to load it into an in memory
-        buffer."""
+        """Get a readable, seekable handle on document
+        image content."""
         raise NotImplementedError
 
     @contextmanager
@@ -117,7 +116,7 @@ class BaseStorage(object):
         meta.update(kwargs)
         self.write_metadata(doc, **meta)
 
-    def delete_metadata(self, *args):
+    def delete_metadata(self, doc, *args):
         meta = self.read_metadata(doc)
         newmeta = dict([(k, v) for k, v in meta.iteritems() \
                 if k not in args])
@@ -135,6 +134,14 @@ class BaseStorage(object):
         """Set image label."""
         raise NotImplementedError
 
+    def write_document_attr(self, doc, attr, handle, mimetype, label):
+        """Set attr content from a file handle, along with
+        its mimetype and label, and save the document."""
+        self.set_document_attr_content(doc, attr, handle)
+        self.set_document_attr_mimetype(doc, attr, mimetype)
+        self.set_document_attr_label(doc, attr, label)
+        doc.save()
+
     def set_document_label(self, doc, label):
         """Set document label."""
         raise NotImplementedError
@@ -147,6 +154,12 @@ class BaseStorage(object):
         """Get a new document object"""
         raise NotImplementedError
 
+    def create_documents(self, labels):
+        """Get a new document object for each label.
+        Backends that can reserve several ids at
+        once should override this."""
+        return [self.create_document(label) for label in labels]
+
     def get(self, id):
         """Get an object by id."""
         raise NotImplementedError
@@ -163,6 +176,17 @@ class BaseStorage(object):
         """List of pids."""
         raise NotImplementedError
 
+    def list_page(self, offset=0, limit=None, filter=None):
+        """List up to `limit` documents, starting at `offset`,
+        optionally just those whose labels contain the `filter`
+        text.  Backends should override this with something
+        that doesn't fetch every document."""
+        docs = self.list()
+        if filter:
+            docs = (d for d in docs if filter.lower() in d.label.lower())
+        return list(itertools.islice(docs, offset,
+                None if limit is None else offset + limit))
+
     def next(self, pid):
         """Get next pid to this one"""
         plist = self.list_pids()
@@ -189,9 +213,7 @@ class BaseStorage(object):
     @classmethod
     def sort_pidlist(cls, namespace, pidlist):
         """Sort a pid list numerically."""
-        def sfunc(a, b):
-            return cls.pid_index(namespace, a) - cls.pid_index(namespace, b)
-        return sorted(pidlist, sfunc)
+        return sorted(pidlist, key=lambda pid: cls.pid_index(namespace, pid))
 
 
 class BaseDocumentType(type):
@@ -276,10 +298,24 @@ class BaseDocument(object):
         back.paste(pil, ((size[0] - pil.size[0]) / 2, (size[1] - pil.size[1]) / 2))
         return back
 
+    def open_thumbnail_source(self, handle):
+        """Open the main image for thumbnailing.  JPEGs
+        are decoded at a reduced scale (using PIL's draft
+        mode), and anything much bigger than a thumbnail
+        is first cut down with a cheap filter so the
+        antialiasing doesn't have to work on the whole
+        image."""
+        size = settings.THUMBNAIL_SIZE
+        im = Image.open(handle)
+        im.draft(im.mode, size)
+        if im.size[0] > size[0] * 4 or im.size[1] > size[1] * 4:
+            im.thumbnail((size[0] * 2, size[1] * 2), Image.NEAREST)
+        return im
+
     def make_thumbnail(self):
         """Create a thumbnail of the main image."""
         with self.image_content as handle:
-            im = Image.open(handle)
+            im = self.open_thumbnail_source(handle)
             thumb = self.process_thumbnail(im)
             # FIXME: This is NOT elegant... 
             try:
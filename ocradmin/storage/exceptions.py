@@ -11,4 +11,5 @@ class DatastreamNotFoundError(StandardError):
     pass
 
 
-
+class DatastreamWriteError(StandardError):
+    pass
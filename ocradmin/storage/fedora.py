@@ -3,8 +3,12 @@ Fedora storage backend.
 """
 
 import io
+import os
 import re
 import urllib
+import shutil
+import tempfile
+import itertools
 from django import forms
 from django.conf import settings
 import eulfedora
@@ -12,9 +16,55 @@ import hashlib
 from cStringIO import StringIO
 from eulfedora.server import Repository
 from eulfedora.models import DigitalObject, FileDatastream
-
-from . import base
-
+from eulfedora.util import RequestFailed
+from fcrepo.http import pool
+from fcrepo.http.restapi import FCRepoRestAPI
+from fcrepo.http.RequestFactory import FCRepoRequestFactory
+
+from . import base, exceptions
+
+
+# connections to each Fedora host are pooled and kept
+# alive, and shared by everything in the process that
+# gets its REST client from get_rest_api()
+pool.configure(
+        maxsize=getattr(settings, "FEDORA_POOL_SIZE", 4),
+        timeout=getattr(settings, "FEDORA_TIMEOUT", 60),
+        retries=getattr(settings, "FEDORA_RETRIES", 2))
+
+
+def get_rest_api(root, username, password):
+    """Get a REST client for a Fedora repository."""
+    return FCRepoRestAPI(repository_url=root, username=username,
+            password=password)
+
+
+def read_datastream(api, pid, dsid):
+    """Stream datastream content into a temp file that only
+    goes to disk once it's bigger than FEDORA_SPOOL_SIZE,
+    since image readers need to be able to seek.  Returns
+    None if there's no such datastream."""
+    response = api.openDatastreamDissemination(pid, dsid)
+    try:
+        if response.status == 404:
+            return
+        if response.status != 200:
+            raise RequestFailed(response)
+        spool = tempfile.SpooledTemporaryFile(
+                max_size=getattr(settings, "FEDORA_SPOOL_SIZE", 4 * 1024 * 1024))
+        shutil.copyfileobj(response, spool, FCRepoRequestFactory.BLOCK_SIZE)
+        spool.seek(0)
+        return spool
+    finally:
+        response.close()
+
+
+def escape_search(value):
+    """
+    Escape Fedora's search wildcards, quotes and spaces
+    in a user-supplied value, so it matches literally.
+    """
+    return re.sub(r"""([\\*?'" ])""", r"\\\1", value)
 
 
 class ConfigForm(base.BaseConfigForm):
@@ -61,6 +111,10 @@ class FedoraStorage(base.BaseStorage):
         self.repo = Repository(
                 root=kwargs["root"], username=kwargs["username"],
                 password=kwargs["password"])
+        # REST client for streaming datastream content, which
+        # EULFedora always reads into memory
+        self.api = get_rest_api(kwargs["root"], kwargs["username"],
+                kwargs["password"])
 
         self.model = type("Document", (DigitalObject,), {
             "default_pidspace": kwargs["namespace"],
@@ -126,10 +180,21 @@ class FedoraStorage(base.BaseStorage):
         return getattr(doc._doc, attr).mimetype
 
     def document_attr_content_handle(self, doc, attr):
-        """Get content for an image type attribute."""
-        handle = getattr(doc._doc, attr).content
+        """Get content for an image type attribute.  Saved
+        content is streamed from Fedora."""
+        ds = getattr(doc._doc, attr)
+        if not doc._doc.exists or ds.isModified():
+            handle = ds.content
+        else:
+            handle = read_datastream(self.api, doc.pid,
+                    getattr(self, "%s_name" % attr))
         return StringIO() if handle is None else handle
 
+    def connection_stats(self):
+        """Request counts and timings for the connection
+        pool to the repository host."""
+        return self.api.getRequestFactory().getStats()
+
     def document_metadata(self, doc):
         """Get document metadata. This currently
         just exposes the DC stream attributes."""                
@@ -150,6 +215,29 @@ class FedoraStorage(base.BaseStorage):
     def set_document_attr_mimetype(self, doc, attr, mimetype):
         """Set image mimetype."""
         getattr(doc._doc, attr).mimetype = mimetype
+
+    def write_document_attr(self, doc, attr, handle, mimetype, label):
+        """Upload attribute content straight from a file handle,
+        in blocks, rather than via EULFedora.  Documents that
+        aren't in the repository yet are saved as usual."""
+        if not doc._doc.exists:
+            return super(FedoraStorage, self).write_document_attr(
+                    doc, attr, handle, mimetype, label)
+        handle.seek(0, os.SEEK_END)
+        length = handle.tell()
+        handle.seek(0)
+        dsid = getattr(self, "%s_name" % attr)
+        params = dict(content=handle, contentLength=length,
+                mimeType=mimetype, dsLabel=label)
+        if getattr(doc._doc, attr).exists:
+            response = self.api.modifyDatastream(doc.pid, dsid, **params)
+        else:
+            response = self.api.addDatastream(doc.pid, dsid,
+                    controlGroup="M", versionable="true", **params)
+        if response.getStatus() not in ("200", "201"):
+            raise exceptions.DatastreamWriteError(
+                    "Error writing %s datastream to %s: %s" % (
+                        dsid, doc.pid, response.getStatus()))
     
     def set_document_attr_label(self, doc, attr, label):
         """Set image label."""
@@ -169,12 +257,26 @@ class FedoraStorage(base.BaseStorage):
 
     def create_document(self, label):
         """Get a new document object"""
-        dobj = self.repo.get_object(type=self.model)
+        return self._new_document(
+                self.repo.get_object(type=self.model), label)
+
+    def create_documents(self, labels):
+        """Get new document objects, reserving all
+        their pids with a single request."""
+        if not labels:
+            return []
+        pids = self.repo.get_next_pid(namespace=self.namespace,
+                count=len(labels))
+        if isinstance(pids, basestring):
+            pids = [pids]
+        return [self._new_document(self.repo.get_object(pid, create=True,
+                type=self.model), label) for pid, label in zip(pids, labels)]
+
+    def _new_document(self, dobj, label):
         dobj.label = label
         dobj.meta.label = "Document Metadata"
         dobj.meta.mimetype = "text/plain"
-        doc = FedoraDocument(dobj, self)
-        return doc
+        return FedoraDocument(dobj, self)
 
     def get(self, pid):
         """Get an object by id."""
@@ -192,6 +294,19 @@ class FedoraStorage(base.BaseStorage):
         return [FedoraDocument(d, self) \
                 for d in self.repo.find_objects("%s:*" % ns, type=self.model)]
         
+    def list_page(self, offset=0, limit=None, filter=None):
+        """List a page of documents.  Fedora does the label
+        search, and pages through the results in chunks of
+        `limit` (following its session token), so only
+        the objects up to the end of the page are fetched."""
+        query = {"pid__contains": "%s:*" % self.namespace}
+        if filter:
+            query["label__contains"] = "*%s*" % escape_search(filter)
+        objs = self.repo.find_objects(type=self.model,
+                chunksize=limit and offset + limit, **query)
+        return [FedoraDocument(d, self) for d in itertools.islice(objs,
+                offset, None if limit is None else offset + limit)]
+
     def list_pids(self, namespace=None):
         """List of pids.  This unforunately involves calling
         list(), so it not a quicker alternative."""
@@ -12,9 +12,8 @@ from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
 from ocradmin.core.utils import media_path_to_url
-from PIL import Image
 
-from . import base, exceptions
+from . import base, exceptions, index
 
 
 class ConfigForm(base.BaseConfigForm):
@@ -27,7 +26,7 @@ class Document(base.BaseDocument):
     def make_thumbnail(self):
         """Create a thumbnail of the main image."""
         with self.image_content as handle:
-            im = Image.open(handle)
+            im = self.open_thumbnail_source(handle)
             thumb = self.process_thumbnail(im)
             # FIXME: This is NOT elegant... 
             with io.open(os.path.join(
@@ -39,9 +38,10 @@ class Document(base.BaseDocument):
 
 
 
-# README: This is a very naive and inefficient file-based repository.
-# Currently nothing is cached and all attribute updates are written
-# immediately.
+# README: This is a very naive file-based repository.  Metadata is
+# served from an SQLite index at the namespace root (with meta.txt
+# kept up to date alongside it) but all attribute updates are
+# written immediately.
 class FileSystemStorage(base.BaseStorage):
     """Filesystem storage backend.  A document is represented
     as a directory of datastreams, i.e:
@@ -74,31 +74,61 @@ class FileSystemStorage(base.BaseStorage):
     def __init__(self, *args, **kwargs):
         self.namespace = kwargs["namespace"]
         self._checkconfigured()
+        self._index = None
+        self._pids = None
 
     @property
     def namespace_root(self):
         docroot = getattr(settings, "DOCUMENT_ROOT", "")
         return os.path.join(docroot, self.namespace)
 
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = index.MetadataIndex(self.namespace_root)
+        return self._index
+
+    @property
+    def pids(self):
+        if self._pids is None:
+            self._pids = index.PidIndex(self.namespace_root, self.namespace)
+        return self._pids
+
     def document_path(self, doc):
         return os.path.join(self.namespace_root, doc.pid)
 
     def get_next_pid(self):
-        """Get the next filesystem pid.  FIXME: This is not
-        re-entrance or thread-safe (but then not much else is!)"""
-        if not os.path.exists(self.namespace_root):
-            return "%s:1" % self.namespace
-        pidnums = []
-        for item in os.listdir(self.namespace_root):
-            if os.path.isdir(os.path.join(self.namespace_root, item)):
-                pidindex = self.pid_index(self.namespace, item)
-                if pidindex is not None:
-                    pidnums.append(pidindex)
-        if not len(pidnums):
-            return "%s:1" % self.namespace
-        return "%s:%d" % (self.namespace, max(sorted(pidnums)) + 1)
+        """Reserve and return the next filesystem pid.  This is
+        safe to call from several processes at once."""
+        return self.pids.allocate()
 
     def read_metadata(self, doc):
+        meta = self.index.get(doc.pid)
+        if meta is None:
+            # not indexed yet, so do that now
+            meta = self.read_metadata_file(doc)
+            self.index.set(doc.pid, meta)
+        return meta
+
+    def write_metadata(self, doc, **kwargs):
+        self.index.set(doc.pid, kwargs)
+        self.write_metadata_file(doc, kwargs)
+        doc._metacache = kwargs
+
+    def merge_metadata(self, doc, **kwargs):
+        # make sure anything in an unindexed meta.txt isn't lost
+        self.read_metadata(doc)
+        meta = self.index.merge(doc.pid, kwargs)
+        self.write_metadata_file(doc, meta)
+        doc._metacache = meta
+
+    def delete_metadata(self, doc, *args):
+        self.read_metadata(doc)
+        meta = self.index.delete(doc.pid, args)
+        self.write_metadata_file(doc, meta)
+        doc._metacache = meta
+
+    def read_metadata_file(self, doc):
         metapath = os.path.join(self.document_path(doc), self.meta_name)
         if not os.path.exists(metapath):
             return {}
@@ -106,20 +136,33 @@ class FileSystemStorage(base.BaseStorage):
             return dict([v.strip().split("=") for v in \
                     metahandle.readlines() if re.match("^\w+=[^=]+$", v.strip())])
 
-    def write_metadata(self, doc, **kwargs):
+    def write_metadata_file(self, doc, meta):
         metapath = os.path.join(self.document_path(doc), self.meta_name)
         with io.open(metapath, "w") as metahandle:
-            for k, v in kwargs.iteritems():
+            for k, v in meta.iteritems():
                 metahandle.write(u"%s=%s\n" % (k, v))
 
     def create_document(self, label):
         """Get a new document object"""
-        pid = self.get_next_pid()
-        # better that this fails than try to handle it
-        os.makedirs(os.path.join(self.namespace_root, pid))
-        doc = Document(pid, self)
-        self.merge_metadata(doc, label=label)
-        return doc
+        return self.create_documents([label])[0]
+
+    def create_documents(self, labels):
+        """Get new document objects, allocating all
+        their pids at once."""
+        docs = []
+        pids = self.pids.allocate(len(labels))
+        for i, (pid, label) in enumerate(zip(pids, labels)):
+            # better that this fails than try to handle it
+            try:
+                os.makedirs(os.path.join(self.namespace_root, pid))
+            except OSError:
+                for unused in pids[i:]:
+                    self.pids.remove(unused)
+                raise
+            doc = Document(pid, self)
+            self.merge_metadata(doc, label=label)
+            docs.append(doc)
+        return docs
 
     def save_document(self, doc):
         """Save document contents."""
@@ -132,7 +175,7 @@ class FileSystemStorage(base.BaseStorage):
 
     def document_label(self, doc):
         """Get the document label."""
-        return self.read_metadata(doc).get("label", "")
+        return doc.metadata.get("label", "")
 
     def document_attr_empty(self, doc, attr):
         """Check if document attr is empty."""
@@ -142,11 +185,11 @@ class FileSystemStorage(base.BaseStorage):
 
     def document_attr_label(self, doc, attr):
         """Get the document image label."""
-        return self.read_metadata(doc).get("%s_label" % attr, "")
+        return doc.metadata.get("%s_label" % attr, "")
 
     def document_attr_mimetype(self, doc, attr):
         """Get the document image mimetype."""
-        return self.read_metadata(doc).get("%s_mimetype" % attr, "")
+        return doc.metadata.get("%s_mimetype" % attr, "")
 
     def document_attr_content_handle(self, doc, attr):
         """Get a handle to a document attribute's content. This
@@ -167,7 +210,7 @@ class FileSystemStorage(base.BaseStorage):
             elif isinstance(content, basestring):
                 imghandle.write(content)
             else:
-                imghandle.write(content.read())
+                shutil.copyfileobj(content, imghandle)
 
     def set_document_attr_mimetype(self, doc, attr, mimetype):
         """Set image mimetype."""
@@ -177,6 +220,13 @@ class FileSystemStorage(base.BaseStorage):
         """Set image label."""
         self.merge_metadata(doc, **{"%s_label" % attr: label})
 
+    def write_document_attr(self, doc, attr, handle, mimetype, label):
+        """Set attr content, mimetype and label, with
+        a single metadata update."""
+        self.set_document_attr_content(doc, attr, handle)
+        self.merge_metadata(doc, **{"%s_mimetype" % attr: mimetype,
+                "%s_label" % attr: label})
+
     def set_document_label(self, doc, label):
         """Set document label."""
         self.merge_metadata(doc, label=label)
@@ -190,6 +240,8 @@ class FileSystemStorage(base.BaseStorage):
         """Delete an object."""
         # TODO: Make more robust
         shutil.rmtree(self.document_path(doc))
+        self.index.remove(doc.pid)
+        self.pids.remove(doc.pid)
         # if  we're deleting the last object
         # also delete the namespace root.
         # Just try this and ignore the error
@@ -200,31 +252,36 @@ class FileSystemStorage(base.BaseStorage):
 
     def list(self, namespace=None):
         """List documents in the repository."""
+        return self.list_page()
+
+    def list_page(self, offset=0, limit=None, filter=None):
+        """List a page of documents, in pid order."""
         if not os.path.exists(self.namespace_root):
             return []
-        return [Document(pid, self) for pid in self.list_pids()]
+        if filter:
+            # labels can only be searched once they're indexed
+            self.pids.ensure_built()
+            for pid in self.index.unindexed():
+                self.read_metadata(Document(pid, self))
+        pids = self.pids.list(offset, limit, label=filter)
+        # fetch the metadata for everything in one go
+        metas = self.index.get_many(pids)
+        docs = []
+        for pid in pids:
+            doc = Document(pid, self)
+            doc._metacache = metas.get(pid)
+            docs.append(doc)
+        return docs
 
     def list_pids(self, namespace=None):
         if not os.path.exists(self.namespace_root):
             return []
-        return self.sort_pidlist(self.namespace, 
-                [p for p in os.listdir(self.namespace_root) \
-                    if os.path.isdir(os.path.join(self.namespace_root, p)) and \
-                        not self.pid_index(self.namespace, p) is None])
+        return self.pids.list()
 
     def next(self, pid):
         """Get next pid to this one"""
-        plist = self.list_pids()
-        idx = plist.index(pid)
-        if len(plist) == idx + 1:
-            return None
-        return plist[idx + 1]
+        return self.pids.next(pid)
 
     def prev(self, pid):
         """Get previous pid to this one."""
-        plist = self.list_pids()
-        idx = plist.index(pid)
-        if idx == 0:
-            return None
-        return plist[idx - 1]        
-
+        return self.pids.prev(pid)
@@ -0,0 +1,273 @@
+"""
+SQLite indexes of document pids and metadata for
+file-based storage.
+"""
+
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+
+
+class SqliteIndex(object):
+    """
+    Base class for indexes kept in an SQLite database at a
+    namespace root, so they can be shared between processes.
+    The indexes share a database, so can be queried together.
+    """
+    dbname = ".metadata.db"
+    # keep IN (...) lists under SQLite's host parameter limit
+    chunksize = 500
+    # set to None to manage transactions by hand
+    isolation_level = ""
+
+    def __init__(self, root):
+        self._root = root
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            if not os.path.exists(self._root):
+                os.makedirs(self._root)
+            self._conn = sqlite3.connect(
+                    os.path.join(self._root, self.dbname), timeout=30,
+                    isolation_level=self.isolation_level)
+            self.create_tables(self._conn)
+            self._conn.commit()
+        return self._conn
+
+    def create_tables(self, conn):
+        conn.execute("""CREATE TABLE IF NOT EXISTS documents (
+                pid TEXT PRIMARY KEY)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS metadata (
+                pid TEXT NOT NULL, key TEXT NOT NULL, value TEXT,
+                PRIMARY KEY (pid, key))""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS pids (
+                pidnum INTEGER PRIMARY KEY, pid TEXT UNIQUE NOT NULL)""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY, value INTEGER NOT NULL)""")
+
+
+class MetadataIndex(SqliteIndex):
+    """
+    Key/value metadata for every document in a namespace.
+    A document that isn't in the index yet (i.e. one created
+    before there was an index) has no row in `documents`,
+    as distinct from one with no metadata.
+    """
+
+    def get(self, pid):
+        """
+        Get a dictionary of metadata for a pid, or None
+        if it isn't indexed.
+        """
+        return self.get_many([pid]).get(pid)
+
+    def unindexed(self):
+        """
+        List pids (in the pid index) that have no
+        indexed metadata.
+        """
+        return [pid for (pid,) in self.conn.execute("SELECT pid FROM pids "
+                "WHERE pid NOT IN (SELECT pid FROM documents)")]
+
+    def get_many(self, pids):
+        """
+        Get a dictionary of metadata dictionaries for each
+        of the given pids that is indexed.
+        """
+        metas = {}
+        pids = list(pids)
+        for start in range(0, len(pids), self.chunksize):
+            chunk = pids[start:start + self.chunksize]
+            marks = ",".join("?" * len(chunk))
+            cur = self.conn.execute(
+                    "SELECT pid FROM documents WHERE pid IN (%s)" % marks, chunk)
+            for (pid,) in cur:
+                metas[pid] = {}
+            cur = self.conn.execute("SELECT pid, key, value FROM metadata "
+                    "WHERE pid IN (%s)" % marks, chunk)
+            for pid, key, value in cur:
+                metas[pid][key] = value
+        return metas
+
+    def set(self, pid, meta):
+        """
+        Replace all of a pid's metadata.
+        """
+        with self.conn:
+            self.conn.execute(
+                    "INSERT OR IGNORE INTO documents (pid) VALUES (?)", (pid,))
+            self.conn.execute("DELETE FROM metadata WHERE pid = ?", (pid,))
+            self._insert(pid, meta)
+
+    def merge(self, pid, meta):
+        """
+        Set some of a pid's metadata, returning the
+        (whole) updated metadata.
+        """
+        with self.conn:
+            self.conn.execute(
+                    "INSERT OR IGNORE INTO documents (pid) VALUES (?)", (pid,))
+            self._insert(pid, meta)
+            return self._select(pid)
+
+    def delete(self, pid, keys):
+        """
+        Delete some of a pid's metadata, returning
+        what's left.
+        """
+        with self.conn:
+            self.conn.executemany(
+                    "DELETE FROM metadata WHERE pid = ? AND key = ?",
+                    [(pid, key) for key in keys])
+            return self._select(pid)
+
+    def remove(self, pid):
+        """
+        Remove a pid from the index.
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM metadata WHERE pid = ?", (pid,))
+            self.conn.execute("DELETE FROM documents WHERE pid = ?", (pid,))
+
+    def _insert(self, pid, meta):
+        self.conn.executemany("INSERT OR REPLACE INTO metadata "
+                "(pid, key, value) VALUES (?, ?, ?)",
+                [(pid, k, unicode(v)) for k, v in meta.iteritems()])
+
+    def _select(self, pid):
+        cur = self.conn.execute(
+                "SELECT key, value FROM metadata WHERE pid = ?", (pid,))
+        return dict(cur.fetchall())
+
+
+class PidIndex(SqliteIndex):
+    """
+    Numerically-ordered index of the pids in a namespace,
+    with a counter for allocating new ones.  Allocation
+    takes SQLite's write lock on the database file, so is
+    safe between processes.  The first time it's used the
+    index is built from the document directories.
+    """
+    isolation_level = None
+
+    def __init__(self, root, namespace):
+        super(PidIndex, self).__init__(root)
+        self._namespace = namespace
+        self._built = False
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run a block with the write lock held.
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        else:
+            self.conn.execute("COMMIT")
+
+    def _is_built(self):
+        return self.conn.execute("SELECT value FROM counters "
+                "WHERE name = 'pid'").fetchone() is not None
+
+    def ensure_built(self):
+        """
+        Build the index from the document directories,
+        if that hasn't been done yet.
+        """
+        if self._built or self._is_built():
+            self._built = True
+            return
+        with self.transaction():
+            # somebody else might have got there first
+            if not self._is_built():
+                self._build()
+        self._built = True
+
+    def _build(self):
+        pidnums = []
+        for item in os.listdir(self._root):
+            pidnum = self.pidnum(item)
+            if pidnum is not None and \
+                    os.path.isdir(os.path.join(self._root, item)):
+                pidnums.append((pidnum, item))
+        self.conn.executemany(
+                "INSERT OR REPLACE INTO pids (pidnum, pid) VALUES (?, ?)",
+                pidnums)
+        self.conn.execute("INSERT INTO counters (name, value) VALUES ('pid', ?)",
+                (max([0] + [num for num, pid in pidnums]),))
+
+    def pidnum(self, pid):
+        match = re.match("^%s:(\d+)$" % re.escape(self._namespace), pid)
+        if match:
+            return int(match.group(1))
+
+    def allocate(self, count=None):
+        """
+        Reserve and return the next pid or, given a count,
+        a list of that many pids, in a single transaction.
+        """
+        if count == 0:
+            return []
+        self.ensure_built()
+        with self.transaction() as conn:
+            value = conn.execute("SELECT value FROM counters "
+                    "WHERE name = 'pid'").fetchone()[0]
+            pidnums = [(num, "%s:%d" % (self._namespace, num)) \
+                    for num in range(value + 1, value + (count or 1) + 1)]
+            conn.execute("UPDATE counters SET value = ? WHERE name = 'pid'",
+                    (pidnums[-1][0],))
+            conn.executemany("INSERT OR REPLACE INTO pids (pidnum, pid) "
+                    "VALUES (?, ?)", pidnums)
+        pids = [pid for num, pid in pidnums]
+        return pids if count is not None else pids[0]
+
+    def remove(self, pid):
+        self.ensure_built()
+        self.conn.execute("DELETE FROM pids WHERE pid = ?", (pid,))
+
+    def list(self, offset=0, limit=None, label=None):
+        """
+        List pids in order, optionally just those whose
+        (indexed) label contains the given text.
+        """
+        self.ensure_built()
+        sql = "SELECT pids.pid FROM pids"
+        params = []
+        if label:
+            sql += (" JOIN metadata ON metadata.pid = pids.pid"
+                    " AND metadata.key = 'label'"
+                    " WHERE metadata.value LIKE ? ESCAPE '\\'")
+            params.append("%%%s%%" % re.sub(r"([\\%_])", r"\\\1", label))
+        sql += " ORDER BY pids.pidnum LIMIT ? OFFSET ?"
+        params.extend([-1 if limit is None else limit, offset])
+        return [pid for (pid,) in self.conn.execute(sql, params)]
+
+    def next(self, pid):
+        """
+        Get the pid after this one, or None.
+        """
+        return self._neighbour(pid, ">", "ASC")
+
+    def prev(self, pid):
+        """
+        Get the pid before this one, or None.
+        """
+        return self._neighbour(pid, "<", "DESC")
+
+    def _neighbour(self, pid, op, order):
+        pidnum = self.pidnum(pid)
+        if pidnum is None:
+            return
+        self.ensure_built()
+        row = self.conn.execute("SELECT pid FROM pids WHERE pidnum %s ? "
+                "ORDER BY pidnum %s LIMIT 1" % (op, order),
+                (pidnum,)).fetchone()
+        if row is not None:
+            return row[0]